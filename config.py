@@ -76,6 +76,22 @@ conf.registerGlobalValue(Sigyn, 'useNotice',
      
 conf.registerGlobalValue(Sigyn,'resolverTimeout',
     registry.PositiveInteger(3, """max duration of dns request/resolve in seconds"""))
+conf.registerGlobalValue(Sigyn,'resolverThreads',
+    registry.PositiveInteger(4, """number of threads doing dns resolutions"""))
+conf.registerGlobalValue(Sigyn,'resolverQueue',
+    registry.PositiveInteger(512, """max number of pending dns requests, others are ignored until there is room"""))
+conf.registerGlobalValue(Sigyn,'resolverNegativeLife',
+    registry.PositiveInteger(300, """life in seconds of cached empty dns answers"""))
+conf.registerGlobalValue(Sigyn,'capabilityCacheSize',
+    registry.PositiveInteger(65536, """max number of users's capabilities per channel kept in memory"""))
+conf.registerGlobalValue(Sigyn,'capabilityCacheLife',
+    registry.PositiveInteger(60, """life in seconds of cached users's capabilities, they are also dropped when users or channels databases change"""))
+conf.registerGlobalValue(Sigyn,'maskCacheSize',
+    registry.PositiveInteger(65536, """max number of prefix to mask computations kept in memory"""))
+conf.registerGlobalValue(Sigyn,'maskCacheLife',
+    registry.PositiveInteger(86400, """life in seconds of cached masks which don't need dns resolution"""))
+conf.registerGlobalValue(Sigyn,'maskCacheResolvedLife',
+    registry.PositiveInteger(3600, """life in seconds of cached masks computed from dns resolution"""))
      
 conf.registerGlobalValue(Sigyn, 'klineDuration',
      registry.Integer(-1, """kline duration, in minutes, with -1, bot will not kill or kline"""))
@@ -167,11 +183,41 @@ conf.registerGlobalValue(Sigyn, 'channelCreationLife',
 conf.registerGlobalValue(Sigyn, 'lethalChannels',
     registry.CommaSeparatedListOfStrings([''],"""patterns to match"""))
 
+# permanent patterns
+conf.registerGlobalValue(Sigyn, 'patternCountInterval',
+    registry.PositiveInteger(60,"""interval in seconds between two writes of pending patterns's triggers count to database"""))
+conf.registerGlobalValue(Sigyn, 'patternCountPermit',
+    registry.PositiveInteger(50,"""number of pending patterns's triggers which forces a write to database"""))
+
+# detectors profiling
+conf.registerGlobalValue(Sigyn, 'profileSample',
+    registry.NonNegativeInteger(100,"""detectors are timed for 1 message out of <n>, 0 to disable"""))
+conf.registerGlobalValue(Sigyn, 'profileLife',
+    registry.PositiveInteger(600,"""in seconds, detectors timings are kept between one and two times this duration"""))
+conf.registerGlobalValue(Sigyn, 'profileFile',
+    registry.String('',"""if set, profile command also writes detectors timings into this file"""))
+
+# metrics
+conf.registerGlobalValue(Sigyn, 'metricsHost',
+    registry.String('127.0.0.1',"""address where metrics are served"""))
+conf.registerGlobalValue(Sigyn, 'metricsPort',
+    registry.NonNegativeInteger(0,"""port where metrics are served over http, 0 to disable"""))
+conf.registerGlobalValue(Sigyn, 'metricsFile',
+    registry.String('',"""if set, metrics are periodically written into this file, for textfile collectors"""))
+conf.registerGlobalValue(Sigyn, 'metricsInterval',
+    registry.PositiveInteger(60,"""interval in seconds between two writes of metricsFile"""))
+
 # dronebl submit
 conf.registerGlobalValue(Sigyn, 'droneblKey',
      registry.String("", """dronebl key for rpc calls""", private=True))
 conf.registerGlobalValue(Sigyn, 'droneblHost',
      registry.String("http://dronebl.org/RPC2", """where bot must do rpc calls"""))
+conf.registerGlobalValue(Sigyn, 'droneblBatch',
+    registry.PositiveInteger(20,"""max number of ips sent in one request"""))
+conf.registerGlobalValue(Sigyn, 'droneblLife',
+    registry.PositiveInteger(3600,"""duration in seconds during which an ip already submitted is ignored"""))
+conf.registerGlobalValue(Sigyn, 'droneblRetries',
+    registry.NonNegativeInteger(3,"""number of retries, with exponential backoff, when a request fails"""))
 conf.registerGlobalValue(Sigyn, 'droneblPatterns',
     registry.CommaSeparatedListOfStrings([''],"""patterns to match"""))
 
@@ -39,11 +39,18 @@ import requests
 from urllib.parse import urlencode
 import sqlite3
 import http.client
+import http.server
 import threading
 import dns.resolver
 import json
 import ipaddress
 import random
+import array
+import bisect
+import functools
+import collections
+import queue
+import unicodedata
 import supybot.log as log
 import supybot.conf as conf
 import supybot.utils as utils
@@ -59,17 +66,116 @@ import supybot.schedule as schedule
 import supybot.registry as registry
 from ftfy.badness import sequence_weirdness
 from ftfy.badness import text_cost
+from ftfy.chardata import chars_to_classes
+import ftfy.badness
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('Sigyn')
 except:
     _ = lambda x:x
 
+# longest text searched by repetitions, irc lines are shorter
+repetitionsLength = 2048
+
+def commonPrefix (s,i,j,limit):
+    """returns length of the common prefix of s[i:] and s[j:], at most limit"""
+    # galloping then binary search, characters are compared by slices
+    limit = min(limit,len(s)-max(i,j))
+    lo = 0
+    n = 1
+    while n <= limit and s[i+lo:i+n] == s[j+lo:j+n]:
+        lo = n
+        n = n * 2
+    hi = min(n,limit+1)
+    while hi - lo > 1:
+        m = (lo + hi) // 2
+        if s[i+lo:i+m] == s[j+lo:j+m]:
+            lo = m
+        else:
+            hi = m
+    return lo
+
+def squares (s):
+    """returns for each position of s the half length of the shortest square starting there, 0 if none"""
+    # a square of half length p starting at x has exactly one multiple j of p in its first half,
+    # squares around j are found by extending the match between j and j+p both ways;
+    # periods are tried in increasing order and only checkpoints near positions without square are visited
+    n = len(s)
+    r = s[::-1]
+    shortest = [0] * n
+    # next position without square yet, path compressed
+    free = list(range(n+1))
+    def find (x):
+        root = x
+        while free[root] != root:
+            root = free[root]
+        while free[x] != root:
+            (free[x],x) = (root,free[x])
+        return root
+    for p in range(1,n//2+1):
+        x = find(0)
+        while x <= n - 2*p:
+            j = (x + p - 1) // p * p
+            if s[j] == s[j+p]:
+                forward = commonPrefix(s,j,j+p,p)
+                if forward == p:
+                    hi = j
+                else:
+                    hi = j + forward - p
+                if hi >= x:
+                    lo = j - commonPrefix(r,n-j,n-j-p,j-x)
+                    if lo <= hi:
+                        x = find(max(x,lo))
+                        while x <= hi:
+                            shortest[x] = p
+                            free[x] = x + 1
+                            x = find(x+1)
+            x = find(j+1)
+    return shortest
+
+def shortestSquare (s,x,tries):
+    """returns (half length of the shortest square starting at x or 0, tries left), None as length if tries ran out"""
+    n = len(s)
+    end = (n + x) // 2
+    key = s[x:x+8]
+    # shorter periods are candidates where the first character occurs again, longer ones where the key does
+    for (sub,start,stop) in ((key[:1],x+1,min(x+len(key)-1,end)+1),(key,x+len(key),end+len(key))):
+        k = s.find(sub,start,stop)
+        while k != -1:
+            if not tries:
+                return (None,0)
+            tries = tries - 1
+            if s.startswith(s[x:k],k):
+                return (k-x,tries)
+            k = s.find(sub,k+1,stop)
+    return (0,tries)
+
 def repetitions(s):
-    # returns a list of (pattern,count), used to detect a repeated pattern inside a single string.
-    r = re.compile(r"(.+?)\1+")
-    for match in r.finditer(s):
-        yield (match.group(1), len(match.group(0))/len(match.group(1)))
+    # returns a list of (pattern,count), used to detect a repeated pattern inside a single string,
+    # same results as finditer of (.+?)\1+ without its quadratic backtracking on lines with few repeats
+    s = s[:repetitionsLength]
+    for line in s.split('\n'):
+        n = len(line)
+        # squares are searched from each position until too many candidates were tried,
+        # then those of the rest of the line are computed at once
+        tries = 2 * n
+        shortest = None
+        base = 0
+        x = 0
+        while x < n:
+            if shortest is None:
+                (p,tries) = shortestSquare(line,x,tries)
+                if p is None:
+                    base = x
+                    shortest = squares(line[x:])
+            if shortest is not None:
+                p = shortest[x-base]
+            if p:
+                length = p + commonPrefix(line,x,x+p,n) // p * p
+                yield (line[x:x+p], length/p)
+                x = x + length
+            else:
+                x = x + 1
 
 def isCloaked (prefix,sig):
     if sig.registryValue('useWhoWas'):
@@ -83,34 +189,146 @@ def isCloaked (prefix,sig):
         return True
     return False
 
-def compareString (a,b):
-    """return 0 to 1 float percent of similarity ( 0.85 seems to be a good average )"""
+@functools.lru_cache(maxsize=4096)
+def fingerprint (s):
+    """return frozenset of characters used in s"""
+    return frozenset(s)
+
+def compareString (a,b,fa=None,fb=None):
+    """return 0 to 1 float percent of similarity ( 0.85 seems to be a good average ), fingerprints may be given"""
     if a == b:
         return 1
-    sa, sb = set(a), set(b)
-    n = len(sa.intersection(sb))
-    if float(len(sa) + len(sb) - n) == 0:
+    if fa is None:
+        fa = fingerprint(a)
+    if fb is None:
+        fb = fingerprint(b)
+    u = len(fa | fb)
+    if u == 0:
         return 0
-    jacc = n / float(len(sa) + len(sb) - n)
+    jacc = len(fa & fb) / float(u)
     return jacc
 
+def similarSizes (n,percent,largest):
+    """return range of fingerprint sizes which may be more than percent similar to a fingerprint of n characters,
+    largest is the biggest size stored"""
+    # jaccard of two sets is at most the ratio of their sizes
+    if percent <= 0:
+        return range(1,largest+1)
+    return range(max(1,int(n*percent)),min(largest,int(n/percent)+1)+1)
+
 def largestString (s1,s2):
     """return largest pattern available in 2 strings"""
-    # From https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/Longest_common_substring#Python2
-    # License: CC BY-SA
-    m = [[0] * (1 + len(s2)) for i in range(1 + len(s1))]
-    longest, x_longest = 0, 0
-    for x in range(1, 1 + len(s1)):
-        for y in range(1, 1 + len(s2)):
-            if s1[x - 1] == s2[y - 1]:
-                m[x][y] = m[x - 1][y - 1] + 1
-                if m[x][y] > longest:
-                    longest = m[x][y]
-                    x_longest = x
+    # suffix automaton of s2, s1 is walked through it keeping the longest match ending at each position,
+    # first longest match in s1 wins, like the former dynamic programming version
+    nexts = [{}]
+    links = [-1]
+    lengths = [0]
+    last = 0
+    for c in s2:
+        cur = len(nexts)
+        nexts.append({})
+        links.append(0)
+        lengths.append(lengths[last] + 1)
+        p = last
+        while p != -1 and c not in nexts[p]:
+            nexts[p][c] = cur
+            p = links[p]
+        if p != -1:
+            q = nexts[p][c]
+            if lengths[p] + 1 == lengths[q]:
+                links[cur] = q
             else:
-                m[x][y] = 0
+                clone = len(nexts)
+                nexts.append(dict(nexts[q]))
+                links.append(links[q])
+                lengths.append(lengths[p] + 1)
+                while p != -1 and nexts[p].get(c) == q:
+                    nexts[p][c] = clone
+                    p = links[p]
+                links[q] = clone
+                links[cur] = clone
+        last = cur
+    longest, x_longest = 0, 0
+    state, length = 0, 0
+    for x in range(len(s1)):
+        c = s1[x]
+        while state and c not in nexts[state]:
+            state = links[state]
+            length = lengths[state]
+        if c in nexts[state]:
+            state = nexts[state][c]
+            length += 1
+        else:
+            state, length = 0, 0
+        if length > longest:
+            longest = length
+            x_longest = x + 1
     return s1[x_longest - longest: x_longest]
 
+# ftfy character classes (see ftfy.chardata) scored by sequence_weirdness on their own or next to another class
+weirdClasses = frozenset('MiX2P_')
+latinClasses = frozenset('Ll')
+otherClasses = frozenset('AaC')
+symbolClasses = frozenset('MmN13')
+# ftfy's expressions of mojibake and common symbols, which also change the score, and the characters they need
+weirdExpressions = [getattr(ftfy.badness,name,None) for name in ('MOJIBAKE_SYMBOL_RE','COMMON_SYMBOL_RE')]
+# ftfy's expression of weird sequences of classes
+weirdSequences = getattr(ftfy.badness,'WEIRDNESS_RE',None)
+if None in weirdExpressions or weirdSequences is None:
+    # unknown ftfy, every line is scored
+    weirdExpressions = None
+else:
+    weirdChars = frozenset([chr(n) for n in range(0x80,0xa0)] + [c for e in weirdExpressions for c in e.pattern if ord(c) > 0x7f])
+
+def classesOf (text):
+    """returns set of ftfy classes of characters used in text"""
+    return set(chars_to_classes(text))
+
+if hasattr(unicodedata,'is_normalized'):
+    def isNormalized (text):
+        return unicodedata.is_normalized('NFC',text)
+else:
+    def isNormalized (text):
+        return unicodedata.normalize('NFC',text) == text
+
+def mayBeWeird (text,classes=None):
+    """returns False when sequence_weirdness of text is 0 for sure, text's ftfy classes may be given"""
+    if weirdExpressions is None:
+        return True
+    # lines proven candidates leave the screen as soon as possible
+    if classes is None:
+        classes = classesOf(text)
+    else:
+        classes = set(classes)
+    if not weirdClasses.isdisjoint(classes):
+        return True
+    if not latinClasses.isdisjoint(classes) and not otherClasses.isdisjoint(classes):
+        return True
+    if len(symbolClasses.intersection(classes)) > 1:
+        return True
+    # composing characters may change their classes
+    if not isNormalized(text):
+        return True
+    if weirdChars.isdisjoint(text):
+        return False
+    for expression in weirdExpressions:
+        if expression.search(text):
+            return True
+    return False
+
+@functools.lru_cache(maxsize=1024)
+def weirdness (text):
+    """returns ftfy's sequence_weirdness of text, only lines which may be weird are scored"""
+    if weirdExpressions is None:
+        return sequence_weirdness(text)
+    # sequence_weirdness, sharing its normalization and classes with the screen
+    text = unicodedata.normalize('NFC',text)
+    classes = chars_to_classes(text)
+    if not mayBeWeird(text,classes):
+        return 0
+    (mojibake,common) = weirdExpressions
+    return len(weirdSequences.findall(classes)) * 2 + len(mojibake.findall(text)) * 2 - len(common.findall(text))
+
 def floatToGMT (t):
     f = None
     try:
@@ -147,7 +365,7 @@ addConverter('getPatternAndMatcher', getPatternAndMatcher)
 
 class Ircd (object):
 
-    __slots__ = ('irc', 'channels','whowas','klines','queues','opered','defcon','pending','logs','limits','netsplit','ping','servers','resolving','stats','patterns','throttled','lastDefcon','god','mx','tokline','toklineresults','dlines', 'invites', 'nicks', 'domains', 'cleandomains', 'ilines', 'klinednicks', 'lastKlineOper')
+    __slots__ = ('irc', 'channels','whowas','klines','queues','opered','defcon','pending','logs','limits','netsplit','ping','servers','resolving','stats','patterns','matcher','triggers','triggered','throttled','lastDefcon','god','mx','tokline','toklineresults','dlines', 'invites', 'users', 'nickchannels', 'accounts', 'domains', 'cleandomains', 'ilines', 'klinednicks', 'lastKlineOper', 'timings', 'sampled', 'wheel', 'departed', 'shared', 'amsg')
 
     def __init__(self,irc):
         self.irc = irc
@@ -155,11 +373,17 @@ class Ircd (object):
         self.channels = {}
         # contains Pattern instances
         self.patterns = {}
+        # compiled view of patterns, matches all of them in one pass
+        self.matcher = Matcher()
+        # pending patterns's triggers count, written to database by batch
+        self.triggers = {}
+        # sum of pending triggers
+        self.triggered = 0
         # contains whowas requested for a short period of time
         self.whowas = {}
         # contains klines requested for a short period of time
         self.klines = {}
-        # contains various TimeoutQueue for detection purpose
+        # contains various Window for detection purpose
         # often it's [host] { with various TimeOutQueue and others elements }
         self.queues = {}
         # flag or time
@@ -187,15 +411,177 @@ class Ircd (object):
         self.toklineresults = {}
         self.dlines = []
         self.invites = {}
-        self.nicks = {}
+        # [nick] = User, shared by the Chan.nicks of every channel the nick is in
+        self.users = {}
+        # [nick] = set of channels the nick is in, for all users
+        self.nickchannels = {}
+        # [lowercased account] = set of nicks of tracked users logged in
+        self.accounts = {}
         self.cleandomains = {}
-        self.klinednicks = utils.structures.TimeoutQueue(86400*2)
+        # lethaled accounts, lowercased
+        self.klinednicks = ExpiringSet(86400*2)
         self.lastKlineOper = ''
+        # sampled detectors timings, [kind] = Histogram
+        self.timings = {}
+        self.sampled = 0
+        # Window expiries, (container,key,window,parent,parentKey), checked by cleanup
+        self.wheel = TimerWheel()
+        # Users which left a channel, removed from Chan.nicks by cleanup
+        self.departed = []
+        # [shareComputedPatternID] = TmpPatterns referenced by the Chan.patterns of the group
+        self.shared = {}
+        # [mask] = { fingerprint size : Window of (channel,text,fingerprint) }, messages checked for amsg
+        self.amsg = {}
 
     def __repr__(self):
         return '%s(patterns=%r, queues=%r, channels=%r, pending=%r, logs=%r, limits=%r, whowas=%r, klines=%r)' % (self.__class__.__name__,
         self.patterns, self.queues, self.channels, self.pending, self.logs, self.limits, self.whowas, self.klines)
 
+    def timer (self,sample,life):
+        """returns a Timer for 1 call out of sample, None otherwise"""
+        if not sample:
+            return None
+        self.sampled += 1
+        if self.sampled < sample:
+            return None
+        self.sampled = 0
+        return Timer(self.timings,life)
+
+    def track (self,chan,nick,prefix,mask,t,gecos=None,account=None):
+        """returns the User of nick, now seen in chan since t"""
+        user = self.users.get(nick)
+        if user is None:
+            user = self.users[nick] = User(nick)
+        user.prefix = prefix
+        user.mask = mask
+        if gecos is not None:
+            user.gecos = gecos
+        # '' when known as logged out
+        if account is not None:
+            self.login(user,account or None)
+        user.joins[chan.channel] = t
+        chan.nicks[nick] = user
+        return user
+
+    def untrack (self,chan,nick):
+        """removes nick from chan, and from the network once it's in no channel"""
+        user = chan.nicks.pop(nick,None)
+        if user is None:
+            return
+        user.joins.pop(chan.channel,None)
+        if not len(user.joins) and self.users.get(user.nick) is user:
+            self.login(user,None)
+            del self.users[user.nick]
+
+    def login (self,user,account):
+        """sets account of user, None when logged out"""
+        if user.account:
+            nicks = self.accounts.get(user.account.lower())
+            if nicks is not None:
+                nicks.discard(user.nick)
+                if not len(nicks):
+                    del self.accounts[user.account.lower()]
+        user.account = account
+        if account:
+            if not account.lower() in self.accounts:
+                self.accounts[account.lower()] = set()
+            self.accounts[account.lower()].add(user.nick)
+
+    def forget (self,nick):
+        """drops the record of nick from the network and returns it, its fields are kept for handlers still using it"""
+        user = self.users.pop(nick,None)
+        if user is not None and user.account:
+            account = user.account
+            self.login(user,None)
+            user.account = account
+        return user
+
+    def depart (self,nick):
+        """queues nick's User for cleanup, which untracks it from channels it left"""
+        user = self.users.get(nick)
+        if user is not None:
+            self.departed.append(user)
+
+    def sessions (self,account):
+        """returns tracked users logged in account"""
+        return [self.users[nick] for nick in self.accounts.get(account.lower(),()) if nick in self.users]
+
+    def enter (self,channel,nicks):
+        """records nicks as members of channel"""
+        chan = self.channels.get(channel)
+        if chan is None:
+            return
+        for nick in nicks:
+            chan.hilights.add(nick)
+            if not nick in self.nickchannels:
+                # nick is new in our channels, a record left by its former owner is stale
+                self.forget(nick)
+                self.nickchannels[nick] = set()
+            self.nickchannels[nick].add(channel)
+
+    def leave (self,channel,nick):
+        """forgets nick as member of channel, its User is untracked by cleanup"""
+        chan = self.channels.get(channel)
+        if chan is None:
+            return
+        chan.hilights.remove(nick)
+        if nick in self.nickchannels:
+            self.nickchannels[nick].discard(channel)
+            if not len(self.nickchannels[nick]):
+                del self.nickchannels[nick]
+
+    def quit (self,nick):
+        """returns channels where nick was, forgotten from each"""
+        channels = self.nickchannels.pop(nick,set())
+        for channel in channels:
+            self.channels[channel].hilights.remove(nick)
+        user = self.forget(nick)
+        if user is not None:
+            self.departed.append(user)
+        return channels
+
+    def rename (self,oldNick,newNick,prefix):
+        """moves oldNick to newNick in every channel, returns its channels"""
+        channels = self.nickchannels.pop(oldNick,set())
+        if newNick in self.nickchannels:
+            # case change
+            channels |= self.nickchannels[newNick]
+        self.nickchannels[newNick] = channels
+        for channel in channels:
+            self.channels[channel].hilights.rename(oldNick,newNick)
+        stale = self.users.get(newNick)
+        user = self.users.pop(oldNick,None)
+        if stale is not None and stale is not user:
+            # newNick was free on the network, its record is left from a departed user
+            for channel in list(stale.joins):
+                if channel in self.channels:
+                    self.untrack(self.channels[channel],newNick)
+        if user is not None:
+            account = user.account
+            self.login(user,None)
+            user.nick = newNick
+            user.prefix = prefix
+            self.users[newNick] = user
+            self.login(user,account)
+            for channel in user.joins:
+                if channel in self.channels and self.channels[channel].nicks.get(oldNick) is user:
+                    self.channels[channel].nicks[newNick] = self.channels[channel].nicks.pop(oldNick)
+        if not len(channels):
+            del self.nickchannels[newNick]
+        return channels
+
+    def part (self,channel):
+        """forgets channel and the users only seen there"""
+        if not channel in self.channels:
+            return
+        for nick in [nick for nick in self.nickchannels if channel in self.nickchannels[nick]]:
+            self.leave(channel,nick)
+        chan = self.channels.pop(channel)
+        if chan.patterns is not None:
+            chan.patterns.channels.discard(channel)
+        for nick in list(chan.nicks):
+            self.untrack(chan,nick)
+
     def restore (self,db):
         c = db.cursor()
         c.execute("""SELECT id, pattern, regexp, mini, life FROM patterns WHERE removed_at is NULL""")
@@ -209,6 +595,7 @@ class Ircd (object):
                 else:
                     regexp = False
                 self.patterns[uid] = Pattern(uid,pattern,regexp,limit,life)
+                self.matcher.add(self.patterns[uid])
         c.close()
 
     def add (self,db,prefix,pattern,limit,life,regexp):
@@ -219,21 +606,42 @@ class Ircd (object):
         c.execute("""INSERT INTO patterns VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)""", (pattern,t,limit,life,prefix,'',0,float(time.time())))
         uid = int(c.lastrowid)
         self.patterns[uid] = Pattern(uid,pattern,regexp,limit,life)
+        self.matcher.add(self.patterns[uid])
         db.commit()
         c.close()
         return uid
 
-    def count(self,db,uid):
+    def match (self,text):
+        """returns patterns which match text"""
+        return [self.patterns[uid] for uid in self.matcher.match(text) if uid in self.patterns]
+
+    def count(self,db,uid,permit=0):
         uid = int(uid)
         if uid in self.patterns:
-            c = db.cursor()
-            c.execute("""SELECT id, triggered FROM patterns WHERE id=? LIMIT 1""",(uid,))
-            items = c.fetchall()
-            if len(items):
-                (uid,triggered) = items[0]
-                triggered = int(triggered + 1)
-                c.execute("""UPDATE patterns SET triggered=? WHERE id=?""",(triggered,uid))
-                db.commit()
+            self.triggers[uid] = self.triggers.get(uid,0) + 1
+            self.triggered += 1
+            if self.triggered >= permit:
+                self.flush(db)
+
+    def flush (self,db):
+        """writes pending triggers count to database, in one transaction"""
+        if not len(self.triggers):
+            return
+        (triggers,self.triggers) = (self.triggers,{})
+        (triggered,self.triggered) = (self.triggered,0)
+        c = db.cursor()
+        try:
+            if db.isolation_level is None:
+                c.execute("""BEGIN""")
+            c.executemany("""UPDATE patterns SET triggered=triggered+? WHERE id=?""",[(triggers[uid],uid) for uid in triggers])
+            db.commit()
+        except sqlite3.Error:
+            db.rollback()
+            for uid in triggers:
+                self.triggers[uid] = self.triggers.get(uid,0) + triggers[uid]
+            self.triggered += triggered
+            raise
+        finally:
             c.close()
 
     def ls (self,db,pattern,deep=False):
@@ -258,6 +666,7 @@ class Ircd (object):
             results = []
             for item in items:
                 (uid,pattern,regexp,operator,at,triggered,removed_at,removed_by,comment,limit,life) = item
+                triggered = triggered + self.triggers.get(uid,0)
                 end = ''
                 if i:
                     if removed_by:
@@ -304,11 +713,13 @@ class Ircd (object):
             if active and removed_at:
                 c.execute("""UPDATE patterns SET removed_at=NULL, removed_by=NULL WHERE id=? LIMIT 1""",(uid,))
                 self.patterns[uid] = Pattern(uid,pattern,regexp == 1,limit,life)
+                self.matcher.add(self.patterns[uid])
                 updated = True
             elif not removed_at and not active:
                 c.execute("""UPDATE patterns SET removed_at=?, removed_by=? WHERE id=? LIMIT 1""",(float(time.time()),prefix,uid))
                 if uid in self.patterns:
                     del self.patterns[uid]
+                self.matcher.remove(uid)
                 updated = True
             db.commit()
         c.close()
@@ -323,24 +734,49 @@ class Ircd (object):
         if len(items):
             (id,pattern,regexp,limit,life,removed_at,removed_by) = items[0]
             c.execute("""DELETE FROM patterns WHERE id=? LIMIT 1""",(uid,))
+            if uid in self.triggers:
+                self.triggered -= self.triggers.pop(uid)
             if not removed_at:
                 if uid in self.patterns:
                     del self.patterns[uid]
+                self.matcher.remove(uid)
             updated = True
             db.commit()
         c.close()
         return updated
 
+class User (object):
+    __slots__ = ('nick', 'prefix', 'mask', 'gecos', 'account', 'joins')
+    def __init__(self,nick):
+        self.nick = nick
+        self.prefix = None
+        self.mask = None
+        self.gecos = ''
+        self.account = None
+        # [channel] = time.time() of join
+        self.joins = {}
+
+    def __repr__(self):
+        return '%s(nick=%r, prefix=%r, mask=%r, account=%r, joins=%r)' % (self.__class__.__name__,
+        self.nick, self.prefix, self.mask, self.account, self.joins)
+
+    def joined (self,channel):
+        """returns when the user joined channel"""
+        return self.joins.get(channel,0)
+
 class Chan (object):
-    __slots__ = ('channel', 'patterns', 'buffers', 'logs', 'nicks', 'called', 'klines', 'requestedBySpam')
+    __slots__ = ('channel', 'patterns', 'local', 'buffers', 'logs', 'nicks', 'hilights', 'called', 'klines', 'requestedBySpam')
     def __init__(self,channel):
         self.channel = channel
         self.patterns = None
+        # TmpPatterns added to this channel alone while it belongs to a shareComputedPatternID group
+        self.local = None
         self.buffers = {}
         self.logs = {}
         self.nicks = {}
+        self.hilights = NickIndex()
         self.called = False
-        self.klines = utils.structures.TimeoutQueue(1800)
+        self.klines = Window(1800)
         self.requestedBySpam = False
 
     def __repr__(self):
@@ -375,6 +811,1211 @@ class Pattern (object):
         return '%s(uid=%r, pattern=%r, limit=%r, life=%r, _match=%r)' % (self.__class__.__name__,
         self.uid, self.pattern, self.limit, self.life, self._match)
 
+class Automaton (object):
+    """Aho-Corasick automaton, returns keys of all stored strings found in a text in a single pass"""
+    __slots__ = ('words', 'goto', 'fail', 'link', 'out', 'dirty')
+    def __init__(self):
+        self.reset()
+
+    def reset (self):
+        self.words = {}
+        self.goto = [{}]
+        self.fail = [0]
+        self.link = [0]
+        self.out = [set()]
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self,key):
+        return key in self.words
+
+    def add (self,key,word):
+        if key in self.words:
+            self.remove(key)
+        self.words[key] = word
+        node = 0
+        for c in word:
+            n = self.goto[node].get(c)
+            if n is None:
+                n = len(self.goto)
+                self.goto[node][c] = n
+                self.goto.append({})
+                self.fail.append(0)
+                self.link.append(0)
+                self.out.append(set())
+                self.dirty = True
+            node = n
+        if not self.out[node]:
+            # dictionary links must be recomputed
+            self.dirty = True
+        self.out[node].add(key)
+
+    def remove (self,key):
+        # nodes are kept, only the output is dropped, dictionary links stay valid
+        word = self.words.pop(key,None)
+        if word is None:
+            return
+        node = 0
+        for c in word:
+            node = self.goto[node][c]
+        self.out[node].discard(key)
+        if not len(self.words):
+            self.reset()
+
+    def build (self):
+        goto = self.goto
+        fail = self.fail
+        link = self.link
+        out = self.out
+        queue = []
+        for n in goto[0].values():
+            fail[n] = 0
+            link[n] = 0
+            queue.append(n)
+        index = 0
+        while index < len(queue):
+            node = queue[index]
+            index += 1
+            for (c,n) in goto[node].items():
+                f = fail[node]
+                while f and c not in goto[f]:
+                    f = fail[f]
+                f = goto[f].get(c,0)
+                if f == n:
+                    f = 0
+                fail[n] = f
+                if out[f]:
+                    link[n] = f
+                else:
+                    link[n] = link[f]
+                queue.append(n)
+        self.dirty = False
+
+    def search (self,text):
+        if self.dirty:
+            self.build()
+        goto = self.goto
+        fail = self.fail
+        link = self.link
+        out = self.out
+        found = set(out[0])
+        node = 0
+        for c in text:
+            while node and c not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(c,0)
+            n = node if out[node] else link[node]
+            while n:
+                found.update(out[n])
+                n = link[n]
+        return found
+
+class Matcher (object):
+    """compiled set of permanent patterns: an automaton for case insensitive strings,
+    and a combined regexp used to prefilter regexp patterns"""
+    __slots__ = ('automaton', 'regexps', 'combined', 'dirty')
+    def __init__(self):
+        self.automaton = Automaton()
+        self.regexps = {}
+        self.combined = None
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.automaton) + len(self.regexps)
+
+    def add (self,pattern):
+        self.remove(pattern.uid)
+        if pattern._match:
+            self.regexps[pattern.uid] = pattern._match
+            self.dirty = True
+        else:
+            self.automaton.add(pattern.uid,pattern.pattern)
+
+    def remove (self,uid):
+        if uid in self.regexps:
+            del self.regexps[uid]
+            self.dirty = True
+        self.automaton.remove(uid)
+
+    def build (self):
+        # patterns with backreferences, named groups or unsupported flags can't be merged
+        # without changing their meaning, they are always tried one by one
+        scoped = re.IGNORECASE | re.MULTILINE | re.DOTALL | re.VERBOSE
+        parts = []
+        for uid in self.regexps:
+            r = self.regexps[uid]
+            if r.flags & ~(scoped | re.UNICODE) or re.search(r'\\[1-9]|\\g<|\(\?P[<=]|\(\?\(',r.pattern):
+                parts = None
+                break
+            flags = ''.join([f for (f,v) in (('i',re.I),('m',re.M),('s',re.S),('x',re.X)) if r.flags & v])
+            # a verbose pattern may end with a comment
+            end = '\n' if r.flags & re.VERBOSE else ''
+            part = '(?%s:%s%s)' % (flags,r.pattern,end)
+            try:
+                re.compile(part)
+            except re.error:
+                parts = None
+                break
+            parts.append(part)
+        self.combined = None
+        if parts:
+            try:
+                self.combined = re.compile('|'.join(parts))
+            except re.error:
+                self.combined = None
+        self.dirty = False
+
+    def match (self,text):
+        """returns sorted uids of patterns matching text"""
+        if isinstance(text,bytes):
+            text = str(text, "utf-8")
+        found = self.automaton.search(text.lower())
+        if len(self.regexps):
+            if self.dirty:
+                self.build()
+            if not self.combined or self.combined.search(text) != None:
+                for uid in self.regexps:
+                    if self.regexps[uid].search(text) != None:
+                        found.add(uid)
+        return sorted(found)
+
+class TmpPatterns (object):
+    """temporary patterns added during the last timeout seconds, adding one again extends its life,
+    an automaton finds those contained in a text in a single pass"""
+    __slots__ = ('timeout', 'stamps', 'queue', 'automaton', 'removed', 'channels')
+    def __init__(self,timeout):
+        self.timeout = timeout
+        # channels of the shareComputedPatternID group using it, empty when owned by a single channel
+        self.channels = set()
+        self.reset()
+
+    def __repr__(self):
+        return '%s(timeout=%r, patterns=%r)' % (self.__class__.__name__,
+        self.timeout, list(self))
+
+    def reset (self):
+        # [pattern] = time.time() of last add, oldest first
+        self.stamps = {}
+        # (time,pattern) in adding order
+        self.queue = collections.deque()
+        self.automaton = Automaton()
+        self.removed = 0
+
+    def setTimeout (self,timeout):
+        self.timeout = timeout
+
+    def expire (self):
+        limit = time.time() - self.timeout
+        queue = self.queue
+        while len(queue) and queue[0][0] < limit:
+            (at,pattern) = queue.popleft()
+            if self.stamps.get(pattern) == at:
+                del self.stamps[pattern]
+                self.automaton.remove(pattern)
+                self.removed += 1
+        # automaton nodes are never reclaimed
+        if self.removed > 64 and self.removed > len(self.stamps):
+            self.automaton = Automaton()
+            for pattern in self.stamps:
+                self.automaton.add(pattern,pattern)
+            self.removed = 0
+
+    def enqueue (self,pattern,at=None):
+        if at is None:
+            at = time.time()
+        if pattern in self.stamps:
+            del self.stamps[pattern]
+        else:
+            self.automaton.add(pattern,pattern)
+        self.stamps[pattern] = at
+        self.queue.append((at,pattern))
+
+    def search (self,text,life=None):
+        """returns the oldest pattern contained in text and added during the last life seconds, None otherwise"""
+        self.expire()
+        if not len(self.stamps):
+            return None
+        found = self.automaton.search(text)
+        if life is not None and life < self.timeout:
+            limit = time.time() - life
+            found = [pattern for pattern in found if self.stamps[pattern] >= limit]
+        if not len(found):
+            return None
+        return min(found,key=self.stamps.get)
+
+    def alive (self,life=None):
+        """returns patterns added during the last life seconds, oldest first"""
+        self.expire()
+        if life is None or life >= self.timeout:
+            return list(self.stamps)
+        limit = time.time() - life
+        return [pattern for pattern in self.stamps if self.stamps[pattern] >= limit]
+
+    def __len__(self):
+        self.expire()
+        return len(self.stamps)
+
+    def __iter__(self):
+        self.expire()
+        return iter(list(self.stamps))
+
+nickSplit = re.compile(r'[^a-z0-9\[\]\\`_^{|}-]+')
+
+class NickIndex (object):
+    """lowercased nicks of a channel, counts how many of them are mentioned in a text"""
+    __slots__ = ('nicks', 'automaton', 'removed')
+    def __init__(self,nicks=()):
+        self.reset(nicks)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def __contains__(self,nick):
+        return nick.lower() in self.nicks
+
+    def __repr__(self):
+        return '%s(nicks=%r)' % (self.__class__.__name__, len(self.nicks))
+
+    def reset (self,nicks=()):
+        self.nicks = set()
+        self.automaton = Automaton()
+        self.removed = 0
+        for nick in nicks:
+            self.add(nick)
+
+    def add (self,nick):
+        n = nick.lower()
+        if len(n) < 4 or n == 'chanserv' or n in self.nicks:
+            return
+        self.nicks.add(n)
+        self.automaton.add(n,n)
+
+    def remove (self,nick):
+        n = nick.lower()
+        if not n in self.nicks:
+            return
+        self.nicks.discard(n)
+        self.automaton.remove(n)
+        self.removed += 1
+        # automaton nodes are never reclaimed
+        if self.removed > 64 and self.removed > len(self.nicks):
+            self.reset(list(self.nicks))
+
+    def rename (self,oldNick,newNick):
+        self.remove(oldNick)
+        self.add(newNick)
+
+    def count (self,text,nick,limit,words=None):
+        """returns how many nicks, except nick, are found in lowercased text, stops once limit is exceeded,
+        words of text split by nickSplit may be given"""
+        exclude = nick.lower()
+        if words is None:
+            words = nickSplit.split(text)
+        found = self.nicks.intersection(words)
+        found.discard(exclude)
+        if len(found) > limit:
+            return len(found)
+        # nicks glued to others chars
+        found = self.automaton.search(text)
+        found.discard(exclude)
+        return len(found)
+
+class Window (object):
+    """values enqueued during the last timeout seconds, a compact TimeoutQueue:
+    timestamps are packed into an array, values are only stored once they differ"""
+    __slots__ = ('timeout', 'stamps', 'values', 'value', 'head')
+    def __init__(self,timeout):
+        self.timeout = timeout
+        self.stamps = array.array('d')
+        # None while every value equals self.value
+        self.values = None
+        self.value = None
+        self.head = 0
+
+    def __repr__(self):
+        return '%s(timeout=%r, values=%r)' % (self.__class__.__name__,
+        self.timeout, list(self))
+
+    def expire (self):
+        stamps = self.stamps
+        head = self.head
+        if head == len(stamps):
+            return
+        limit = time.time() - self.timeout
+        if stamps[head] < limit:
+            head = bisect.bisect_left(stamps,limit,head)
+            if head == len(stamps):
+                self.reset()
+                return
+            if head > 32 and head * 2 > len(stamps):
+                del stamps[:head]
+                if self.values is not None:
+                    del self.values[:head]
+                head = 0
+            self.head = head
+
+    def setTimeout (self,timeout):
+        self.timeout = timeout
+
+    def reset (self):
+        self.stamps = array.array('d')
+        self.values = None
+        self.value = None
+        self.head = 0
+
+    def enqueue (self,value,at=None):
+        if at is None:
+            at = time.time()
+        if self.head == len(self.stamps):
+            self.reset()
+            self.value = value
+        elif self.values is None and value != self.value:
+            self.values = [self.value] * len(self.stamps)
+        if self.values is not None:
+            self.values.append(value)
+        self.stamps.append(at)
+
+    def dequeue (self):
+        self.expire()
+        if self.head == len(self.stamps):
+            raise IndexError('dequeue from empty Window')
+        value = self[0]
+        self.head += 1
+        return value
+
+    def __len__(self):
+        self.expire()
+        return len(self.stamps) - self.head
+
+    def stored (self):
+        """returns number of values kept, expired ones included until next expire, leaves the Window untouched"""
+        return max(0,len(self.stamps) - self.head)
+
+    def __getitem__(self,index):
+        if index < 0 or self.head + index >= len(self.stamps):
+            raise IndexError('Window index out of range')
+        if self.values is None:
+            return self.value
+        return self.values[self.head + index]
+
+    def __setitem__(self,index,value):
+        if index < 0 or self.head + index >= len(self.stamps):
+            raise IndexError('Window index out of range')
+        if self.values is None:
+            if value == self.value:
+                return
+            self.values = [self.value] * len(self.stamps)
+        self.values[self.head + index] = value
+
+    def __iter__(self):
+        self.expire()
+        if self.values is None:
+            return iter([self.value] * (len(self.stamps) - self.head))
+        return iter(self.values[self.head:])
+
+    def expiry (self):
+        """returns time when the last value expires"""
+        if self.head == len(self.stamps):
+            return time.time()
+        return self.stamps[-1] + self.timeout
+
+class ExpiringSet (object):
+    """keys added during the last timeout seconds, adding a key again extends its life"""
+    __slots__ = ('timeout', 'keys')
+    def __init__(self,timeout):
+        self.timeout = timeout
+        # [key] = time.time() of last add
+        self.keys = {}
+
+    def __repr__(self):
+        return '%s(timeout=%r, keys=%r)' % (self.__class__.__name__,
+        self.timeout, list(self))
+
+    def expire (self):
+        limit = time.time() - self.timeout
+        for key in [key for key in self.keys if self.keys[key] < limit]:
+            del self.keys[key]
+
+    def add (self,key,at=None):
+        if at is None:
+            at = time.time()
+        self.keys[key] = at
+
+    def discard (self,key):
+        self.keys.pop(key,None)
+
+    def __contains__(self,key):
+        if not key in self.keys:
+            return False
+        if self.keys[key] < time.time() - self.timeout:
+            del self.keys[key]
+            return False
+        return True
+
+    def __len__(self):
+        self.expire()
+        return len(self.keys)
+
+    def __iter__(self):
+        self.expire()
+        return iter(list(self.keys))
+
+class SimilarIndex (object):
+    """lines added during the last timeout seconds, with a bitmap of lines per character,
+    finds lines more than percent similar to a text without comparing it to each line"""
+    __slots__ = ('timeout', 'lines', 'chars', 'sizes', 'base', 'seq')
+    def __init__(self,timeout):
+        self.timeout = timeout
+        # (seq,text,fp), seq - base is the bit of the line in bitmaps
+        self.lines = Window(timeout)
+        # [character] = bitmap of lines using it
+        self.chars = {}
+        # [number of characters] = bitmap of lines
+        self.sizes = {}
+        self.base = 0
+        self.seq = 0
+
+    def __repr__(self):
+        return '%s(timeout=%r, lines=%r, chars=%r)' % (self.__class__.__name__,
+        self.timeout, len(self.lines), len(self.chars))
+
+    def setTimeout (self,timeout):
+        self.timeout = timeout
+        self.lines.setTimeout(timeout)
+
+    def reset (self):
+        self.lines.reset()
+        self.chars = {}
+        self.sizes = {}
+        self.base = self.seq
+
+    def first (self):
+        """returns bit of the oldest line, None if empty"""
+        if not len(self.lines):
+            return None
+        return self.lines[0][0] - self.base
+
+    def add (self,text,fp=None):
+        if fp is None:
+            fp = fingerprint(text)
+        first = self.first()
+        if first is None:
+            self.reset()
+        elif first > 1024 and first * 2 > self.seq - self.base:
+            # drops bits of expired lines
+            for bitmaps in (self.chars,self.sizes):
+                for key in list(bitmaps):
+                    bitmaps[key] >>= first
+                    if not bitmaps[key]:
+                        del bitmaps[key]
+            self.base += first
+        bit = 1 << (self.seq - self.base)
+        self.lines.enqueue((self.seq,text,fp))
+        self.seq += 1
+        chars = fp
+        for c in chars:
+            self.chars[c] = self.chars.get(c,0) | bit
+        self.sizes[len(chars)] = self.sizes.get(len(chars),0) | bit
+
+    def similar (self,text,percent,fp=None):
+        """returns the oldest line more than percent similar to text, None otherwise"""
+        if percent >= 1:
+            # compareString is at most 1
+            return None
+        first = self.first()
+        if first is None:
+            return None
+        if fp is None:
+            fp = fingerprint(text)
+        chars = fp
+        # characters in common with text for each line, bitmaps of binary digits
+        digits = []
+        for c in chars:
+            carry = self.chars.get(c,0)
+            for n in range(len(digits)):
+                if not carry:
+                    break
+                (digits[n],carry) = (digits[n] ^ carry,digits[n] & carry)
+            if carry:
+                digits.append(carry)
+        alive = ((1 << (self.seq - self.base)) - 1) ^ ((1 << first) - 1)
+        def atLeast (need):
+            greater = 0
+            equal = alive
+            for n in range(max(len(digits),need.bit_length()) - 1,-1,-1):
+                digit = digits[n] if n < len(digits) else 0
+                if need >> n & 1:
+                    equal &= digit
+                else:
+                    greater |= equal & digit
+                    equal &= ~digit
+            return greater | equal
+        # lines of size n are more than percent similar
+        # with more than percent * (len(chars) + n) / (1 + percent) characters in common
+        candidates = 0
+        sizes = similarSizes(len(chars),percent,max(self.sizes,default=0))
+        for n in self.sizes:
+            if n in sizes or n == len(chars):
+                candidates |= atLeast(int(percent * (len(chars) + n) / (1 + percent))) & self.sizes[n]
+        while candidates:
+            low = candidates & -candidates
+            (seq,m,fm) = self.lines[low.bit_length() - 1 - first]
+            if compareString(m,text,fm,fp) > percent:
+                return m
+            candidates ^= low
+        return None
+
+    def __len__(self):
+        size = len(self.lines)
+        if not size:
+            self.chars = {}
+            self.sizes = {}
+        return size
+
+    def __iter__(self):
+        for (seq,text,fp) in self.lines:
+            yield (text,fp)
+
+    def expiry (self):
+        """returns time when the last line expires"""
+        return self.lines.expiry()
+
+class TimerWheel (object):
+    """hierarchical timer wheel of 64 slots per level, one tick per second on the first level,
+    advance() returns items whose time is reached, cost is proportional to items returned"""
+    __slots__ = ('tick', 'levels', 'due', 'size')
+    bits = 6
+    def __init__(self,levels=4,now=None):
+        if now is None:
+            now = time.time()
+        self.tick = int(now)
+        self.levels = [[[] for n in range(1 << self.bits)] for l in range(levels)]
+        self.due = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return '%s(tick=%r, size=%r)' % (self.__class__.__name__, self.tick, self.size)
+
+    def add (self,at,item):
+        self.size += 1
+        self.insert(int(at),item)
+
+    def insert (self,t,item):
+        bits = self.bits
+        if t <= self.tick:
+            self.due.append(item)
+            return
+        for (n,slots) in enumerate(self.levels):
+            shift = bits * n
+            block = t >> shift
+            if block - (self.tick >> shift) < len(slots) or n == len(self.levels) - 1:
+                if block - (self.tick >> shift) >= len(slots):
+                    # beyond the wheel, placed in the farthest slot and inserted again once reached
+                    block = (self.tick >> shift) + len(slots) - 1
+                slots[block & (len(slots) - 1)].append((t,item))
+                return
+
+    def advance (self,now=None):
+        """returns items due at now"""
+        if now is None:
+            now = time.time()
+        target = int(now)
+        bits = self.bits
+        mask = (1 << bits) - 1
+        levels = self.levels
+        while self.tick < target:
+            self.tick += 1
+            tick = self.tick
+            # items of upper levels move down once their slot is reached
+            for n in range(len(levels) - 1,0,-1):
+                if tick & ((1 << (bits * n)) - 1) == 0:
+                    slot = levels[n][(tick >> (bits * n)) & mask]
+                    if len(slot):
+                        levels[n][(tick >> (bits * n)) & mask] = []
+                        for (t,item) in slot:
+                            self.insert(t,item)
+            slot = levels[0][tick & mask]
+            if len(slot):
+                levels[0][tick & mask] = []
+                for (t,item) in slot:
+                    self.insert(t,item)
+        due = self.due
+        self.due = []
+        self.size -= len(due)
+        return due
+
+class Histogram (object):
+    """rolling histogram of durations, power of two buckets in microseconds, keeps current and previous window"""
+    __slots__ = ('life', 'stamp', 'current', 'previous')
+    def __init__(self,life):
+        self.life = life
+        self.stamp = time.time()
+        self.current = [0] * 32
+        self.previous = [0] * 32
+
+    def __len__(self):
+        self.rotate()
+        return sum(self.current) + sum(self.previous)
+
+    def __repr__(self):
+        return '%s(life=%r, samples=%r)' % (self.__class__.__name__, self.life, len(self))
+
+    def rotate (self):
+        now = time.time()
+        if now - self.stamp > self.life:
+            if now - self.stamp > 2 * self.life:
+                self.previous = [0] * 32
+            else:
+                self.previous = self.current
+            self.current = [0] * 32
+            self.stamp = now
+
+    def add (self,duration):
+        self.rotate()
+        self.current[min(int(duration * 1000000).bit_length(),31)] += 1
+
+    def percentile (self,p):
+        """returns upper bound in seconds of the bucket holding the p percentile"""
+        self.rotate()
+        buckets = [a + b for (a,b) in zip(self.current,self.previous)]
+        total = sum(buckets)
+        if not total:
+            return 0
+        count = 0
+        for (n,v) in enumerate(buckets):
+            count += v
+            if count >= total * p:
+                return (1 << n) / 1000000.0
+        return (1 << 31) / 1000000.0
+
+class Timer (object):
+    """times consecutive stages of a message"""
+    __slots__ = ('timings', 'life', 'mark')
+    def __init__(self,timings,life):
+        self.timings = timings
+        self.life = life
+        self.mark = time.perf_counter()
+
+    def reset (self):
+        self.mark = time.perf_counter()
+
+    def lap (self,kind):
+        now = time.perf_counter()
+        if not kind in self.timings:
+            self.timings[kind] = Histogram(self.life)
+        h = self.timings[kind]
+        h.life = self.life
+        h.add(now - self.mark)
+        self.mark = now
+
+class Cache (object):
+    """bounded LRU cache, each entry has its own life"""
+    __slots__ = ('items', 'size', 'lock', 'hits', 'misses', 'evictions', 'expirations')
+    def __init__(self,size):
+        self.items = collections.OrderedDict()
+        self.size = size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return '%s(size=%r, items=%r, hits=%r, misses=%r, evictions=%r, expirations=%r)' % (self.__class__.__name__,
+        self.size, len(self.items), self.hits, self.misses, self.evictions, self.expirations)
+
+    def get (self,key,default=None):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            (value,expire) = item
+            if expire < time.time():
+                del self.items[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set (self,key,value,life):
+        with self.lock:
+            self.items[key] = (value,time.time()+life)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def resize (self,size):
+        with self.lock:
+            self.size = size
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def clear (self):
+        with self.lock:
+            self.items.clear()
+
+class Resolver (object):
+    """pool of threads doing AAAA and A lookups, identical requests are coalesced
+    and negative answers are cached for a while"""
+    __slots__ = ('queue', 'lock', 'pending', 'negatives', 'timeout', 'negativeLife', 'nameservers', 'port', 'threads', 'stopped')
+    def __init__(self,threads,size,timeout,negativeLife,nameservers=None,port=53):
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        # host : ([callbacks], {rdtype: answers})
+        self.pending = {}
+        # host : expiry
+        self.negatives = {}
+        self.timeout = timeout
+        self.negativeLife = negativeLife
+        self.nameservers = nameservers
+        self.port = port
+        self.stopped = False
+        self.threads = []
+        for n in range(threads):
+            t = world.SupyThread(target=self.work,name=format('Sigyn resolver %s', n))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def __repr__(self):
+        return '%s(threads=%r, queue=%r, pending=%r, negatives=%r)' % (self.__class__.__name__,
+        len(self.threads), self.queue.qsize(), len(self.pending), len(self.negatives))
+
+    def resolve (self,host,callback):
+        """calls callback(host,ips) once AAAA and A records of host are known,
+        returns False if the queue is full"""
+        with self.lock:
+            now = time.time()
+            if len(self.negatives) > self.queue.maxsize:
+                for h in list(self.negatives.keys()):
+                    if self.negatives[h] < now:
+                        del self.negatives[h]
+            negative = host in self.negatives and self.negatives[host] > now
+            if not negative:
+                if host in self.pending:
+                    self.pending[host][0].append(callback)
+                    return True
+                # only producers hold the lock, so free room can't shrink here
+                if self.stopped or self.queue.maxsize - self.queue.qsize() < 2:
+                    return False
+                self.pending[host] = ([callback],{})
+                self.queue.put_nowait((host,'AAAA'))
+                self.queue.put_nowait((host,'A'))
+                return True
+        callback(host,[])
+        return True
+
+    def lookup (self,resolver,host,rdtype):
+        """returns records as strings, an empty list if there is none, None on failure"""
+        try:
+            return [str(ip) for ip in resolver.query(host,rdtype)]
+        except (dns.resolver.NXDOMAIN,dns.resolver.NoAnswer):
+            return []
+        except Exception:
+            return None
+
+    def work (self):
+        resolver = dns.resolver.Resolver()
+        resolver.timeout = self.timeout
+        resolver.lifetime = self.timeout
+        if self.nameservers:
+            resolver.nameservers = self.nameservers
+            resolver.port = self.port
+        while not self.stopped:
+            job = self.queue.get()
+            if job is None:
+                break
+            (host,rdtype) = job
+            answers = self.lookup(resolver,host,rdtype)
+            with self.lock:
+                (callbacks,results) = self.pending[host]
+                results[rdtype] = answers
+                if len(results) < 2:
+                    continue
+                del self.pending[host]
+                L = []
+                for rdtype in ('AAAA','A'):
+                    if results[rdtype]:
+                        for ip in results[rdtype]:
+                            if not ip in L:
+                                L.append(ip)
+                if results['AAAA'] == [] and results['A'] == []:
+                    self.negatives[host] = time.time() + self.negativeLife
+            for callback in callbacks:
+                try:
+                    callback(host,L)
+                except Exception:
+                    log.exception('Sigyn resolver callback failed for %s' % host)
+
+    def stop (self):
+        self.stopped = True
+        for t in self.threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+
+# dronebl's types, by comment
+droneblTypes = {
+    'Bottler': 5,
+    'Unknown spambot or drone': 6,
+    'DDOS Drone': 7,
+    'SOCKS Proxy': 8,
+    'HTTP Proxy': 9,
+    'ProxyChain': 10,
+    'Web Page Proxy': 11,
+    'Open DNS Resolver': 12,
+    'Brute force attackers': 13,
+    'Open Wingate Proxy': 14,
+    'Compromised router / gateway': 15,
+    'Autorooting worms': 16,
+    'Automatically determined botnet IPs (experimental)': 17,
+    'DNS/MX type hostname detected on IRC': 18,
+    'Abused VPN Service': 19
+}
+
+class DroneblJob (object):
+    """ip to list or remove, done once its callback was called"""
+    __slots__ = ('kind', 'host', 'key', 'ip', 'comment', 'callback', 'done')
+    def __init__(self,kind,host,key,ip,comment,callback):
+        self.kind = kind
+        self.host = host
+        self.key = key
+        self.ip = ip
+        self.comment = comment
+        self.callback = callback
+        self.done = False
+
+    def __repr__(self):
+        return '%s(kind=%r, ip=%r, done=%r)' % (self.__class__.__name__,
+        self.kind, self.ip, self.done)
+
+class Dronebl (object):
+    """single worker doing dronebl rpc calls with a persistent session, lookups and adds
+    are batched into one request, ips recently submitted are ignored"""
+    __slots__ = ('queue', 'session', 'lock', 'submitted', 'life', 'batch', 'linger', 'retries', 'backoff', 'timeout', 'thread', 'stopped')
+    headers = {
+        'Content-Type' : 'text/xml'
+    }
+    def __init__(self,batch,life,retries=3,backoff=1,linger=0.5,timeout=9):
+        self.queue = queue.Queue()
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        # ip : expiry
+        self.submitted = {}
+        self.life = life
+        self.batch = batch
+        self.linger = linger
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.stopped = False
+        self.thread = world.SupyThread(target=self.work,name='Sigyn dronebl')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __repr__(self):
+        return '%s(queue=%r, submitted=%r)' % (self.__class__.__name__,
+        self.queue.qsize(), len(self.submitted))
+
+    def add (self,host,key,ip,comment,callback):
+        """queues ip for listing, callback(ip,status,detail) is called once done,
+        returns False if ip was already submitted recently"""
+        with self.lock:
+            now = time.time()
+            if ip in self.submitted and self.submitted[ip] > now:
+                return False
+            if len(self.submitted) > 4096:
+                for k in list(self.submitted.keys()):
+                    if self.submitted[k] < now:
+                        del self.submitted[k]
+            self.submitted[ip] = now + self.life
+        self.queue.put(DroneblJob('add',host,key,ip,comment,callback))
+        return True
+
+    def forget (self,ip):
+        """allows ip to be submitted again"""
+        with self.lock:
+            if ip in self.submitted:
+                del self.submitted[ip]
+
+    def remove (self,host,key,ip,callback):
+        """queues ip for removal, callback(ip,status,detail) is called for each listing"""
+        self.forget(ip)
+        self.queue.put(DroneblJob('remove',host,key,ip,None,callback))
+
+    def post (self,host,key,elements):
+        """sends elements in one request, retries with backoff on network and server errors"""
+        data = "<?xml version=\"1.0\"?><request key='"+key+"'>"+''.join(elements)+"</request>"
+        delay = self.backoff
+        attempt = 0
+        while True:
+            try:
+                r = self.session.post(host,data=data,headers=self.headers,timeout=self.timeout)
+                if r.status_code < 500 or attempt >= self.retries:
+                    return r
+            except requests.exceptions.RequestException:
+                if attempt >= self.retries:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+            delay = delay * 2
+
+    def results (self,answer):
+        """returns attributes of each result element, by ip"""
+        results = {}
+        for result in re.findall(r'<result\s([^>]*)>',answer):
+            attributes = dict(re.findall(r'(\w+)="([^"]*)"',result))
+            if 'ip' in attributes:
+                results.setdefault(attributes['ip'],[]).append(attributes)
+        return results
+
+    def lookup (self,host,key,ips):
+        r = self.post(host,key,["<lookup ip='"+ip+"' />" for ip in ips])
+        if r.status_code != 200:
+            raise requests.exceptions.HTTPError('%s %s' % (r.status_code,r.reason))
+        return self.results(r.text)
+
+    def work (self):
+        while not self.stopped:
+            jobs = [self.queue.get()]
+            deadline = time.time() + self.linger
+            while jobs[-1] is not None and len(jobs) < self.batch:
+                try:
+                    jobs.append(self.queue.get(timeout=max(0,deadline-time.time())))
+                except queue.Empty:
+                    break
+            if jobs[-1] is None:
+                self.stopped = True
+                jobs.pop()
+            groups = {}
+            for job in jobs:
+                groups.setdefault((job.kind,job.host,job.key),[]).append(job)
+            for (kind,host,key) in groups:
+                try:
+                    if kind == 'add':
+                        self.doAdd(host,key,groups[(kind,host,key)])
+                    else:
+                        self.doRemove(host,key,groups[(kind,host,key)])
+                except Exception as e:
+                    for job in groups[(kind,host,key)]:
+                        if job.done:
+                            continue
+                        if kind == 'add':
+                            self.forget(job.ip)
+                        self.call(job,'error',e)
+
+    def call (self,job,status,detail):
+        job.done = True
+        try:
+            job.callback(job.ip,status,detail)
+        except Exception:
+            log.exception('Sigyn dronebl callback failed for %s' % job.ip)
+
+    def doAdd (self,host,key,jobs):
+        results = self.lookup(host,key,[job.ip for job in jobs])
+        elements = []
+        pending = []
+        for job in jobs:
+            ip = job.ip
+            if len([result for result in results.get(ip,[]) if result.get('listed') == '1']):
+                self.call(job,'listed',None)
+                continue
+            elements.append("<add ip='"+ip+"' type='"+str(droneblTypes.get(job.comment,3))+"' comment='used by irc spam bot' />")
+            pending.append(job)
+        if len(elements):
+            r = self.post(host,key,elements)
+            for job in pending:
+                if r.status_code != 200:
+                    self.forget(job.ip)
+                    self.call(job,'error','add returned %s %s' % (r.status_code,r.reason))
+                else:
+                    self.call(job,'added',droneblTypes.get(job.comment,3))
+
+    def doRemove (self,host,key,jobs):
+        results = self.lookup(host,key,[job.ip for job in jobs])
+        for job in jobs:
+            found = False
+            for result in results.get(job.ip,[]):
+                if result.get('listed') != '1' or not 'id' in result:
+                    continue
+                incident = result['id']
+                if result.get('type') == '18':
+                    self.call(job,'type18',incident)
+                    continue
+                found = True
+                try:
+                    r = self.post(host,key,["<remove id='"+incident+"' />"])
+                    if "You are not authorized to remove this incident" in r.text:
+                        self.call(job,'unauthorized',incident)
+                    else:
+                        self.call(job,'removed',incident)
+                except requests.exceptions.RequestException:
+                    self.call(job,'failed',incident)
+            if not found:
+                self.call(job,'notlisted',None)
+
+    def stop (self):
+        self.queue.put(None)
+
+class Metrics (object):
+    """counters, rendered with gauges in prometheus text format"""
+    __slots__ = ('lock', 'counters')
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, ((label,value),...)) : count
+        self.counters = {}
+
+    def __repr__(self):
+        return '%s(counters=%r)' % (self.__class__.__name__, len(self.counters))
+
+    def inc (self,name,labels=(),value=1):
+        key = (name,labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key,0) + value
+
+    def get (self,name,labels=()):
+        return self.counters.get((name,labels),0)
+
+    def render (self,gauges=()):
+        """returns counters and gauges, a list of (name,labels,value), as text"""
+        with self.lock:
+            counters = list(self.counters.items())
+        lines = []
+        types = {}
+        for (kind,items) in (('counter',counters),('gauge',[((name,labels),value) for (name,labels,value) in gauges])):
+            for ((name,labels),value) in sorted(items):
+                if not name in types:
+                    types[name] = kind
+                    lines.append('# TYPE %s %s' % (name,kind))
+                if len(labels):
+                    labels = ','.join(['%s="%s"' % (k,str(v).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')) for (k,v) in labels])
+                    lines.append('%s{%s} %s' % (name,labels,value))
+                else:
+                    lines.append('%s %s' % (name,value))
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler (http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self,*args):
+        pass
+
+class Exporter (object):
+    """serves render() on a local http endpoint, and/or writes it periodically into path"""
+    __slots__ = ('render', 'server', 'path', 'interval', 'event', 'threads')
+    def __init__(self,render,host,port,path,interval):
+        self.render = render
+        self.server = None
+        self.path = path
+        self.interval = interval
+        self.event = threading.Event()
+        self.threads = []
+        if port:
+            self.server = http.server.HTTPServer((host,port),MetricsHandler)
+            self.server.render = render
+            self.start(self.server.serve_forever,'Sigyn metrics server')
+        if path:
+            self.start(self.work,'Sigyn metrics file')
+
+    def __repr__(self):
+        return '%s(server=%r, path=%r)' % (self.__class__.__name__, self.server and self.server.server_address, self.path)
+
+    def start (self,target,name):
+        t = world.SupyThread(target=target,name=name)
+        t.setDaemon(True)
+        t.start()
+        self.threads.append(t)
+
+    def write (self):
+        try:
+            with open('%s.tmp' % self.path,'w') as f:
+                f.write(self.render())
+            os.replace('%s.tmp' % self.path,self.path)
+        except Exception as e:
+            log.error('Sigyn unable to write metrics into %s: %s' % (self.path,e))
+
+    def work (self):
+        while not self.event.wait(self.interval):
+            self.write()
+
+    def stop (self):
+        self.event.set()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+# detectors which may be disabled with #channel,-detector capability
+detectors = ('pattern', 'badunicode', 'hilight', 'lowHilight', 'massRepeat', 'lowMassRepeat', 'repeat', 'lowRepeat', 'flood', 'lowFlood', 'ctcp', 'notice', 'cap')
+
+# bits of capabilities resolved for a prefix in a channel
+capabilityBits = {'protected': 1, 'channelProtected': 2}
+capabilityBits.update([(detector,4 << n) for (n,detector) in enumerate(detectors)])
+
+class Settings (object):
+    """frozen snapshot of plugin's values for a channel"""
+    __slots__ = ('channel', 'values')
+    def __init__(self,channel,values):
+        self.channel = channel
+        self.values = values
+
+    def __getitem__(self,name):
+        return self.values[name]
+
+    def __repr__(self):
+        return '%s(channel=%r, values=%r)' % (self.__class__.__name__,
+        self.channel, self.values)
+
+capitals = re.compile("[A-Z]")
+
+class MessageContext (object):
+    """text of a message prepared once for every detector and channel"""
+    __slots__ = ('raw', 'text', 'ascii', 'letters', 'caps', 'spam', 'fingerprint', 'words', 'url')
+    def __init__(self,raw,text=None,spamchars=()):
+        # without formatting
+        self.raw = raw
+        # lowercased unless given
+        if text is None:
+            text = raw.lower()
+        self.text = text
+        self.ascii = text.isascii()
+        # characters except spaces and percent of ascii capitals among them
+        self.letters = len(raw) - raw.count(' ')
+        self.caps = 0
+        if self.letters:
+            self.caps = (len(capitals.findall(raw))*100) / (self.letters * 1.0)
+        # spamchars aren't ascii
+        self.spam = 0
+        if not self.ascii:
+            self.spam = sum(map(spamchars.__contains__,text))
+        self.fingerprint = fingerprint(text)
+        # candidates nicks
+        self.words = frozenset(nickSplit.split(text))
+        self.url = 'http' in text
+
+    def __repr__(self):
+        return '%s(raw=%r, caps=%r, spam=%r, url=%r)' % (self.__class__.__name__,
+        self.raw, self.caps, self.spam, self.url)
+
 class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     """Network and Channels Spam protections"""
     threaded = True
@@ -384,122 +2025,171 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         callbacks.Plugin.__init__(self, irc)
         plugins.ChannelDBHandler.__init__(self)
         self._ircs = ircutils.IrcDict()
-        self.cache = {}
+        # prefix to mask
+        self.cache = Cache(self.registryValue('maskCacheSize'))
+        # (value,callback) added to registry, removed on die
+        self.watched = []
+        # channel : Settings, rebuilt once values changed
+        self.settings = {}
+        self.settingsValues = set()
+        group = conf.supybot.plugins.get(self.name())
+        for name in group._added:
+            if name != 'lastActionTaken':
+                self.watchValue(group.get(name))
+        # (prefix,channel) : bitmask of capabilityBits
+        self.capabilities = Cache(self.registryValue('capabilityCacheSize'))
+        self.capabilitiesChecked = 0
+        self.capabilitiesStamp = None
+        self.watch(conf.supybot.capabilities,self.capabilities.clear)
+        self.watch(conf.supybot.capabilities.default,self.capabilities.clear)
+        self.dronebl = Dronebl(self.registryValue('droneblBatch'),self.registryValue('droneblLife'),self.registryValue('droneblRetries'))
+        self.resolver = Resolver(self.registryValue('resolverThreads'),self.registryValue('resolverQueue'),self.registryValue('resolverTimeout'),self.registryValue('resolverNegativeLife'))
+        self.metrics = Metrics()
+        self.exporter = None
+        if self.registryValue('metricsPort') or len(self.registryValue('metricsFile')):
+            try:
+                self.exporter = Exporter(self.renderMetrics,self.registryValue('metricsHost'),self.registryValue('metricsPort'),self.registryValue('metricsFile'),self.registryValue('metricsInterval'))
+            except OSError as e:
+                self.log.error('unable to export metrics: %s' % e)
         self.getIrc(irc)
         self.starting = world.starting
-        self.recaps = re.compile("[A-Z]")
         self.ipfiltered = {}
         self.rmrequestors = {}
+        schedule.addPeriodicEvent(self.flushCounts,self.registryValue('patternCountInterval'),'SigynPatternCount',now=False)
         self.spamchars = {'Ḕ', 'Î', 'Ù', 'Ṋ', 'ℰ', 'Ừ', 'ś', 'ï', 'ℯ', 'ļ', 'ẋ', 'ᾒ', 'ἶ', 'ệ', 'ℓ', 'Ŋ', 'Ḝ', 'ξ', 'ṵ', 'û', 'ẻ', 'Ũ', 'ṡ', '§', 'Ƚ', 'Š', 'ᶙ', 'ṩ', '¹', 'ư', 'Ῐ', 'Ü', 'ŝ', 'ὴ', 'Ș', 'ũ', 'ῑ', 'ⱷ', 'Ǘ', 'Ɇ', 'ĭ', 'ἤ', 'Ɲ', 'Ǝ', 'ủ', 'µ', 'Ỵ', 'Ű', 'ū', 'į', 'ἳ', 'ΐ', 'ḝ', 'Ɛ', 'ṇ', 'È', 'ῆ', 'ử', 'Ň', 'υ', 'Ǜ', 'Ἔ', 'Ὑ', 'μ', 'Ļ', 'ů', 'Ɫ', 'ŷ', 'Ǚ', 'ἠ', 'Ĺ', 'Ę', 'Ὲ', 'Ẍ', 'Ɣ', 'Ϊ', 'ℇ', 'ẍ', 'ῧ', 'ϵ', 'ἦ', 'ừ', 'ṳ', 'ᾕ', 'ṋ', 'ù', 'ῦ', 'Ι', 'ῠ', 'ṥ', 'ὲ', 'ê', 'š', 'ě', 'ề', 'ẽ', 'ī', 'Ė', 'ỷ', 'Ủ', 'ḯ', 'Ἓ', 'Ὓ', 'Ş', 'ύ', 'Ṧ', 'Ŷ', 'ἒ', 'ἵ', 'ė', 'ἰ', 'ẹ', 'Ȇ', 'Ɏ', 'Ί', 'ὶ', 'Ε', 'ḛ', 'Ὤ', 'ǐ', 'ȇ', 'ἢ', 'í', 'ȕ', 'Ữ', '＄', 'ή', 'Ṡ', 'ἷ', 'Ḙ', 'Ὢ', 'Ṉ', 'Ľ', 'ῃ', 'Ụ', 'Ṇ', 'ᾐ', 'Ů', 'Ἕ', 'ý', 'Ȅ', 'ᴌ', 'ύ', 'ņ', 'ὒ', 'Ý', 'ế', 'ĩ', 'ǘ', 'Ē', 'ṹ', 'Ư', 'é', 'Ÿ', 'ΰ', 'Ὦ', 'Ë', 'ỳ', 'ἓ', 'ĕ', 'ἑ', 'ṅ', 'ȗ', 'Ν', 'ί', 'ể', 'ᴟ', 'è', 'ᴇ', 'ḭ', 'ȝ', 'ϊ', 'ƪ', 'Ὗ', 'Ų', 'Ề', 'Ṷ', 'ü', 'Ɨ', 'Ώ', 'ň', 'ṷ', 'ƞ', 'Ȗ', 'ș', 'ῒ', 'Ś', 'Ự', 'Ń', 'Ἳ', 'Ứ', 'Ἷ', 'ἱ', 'ᾔ', 'ÿ', 'Ẽ', 'ὖ', 'ὑ', 'ἧ', 'Ὥ', 'ṉ', 'Ὠ', 'ℒ', 'Ệ', 'Ὼ', 'Ẻ', 'ḙ', 'Ŭ', '₴', 'Ὡ', 'ȉ', 'Ṅ', 'ᵪ', 'ữ', 'Ὧ', 'ń', 'Ἐ', 'Ú', 'ɏ', 'î', 'Ⱡ', 'Ƨ', 'Ě', 'ȿ', 'ᴉ', 'Ṩ', 'Ê', 'ȅ', 'ᶊ', 'Ṻ', 'Ḗ', 'ǹ', 'ᴣ', 'ş', 'Ï', 'ᾗ', 'ự', 'ὗ', 'ǔ', 'ᶓ', 'Ǹ', 'Ἶ', 'Ṳ', 'Ʊ', 'ṻ', 'Ǐ', 'ᵴ', 'ῇ', 'Ẹ', 'Ế', 'Ϋ', 'Ū', 'Ῑ', 'ί', 'ỹ', 'Ḯ', 'ǀ', 'Ὣ', 'Ȳ', 'ǃ', 'ų', 'ϴ', 'Ώ', 'Í', 'ì', 'ι', 'ῄ', 'ΰ', 'ἣ', 'ῡ', 'Ἒ', 'Ḽ', 'Ȉ', 'Έ', 'ἴ', 'ᶇ', 'ἕ', 'ǚ', 'Ī', 'Έ', '¥', 'Ṵ', 'ὔ', 'Ŝ', 'ῢ', 'Ἱ', 'ű', 'Ḷ', 'Ὶ', 'ḗ', 'ᴜ', 'ę', 'ὐ', 'Û', 'ᾑ', 'Ʋ', 'Ἑ', 'Ì', 'ŋ', 'Ḛ', 'ỵ', 'Ễ', '℮', '×', 'Ῠ', 'Ἵ', 'Ύ', 'Ử', 'ᴈ', 'ē', 'Ἰ', 'ᶖ', 'ȳ', 'Ǯ', 'ὓ', 'ὕ', 'ῂ', 'Ĕ', 'É', 'ᾓ', 'Ḻ', 'Ņ', 'ἥ', 'ḕ', 'ὺ', 'Ȋ', 'ı', 'Ȕ', 'ṧ', 'ᾖ', 'Ί', 'ΐ', '€', 'Ḭ', 'Ƴ', 'ȵ', 'Ṹ', 'Ñ', 'Ƞ', 'Ȩ', 'ῐ', 'ứ', 'έ', 'ł', 'ŭ', '϶', 'ƴ', '₤', 'ƨ', '£', 'Ł', 'ñ', 'ë', 'ễ', 'ǯ', 'ᶕ', 'ή', 'ᶔ', 'Π', 'ȩ', 'ἐ', 'Ể', 'ε', 'Ĩ', 'ǜ', 'Į', 'Ξ', 'Ḹ', 'Ῡ', '∩', 'ú', 'Χ', 'ụ'}
 
     def removeDnsbl (self,irc,ip,droneblHost,droneblKey):
-        headers = {
-            'Content-Type' : 'text/xml'
-        }
-        def check(answer):
-            found = False
-            for line in answer.split('\n'):
-                if line.find('listed="1"') != -1:
-                    id = line.split('id="')[1]
-                    id = id.split('"')[0]
-                    if line.find('type="18"') != -1:
-                        self.logChannel(irc,'RMDNSBL: %s (%s) not removed: is type 18' % (ip,id))
-                        if ip in self.rmrequestors:
-                            irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],'%s (%s) not removed: is type 18' % (ip,id)))
-                            del self.rmrequestors[ip]
-                        continue
-                    data = "<?xml version=\"1.0\"?><request key='"+droneblKey+"'><remove id='"+id+"' /></request>"
-                    found = True
-                    try:
-                        r = requests.post(droneblHost,data=data,headers=headers)
-                        response = r.text.replace('\n','')
-                        if "You are not authorized to remove this incident" in response:
-                            self.logChannel(irc,'RMDNSBL: %s (%s) failed: You are not authorized to remove this incident' % (ip,id))
-                            if ip in self.rmrequestors:
-                                irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],'%s (%s) not removed: You are not authorized to remove this incident' % (ip,id)))
-                                del self.rmrequestors[ip]
-                        else:
-                            self.logChannel(irc,'RMDNSBL: %s (%s) removed' % (ip,id))
-                            if ip in self.rmrequestors:
-                                irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],'%s (%s) removed' % (ip,id)))
-                                del self.rmrequestors[ip]
-                    except:
-                        self.logChannel(irc,'RMDNSBL: %s (%s) failed: unknown error' % (ip,id))
-                        if ip in self.rmrequestors:
-                            irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],'%s (%s) not removed: unknown error' % (ip,id)))
-                            del self.rmrequestors[ip]
-            if not found:
+        def removed (ip,status,id):
+            self.metrics.inc('sigyn_dronebl_removals_total',(('status',status),))
+            if status == 'type18':
+                self.logChannel(irc,'RMDNSBL: %s (%s) not removed: is type 18' % (ip,id))
+                reply = '%s (%s) not removed: is type 18' % (ip,id)
+            elif status == 'unauthorized':
+                self.logChannel(irc,'RMDNSBL: %s (%s) failed: You are not authorized to remove this incident' % (ip,id))
+                reply = '%s (%s) not removed: You are not authorized to remove this incident' % (ip,id)
+            elif status == 'removed':
+                self.logChannel(irc,'RMDNSBL: %s (%s) removed' % (ip,id))
+                reply = '%s (%s) removed' % (ip,id)
+            elif status == 'failed':
+                self.logChannel(irc,'RMDNSBL: %s (%s) failed: unknown error' % (ip,id))
+                reply = '%s (%s) not removed: unknown error' % (ip,id)
+            elif status == 'notlisted':
                 self.logChannel(irc,'RMDNSBL: %s (none) not removed: no listing found' % ip)
-                if ip in self.rmrequestors:
-                    irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],'%s (%s) not removed: no listing found' % (ip,id)))
-                    del self.rmrequestors[ip]
-        data = "<?xml version=\"1.0\"?><request key='"+droneblKey+"'><lookup ip='"+ip+"' /></request>"
-        r = requests.post(droneblHost,data=data,headers=headers)
-        if r.status_code == 200:
-            check(r.text)
-        else:
-            self.logChannel(irc,'RMDNSBL: %s (unknown) failed: status code %s' % (ip,r.status_code))
+                reply = '%s (none) not removed: no listing found' % ip
+            else:
+                self.logChannel(irc,'RMDNSBL: %s (unknown) failed: %s' % (ip,id))
+                reply = '%s (unknown) not removed: %s' % (ip,id)
             if ip in self.rmrequestors:
-                irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],'%s (unknown) not removed: status code %s' % (ip,r.status_code)))
+                irc.queueMsg(ircmsgs.privmsg(self.rmrequestors[ip],reply))
+                del self.rmrequestors[ip]
+        self.dronebl.remove(droneblHost,droneblKey,ip,removed)
 
     def fillDnsbl (self,irc,ip,droneblHost,droneblKey,comment=None):
-        headers = {
-            'Content-Type' : 'text/xml'
-        }
-        def check(answer):
+        def submitted (ip,status,detail):
             self.log.info ('fillDnsbl, answered %s' % ip)
-            if 'listed="1"' in answer:
+            self.metrics.inc('sigyn_dronebl_submissions_total',(('status',status),))
+            if status == 'listed':
                 self.logChannel(irc,'DNSBL: %s (already listed)' % ip)
-                return
-            type = 3
-            if comment == 'Bottler':
-                type = 5
-            elif comment == 'Unknown spambot or drone':
-                type = 6
-            elif comment == 'DDOS Drone':
-                type = 7
-            elif comment == 'SOCKS Proxy':
-                type = 8
-            elif comment == 'HTTP Proxy':
-                type = 9
-            elif comment == 'ProxyChain':
-                type = 10
-            elif comment == 'Web Page Proxy':
-                type = 11
-            elif comment == 'Open DNS Resolver':
-                type = 12
-            elif comment == 'Brute force attackers':
-                type = 13
-            elif comment == 'Open Wingate Proxy':
-                type = 14
-            elif comment == 'Compromised router / gateway':
-                type = 15
-            elif comment == 'Autorooting worms':
-                type = 16
-            elif comment == 'Automatically determined botnet IPs (experimental)':
-                type = 17
-            elif comment == 'DNS/MX type hostname detected on IRC':
-                type = 18
-            elif comment == "Abused VPN Service":
-                type = 19
-            data = "<?xml version=\"1.0\"?><request key='"+droneblKey+"'><add ip='"+ip+"' type='"+str(type)+"' comment='used by irc spam bot' /></request>"
-            r = requests.post(droneblHost,data=data,headers=headers)
-            if r.status_code != 200:
-                self.logChannel(irc,'DNSBL: %s (add returned %s %s)' % (ip,r.status_code,r.reason))
-            if comment:
-                self.logChannel(irc,'DNSBL: %s (%s,type:%s)' % (ip,comment,type))
+            elif status == 'added':
+                if comment:
+                    self.logChannel(irc,'DNSBL: %s (%s,type:%s)' % (ip,comment,detail))
+                else:
+                    self.logChannel(irc,'DNSBL: %s' % ip)
             else:
-                self.logChannel(irc,'DNSBL: %s' % ip)
+                self.logChannel(irc,'DNSBL: %s (%s)' % (ip,detail))
         self.log.info('fillDnsbl, checking %s' % ip)
-        data = "<?xml version=\"1.0\"?><request key='"+droneblKey+"'><lookup ip='"+ip+"' /></request>"
-        try:
-            r = requests.post(droneblHost,data=data,headers=headers,timeout=9)
-            if r.status_code == 200:
-                check(r.text)
-            else:
-                self.logChannel(irc,'DNSBL: %s (%s)' % (ip,r.status_code))
-        except requests.exceptions.RequestException as e:
-            self.logChannel(irc,'DNSBL: %s (%s)' % (ip,e))
+        if not self.dronebl.add(droneblHost,droneblKey,ip,comment,submitted):
+            self.log.info('fillDnsbl, %s recently submitted' % ip)
+            self.metrics.inc('sigyn_dronebl_submissions_total',(('status','recent'),))
+
+    def gauges (self):
+        """returns current sizes of queues and caches, as (name,labels,value)"""
+        L = []
+        for network in list(self._ircs.keys()):
+            i = self._ircs.get(network)
+            if not i:
+                continue
+            labels = (('network',network),)
+            L.append(('sigyn_channels',labels,len(i.channels)))
+            L.append(('sigyn_queue_keys',labels,len(i.queues)))
+            # approximate entries of Windows, other values of i.queues are timestamps,
+            # called from the exporter's threads so nothing is expired here
+            windows = [q for qs in list(i.queues.values()) + list(i.amsg.values()) for q in list(qs.values()) if isinstance(q,Window)]
+            L.append(('sigyn_queues',labels,sum([q.stored() for q in windows])))
+            L.append(('sigyn_whowas_pending',labels,len(i.whowas)))
+        for (name,c) in (('masks',self.cache),('capabilities',self.capabilities)):
+            labels = (('cache',name),)
+            L.append(('sigyn_cache_entries',labels,len(c)))
+            L.append(('sigyn_cache_hits',labels,c.hits))
+            L.append(('sigyn_cache_misses',labels,c.misses))
+            L.append(('sigyn_cache_evictions',labels,c.evictions))
+        L.append(('sigyn_resolver_queue',(),self.resolver.queue.qsize()))
+        L.append(('sigyn_resolver_pending',(),len(self.resolver.pending)))
+        L.append(('sigyn_dronebl_queue',(),self.dronebl.queue.qsize()))
+        return L
+
+    def renderMetrics (self):
+        return self.metrics.render(self.gauges())
+
+    def watch (self,value,callback):
+        value.addCallback(callback)
+        self.watched.append((value,callback))
+
+    def watchValue (self,value):
+        if not value in self.settingsValues:
+            self.watch(value,self.resetSettings)
+            self.settingsValues.add(value)
+
+    def resetSettings (self):
+        self.settings = {}
+
+    def getSettings (self,channel):
+        """returns plugin's values for channel, values are read once until one of them changes"""
+        settings = self.settings.get(channel)
+        if settings is None:
+            group = conf.supybot.plugins.get(self.name())
+            values = {}
+            for name in group._added:
+                if name == 'lastActionTaken':
+                    continue
+                value = group.get(name)
+                if channel and value._channelValue:
+                    value = value.getSpecific(channel=channel)
+                    self.watchValue(value)
+                values[name] = value()
+            settings = Settings(channel,values)
+            self.settings[channel] = settings
+        return settings
+
+    def getCapabilities (self,prefix,channel):
+        """returns bitmask of capabilityBits owned by prefix in channel"""
+        now = time.time()
+        if now - self.capabilitiesChecked > 1:
+            # users and channels databases are written on changes
+            self.capabilitiesChecked = now
+            stamp = []
+            for db in (ircdb.users,ircdb.channels):
+                try:
+                    stamp.append(os.stat(db.filename).st_mtime_ns)
+                except (AttributeError,TypeError,OSError):
+                    stamp.append(None)
+            if stamp != self.capabilitiesStamp:
+                self.capabilitiesStamp = stamp
+                self.capabilities.clear()
+        key = (prefix,channel)
+        bits = self.capabilities.get(key)
+        if bits is None:
+            bits = 0
+            if ircdb.checkCapability(prefix,'protected'):
+                bits |= capabilityBits['protected']
+            if channel:
+                if ircdb.checkCapability(prefix,ircdb.makeChannelCapability(channel,'protected')):
+                    bits |= capabilityBits['channelProtected']
+                for detector in detectors:
+                    if ircdb.checkCapability(prefix,ircdb.makeChannelCapability(channel,detector)):
+                        bits |= capabilityBits[detector]
+            self.capabilities.set(key,bits,self.registryValue('capabilityCacheLife'))
+        return bits
 
     def state (self,irc,msg,args,channel):
         """[<channel>]
@@ -518,6 +2208,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 elif ircutils.isUserHostmask(k):
                     prefixs += 1
             irc.queueMsg(ircmsgs.privmsg(msg.nick,"Via server's notices: %s channels and %s users monitored" % (channels,prefixs)))
+            c = self.cache
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,'Masks cache: %s/%s entries, %s hits, %s misses, %s evictions, %s expirations' % (len(c),c.size,c.hits,c.misses,c.evictions,c.expirations)))
         for chan in i.channels:
             if channel == chan:
                 ch = self.getChan(irc,chan)
@@ -553,6 +2245,37 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         irc.replySuccess()
     state = wrap(state,['owner',optional('channel')])
 
+    def profile (self,irc,msg,args):
+        """takes no arguments
+
+        returns sampled detectors timings, written to profileFile if set"""
+        i = self.getIrc(irc)
+        lines = []
+        for kind in sorted(i.timings):
+            h = i.timings[kind]
+            n = len(h)
+            if n:
+                lines.append('%s: %s samples, p50 < %.3fms, p99 < %.3fms' % (kind,n,h.percentile(0.5)*1000,h.percentile(0.99)*1000))
+        if not len(lines):
+            irc.reply('No timings, profileSample is %s' % self.registryValue('profileSample'))
+            return
+        for line in lines:
+            irc.queueMsg(ircmsgs.privmsg(msg.nick,line))
+        path = self.registryValue('profileFile')
+        if len(path):
+            try:
+                with open('%s.tmp' % path,'w') as f:
+                    f.write('# %s 1/%s messages timed over %ss\n' % (irc.network,self.registryValue('profileSample'),self.registryValue('profileLife')))
+                    for line in lines:
+                        f.write('%s\n' % line)
+                os.replace('%s.tmp' % path,path)
+            except OSError as e:
+                self.log.error('unable to write %s: %s' % (path,e))
+                irc.error('unable to write %s' % path)
+                return
+        irc.replySuccess()
+    profile = wrap(profile,['owner'])
+
     def defcon (self,irc,msg,args,channel):
         """[<channel>]
 
@@ -685,10 +2408,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         i = self.getIrc(irc)
         patterns = []
         text = text.encode('utf-8').strip()
-        for k in i.patterns:
-            pattern = i.patterns[k]
-            if pattern.match(text):
-                patterns.append('#%s' % pattern.uid)
+        for pattern in i.match(text):
+            patterns.append('#%s' % pattern.uid)
         if len(patterns):
             irc.queueMsg(ircmsgs.privmsg(msg.nick,'%s matches: %s' % (len(patterns),', '.join(patterns))))
         else:
@@ -790,9 +2511,12 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         returns temporary patterns for given channel"""
         i = self.getIrc(irc)
         if channel in i.channels:
-            chan = self.getChan(irc,channel)
-            if chan.patterns:
-                patterns = list(chan.patterns)
+            stores = self.getChannelPatterns(irc,channel)
+            if len(stores):
+                life = self.getSettings(channel)['computedPatternLife']
+                patterns = []
+                for store in stores:
+                    patterns.extend(store.alive(life))
                 if len(patterns):
                     irc.reply('[%s] %s patterns : %s' % (channel,len(patterns),', '.join(patterns)))
                 else:
@@ -809,15 +2533,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             add <ips> on dronebl, hostmasks can be provided"""
         for ip in ips:
             if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
-                t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),"Unknown spambot or drone"))
-                t.setDaemon(True)
-                t.start()
+                self.fillDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),"Unknown spambot or drone")
             else:
                 prefix = "*!*@%s" % ip
                 if ircutils.isUserHostmask(prefix):
-                    t = world.SupyThread(target=self.resolve,name=format('resolve %s', prefix),args=(irc,prefix,'',True,"Unknown spambot or drone"))
-                    t.setDaemon(True)
-                    t.start()
+                    self.resolve(irc,prefix,'',True,"Unknown spambot or drone")
         irc.replySuccess()
     dnsblresolve = wrap(dnsblresolve,['owner',commalist('something')])
 
@@ -827,9 +2547,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
           add <ips> on dronebl, <comment> can be used to change type (Bottler|Unknown spambot or drone|DDOS Drone|SOCKS Proxy|HTTP Proxy|ProxyChain|Web Page Proxy|Open DNS Resolver|Brute force attackers|Open Wingate Proxy|Compromised router / gateway|Autorooting worms)"""
        for ip in ips:
            if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
-               t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),comment))
-               t.setDaemon(True)
-               t.start()
+               self.fillDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),comment)
        irc.replySuccess()
     dnsbl = wrap(dnsbl,['owner',commalist('ip'),rest('text')])
 
@@ -840,9 +2558,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         for ip in ips:
             if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
                 self.rmrequestors[ip] = msg.nick
-                t = world.SupyThread(target=self.removeDnsbl,name=format('rmDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey')))
-                t.setDaemon(True)
-                t.start()
+                self.removeDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'))
         irc.replySuccess()
     rmdnsbl = wrap(rmdnsbl,['owner',many('ip')])
 
@@ -853,33 +2569,18 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         text = text.lower()
         i = self.getIrc(irc)
         if channel in i.channels:
-            chan = self.getChan(irc,channel)
-            shareID = self.registryValue('shareComputedPatternID',channel=channel)
-            if shareID == -1 or not i.defcon:
-                life = self.registryValue('computedPatternLife',channel=channel)
-                if not chan.patterns:
-                    chan.patterns = utils.structures.TimeoutQueue(life)
-                elif chan.patterns.timeout != life:
-                    chan.patterns.setTimeout(life)
-                chan.patterns.enqueue(text)
-                self.logChannel(irc,'PATTERN: [%s] added tmp "%s" for %ss by %s' % (channel,text,life,msg.nick))
-                irc.replySuccess()
+            # outside defcon a grouped channel keeps the pattern for itself
+            if i.defcon:
+                patterns = self.getPatterns(irc,channel)
             else:
-                n = 0
-                l = self.registryValue('computedPatternLife',channel=channel)
-                for channel in i.channels:
-                    chan = self.getChan(irc,channel)
-                    id = self.registryValue('shareComputedPatternID',channel=channel)
-                    if id == shareID:
-                        life = self.registryValue('computedPatternLife',channel=channel)
-                        if not chan.patterns:
-                            chan.patterns = utils.structures.TimeoutQueue(life)
-                        elif chan.patterns.timeout != life:
-                            chan.patterns.setTimeout(life)
-                        chan.patterns.enqueue(text)
-                        n = n + 1
-                self.logChannel(irc,'PATTERN: added tmp "%s" for %ss by %s in %s channels' % (text,l,msg.nick,n))
-                irc.replySuccess()
+                patterns = self.getLocalPatterns(irc,channel)
+            life = self.getSettings(channel)['computedPatternLife']
+            patterns.enqueue(text)
+            if channel in patterns.channels:
+                self.logChannel(irc,'PATTERN: added tmp "%s" for %ss by %s in %s channels' % (text,life,msg.nick,len(patterns.channels)))
+            else:
+                self.logChannel(irc,'PATTERN: [%s] added tmp "%s" for %ss by %s' % (channel,text,life,msg.nick))
+            irc.replySuccess()
         else:
             irc.reply('unknown channel')
     addtmp = wrap(addtmp,['op','text'])
@@ -890,17 +2591,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         add <text> to temporary patterns in all channels"""
         text = text.lower()
         i = self.getIrc(irc)
-        n = 0
-        for channel in i.channels:
-            chan = self.getChan(irc,channel)
-            life = self.registryValue('computedPatternLife',channel=channel)
-            if not chan.patterns:
-                chan.patterns = utils.structures.TimeoutQueue(life)
-            elif chan.patterns.timeout != life:
-                chan.patterns.setTimeout(life)
-            chan.patterns.enqueue(text)
-            n = n + 1
-        self.logChannel(irc,'PATTERN: added tmp "%s" for %ss by %s in %s channels' % (text,life,msg.nick,n))
+        life = 0
+        for patterns in self.getAllPatterns(irc):
+            patterns.enqueue(text)
+            life = max(life,patterns.timeout)
+        self.logChannel(irc,'PATTERN: added tmp "%s" for %ss by %s in %s channels' % (text,life,msg.nick,len(i.channels)))
         irc.replySuccess()
     addglobaltmp = wrap(addglobaltmp,['owner','text'])
 
@@ -910,20 +2605,17 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         remove temporary patterns for given channel"""
         i = self.getIrc(irc)
         if channel in i.channels:
-            chan = self.getChan(irc,channel)
-            shareID = self.registryValue('shareComputedPatternID',channel=channel)
-            if shareID != -1:
-                n = 0
-                for channel in i.channels:
-                    id = self.registryValue('shareComputedPatternID',channel=channel)
-                    if id == shareID:
-                       if i.channels[channel].patterns:
-                           i.channels[channel].patterns.reset()
-                           n = n + 1
-                self.logChannel(irc,'PATTERN: removed tmp patterns in %s channels by %s' % (n,msg.nick))
-            elif chan.patterns:
-                l = len(chan.patterns)
-                chan.patterns.reset()
+            patterns = self.getPatterns(irc,channel,False)
+            if patterns and channel in patterns.channels:
+                patterns.reset()
+                for ch in patterns.channels:
+                    if i.channels[ch].local is not None:
+                        i.channels[ch].local.reset()
+                self.logChannel(irc,'PATTERN: removed tmp patterns in %s channels by %s' % (len(patterns.channels),msg.nick))
+                irc.replySuccess()
+            elif patterns:
+                l = len(patterns)
+                patterns.reset()
                 if l:
                     self.logChannel(irc,'PATTERN: [%s] removed %s tmp pattern by %s' % (channel,l,msg.nick))
                     irc.replySuccess()
@@ -957,9 +2649,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                               else:
                                   irc.queueMsg(ircmsgs.IrcMsg('UNKLINE %s' % ip))
                               if self.registryValue('clearTmpPatternOnUnkline',channel=channel):
-                                  if chan.patterns and len(chan.patterns):
-                                      self.logChannel(irc,'PATTERN: [%s] removed %s tmp pattern by %s' % (channel,len(chan.patterns),msg.nick))
-                                      chan.patterns.reset()
+                                  for patterns in (chan.patterns,chan.local):
+                                      if patterns and len(patterns):
+                                          self.logChannel(irc,'PATTERN: [%s] removed %s tmp pattern by %s' % (channel,len(patterns),msg.nick))
+                                          patterns.reset()
                               self.logChannel(irc,'OP: [%s] %s unklined %s (%s)' % (channel,msg.nick,ip,nick))
                               irc.reply('The ban on %s from %s has been lifted' % (nick,channel))
                           else:
@@ -1049,30 +2742,12 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         (nick,ident,host) = ircutils.splitHostmask(prefix)
         if ident.startswith('~'):
             ident = '*'
-        if prefix in self.cache:
-            return self.cache[prefix]
-        try:
-            resolver = dns.resolver.Resolver()
-            resolver.timeout = self.registryValue('resolverTimeout')
-            resolver.lifetime = self.registryValue('resolverTimeout')
-            L = []
-            ips = None
-            try:
-                ips = resolver.query(host,'AAAA')
-            except:
-                ips = None
-            if ips:
-                for ip in ips:
-                    if not str(ip) in L:
-                        L.append(str(ip))
-            try:
-                ips = resolver.query(host,'A')
-            except:
-                ips = None
-            if ips:
-                for ip in ips:
-                    if not str(ip) in L:
-                        L.append(str(ip))
+        mask = self.cache.get(prefix)
+        if mask:
+            return mask
+        i = self.getIrc(irc)
+        def resolved (host,L):
+            self.metrics.inc('sigyn_dns_resolutions_total',(('result','found' if len(L) else 'none'),))
             #self.log.debug('%s resolved as %s' % (prefix,L))
             if len(L) == 1:
                 h = L[0]
@@ -1080,46 +2755,49 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if dnsbl:
                     if utils.net.isIPV4(h) or utils.net.bruteIsIPV6(h):
                         if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                            t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', h),args=(irc,h,self.registryValue('droneblHost'),self.registryValue('droneblKey'),comment))
-                            t.setDaemon(True)
-                            t.start()
+                            self.fillDnsbl(irc,h,self.registryValue('droneblHost'),self.registryValue('droneblKey'),comment)
                             if prefix in i.resolving:
                                 del i.resolving[prefix]
                             return
-                self.cache[prefix] = '%s@%s' % (ident,h)
+                mask = '%s@%s' % (ident,h)
             else:
-                self.cache[prefix] = '%s@%s' % (ident,host)
-        except:
-            self.cache[prefix] = '%s@%s' % (ident,host)
-        i = self.getIrc(irc)
-        if channel and channel in irc.state.channels:
-            chan = self.getChan(irc,channel)
-            if nick in irc.state.channels[channel].users:
-                if nick in chan.nicks:
-                    chan.nicks[nick][2] = self.cache[prefix]
-        if prefix in i.resolving:
-            del i.resolving[prefix]
+                mask = '%s@%s' % (ident,host)
+            self.cache.set(prefix,mask,self.registryValue('maskCacheResolvedLife'))
+            if channel and channel in irc.state.channels:
+                chan = self.getChan(irc,channel)
+                if nick in irc.state.channels[channel].users:
+                    if nick in chan.nicks:
+                        chan.nicks[nick].mask = mask
+            if prefix in i.resolving:
+                del i.resolving[prefix]
+        if not self.resolver.resolve(host,resolved):
+            # resolver is overloaded, will be retried on next call
+            self.log.debug('resolver queue is full, %s not resolved' % prefix)
+            self.metrics.inc('sigyn_dns_resolutions_total',(('result','overloaded'),))
+            if prefix in i.resolving:
+                del i.resolving[prefix]
 
     def prefixToMask (self,irc,prefix,channel='',dnsbl=False,comment=None):
-        if prefix in self.cache:
-            return self.cache[prefix]
+        mask = self.cache.get(prefix)
+        if mask:
+            return mask
         prefix = prefix
         (nick,ident,host) = ircutils.splitHostmask(prefix)
         if '/' in host:
             if host.startswith('gateway/web/freenode'):
                 if 'ip.' in host:
-                    self.cache[prefix] = '*@%s' % host.split('ip.')[1]
+                    mask = '*@%s' % host.split('ip.')[1]
                 else:
                     # syn offline / busy
-                    self.cache[prefix] = '%s@gateway/web/freenode/*' % ident
+                    mask = '%s@gateway/web/freenode/*' % ident
             elif host.startswith('gateway/tor-sasl'):
-                self.cache[prefix] = '*@%s' % host
+                mask = '*@%s' % host
             elif host.startswith('gateway/vpn') or host.startswith('nat/'):
                 if ident.startswith('~'):
                     ident = '*'
                 if '/x-' in host:
                     host = host.split('/x-')[0] + '/*'
-                self.cache[prefix] = '%s@%s' % (ident,host)
+                mask = '%s@%s' % (ident,host)
             elif host.startswith('gateway'):
                 h = host.split('/')
                 if 'ip.' in host:
@@ -1138,47 +2816,46 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     h = '%s/*' % '/'.join(h)
                 else:
                     h = host
-                self.cache[prefix] = '%s@%s' % (ident,h)
+                mask = '%s@%s' % (ident,h)
             else:
                 if ident.startswith('~'):
                     ident = '*'
-                self.cache[prefix] = '%s@%s' % (ident,host)
+                mask = '%s@%s' % (ident,host)
         else:
             if ident.startswith('~'):
                 ident = '*'
             if utils.net.isIPV4(host):
-                self.cache[prefix] = '%s@%s' % (ident,host)
+                mask = '%s@%s' % (ident,host)
             elif utils.net.bruteIsIPV6(host):
-                self.cache[prefix] = '%s@%s' % (ident,host)
+                mask = '%s@%s' % (ident,host)
             else:
                 i = self.getIrc(irc)
                 if self.registryValue('useWhoWas'):
-                    self.cache[prefix] = '%s@%s' % (ident,host)
+                    mask = '%s@%s' % (ident,host)
                 elif not prefix in i.resolving:
                     i.resolving[prefix] = True
-                    t = world.SupyThread(target=self.resolve,name=format('resolve %s', prefix),args=(irc,prefix,channel,dnsbl,comment))
-                    t.setDaemon(True)
-                    t.start()
+                    self.resolve(irc,prefix,channel,dnsbl,comment)
                     return '%s@%s' % (ident,host)
-        if prefix in self.cache:
-            return self.cache[prefix]
-        else:
-            if ident.startswith('~'):
-                ident = '*'
-            return '%s@%s' % (ident,host)
+                else:
+                    # not cached until resolved
+                    return '%s@%s' % (ident,host)
+        self.cache.set(prefix,mask,self.registryValue('maskCacheLife'))
+        return mask
 
     def do352 (self,irc,msg):
         # RPL_WHOREPLY
         channel = msg.args[1]
         (nick, ident, host) = (msg.args[5], msg.args[2], msg.args[3])
         if irc.isChannel(channel):
+            i = self.getIrc(irc)
             chan = self.getChan(irc,channel)
             t = time.time()
             prefix = '%s!%s@%s' % (nick,ident,host)
             mask = self.prefixToMask(irc,prefix,channel)
             if isCloaked(prefix,self):
                 t = t - self.registryValue('ignoreDuration',channel=channel) - 1
-            chan.nicks[nick] = [t,prefix,mask,'','']
+            i.enter(channel,(nick,))
+            i.track(chan,nick,prefix,mask,t)
 
     def spam (self,irc,msg,args,channel):
         """<channel>
@@ -1286,11 +2963,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if mode == '+v':
                     chan = self.getChan(irc,target)
                     if value in chan.nicks:
-                        a = chan.nicks[value]
-                        if len(a) == 5:
-                            chan.nicks[msg.nick] = [time.time(),a[1],a[2],a[3],a[4]]
-                        else:
-                            chan.nicks[msg.nick] = [time.time(),a[1],a[2],'','']
+                        chan.nicks[value].joins[target] = time.time()
         elif target in irc.state.channels:
             modes = ircutils.separateModes(msg.args[1:])
             for change in modes:
@@ -1354,38 +3027,106 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 acc = None
             else:
                 aa = acc.lower()
-                for u in i.klinednicks:
-                    if aa == u:
-                        self.logChannel(irc,"SERVICE: %s (%s) lethal account (account-notify)" % (msg.prefix,acc))
-                        src = msg.nick
-                        i.klinednicks.enqueue(aa)
-                        if not src in i.tokline:
-                            i.toklineresults[src] = {}
-                            i.toklineresults[src]['kind'] = 'evade'
-                            i.tokline[src] = src
-                            def f ():
-                                irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                            schedule.addEvent(f,time.time()+random.randint(0,7))
-                            #irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                        break
-            for channel in irc.state.channels:
-                if irc.isChannel(channel):
-                    chan = self.getChan(irc,channel)
-                    if nick in chan.nicks:
-                        a = chan.nicks[msg.nick]
-                        if len(a) == 5:
-                            chan.nicks[msg.nick] = [a[0],a[1],a[2],a[3],acc]
-                        else:
-                            chan.nicks[msg.nick] = [a[0],a[1],a[2],'',acc]
+                if aa in i.klinednicks:
+                    self.logChannel(irc,"SERVICE: %s (%s) lethal account (account-notify)" % (msg.prefix,acc))
+                    src = msg.nick
+                    i.klinednicks.add(aa)
+                    if not src in i.tokline:
+                        i.toklineresults[src] = {}
+                        i.toklineresults[src]['kind'] = 'evade'
+                        i.tokline[src] = src
+                        def f ():
+                            irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
+                        schedule.addEvent(f,time.time()+random.randint(0,7))
+                        #irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
+            if nick in i.users:
+                i.login(i.users[nick],acc)
 
     def getChan (self,irc,channel):
         i = self.getIrc(irc)
         if not channel in i.channels and irc.isChannel(channel):
             i.channels[channel] = Chan(channel)
+            if channel in irc.state.channels:
+                i.enter(channel,irc.state.channels[channel].users)
+            if self.getSettings(channel)['shareComputedPatternID'] != -1:
+                self.getPatterns(irc,channel)
             if not self.starting:
                 irc.queueMsg(ircmsgs.who(channel))
         return i.channels[channel]
 
+    def getPatterns (self,irc,channel,create=True):
+        """returns channel's TmpPatterns, the one of its group when shareComputedPatternID is set"""
+        i = self.getIrc(irc)
+        chan = self.getChan(irc,channel)
+        settings = self.getSettings(channel)
+        shareID = settings['shareComputedPatternID']
+        life = settings['computedPatternLife']
+        patterns = chan.patterns
+        if shareID == -1:
+            if patterns is not None and channel in patterns.channels:
+                patterns.channels.discard(channel)
+                patterns = None
+            if patterns is None:
+                # patterns added to the channel alone while it was grouped are kept
+                patterns = chan.local
+                chan.local = None
+            if patterns is None:
+                if not create:
+                    chan.patterns = None
+                    return None
+                patterns = TmpPatterns(life)
+            elif patterns.timeout != life:
+                patterns.setTimeout(life)
+        else:
+            if not shareID in i.shared:
+                i.shared[shareID] = TmpPatterns(life)
+            shared = i.shared[shareID]
+            # channels of the group may have different lifes, search filters on the caller's one
+            if shared.timeout < life:
+                shared.setTimeout(life)
+            if patterns is not shared:
+                if patterns is not None:
+                    patterns.channels.discard(channel)
+                shared.channels.add(channel)
+            patterns = shared
+        chan.patterns = patterns
+        return patterns
+
+    def getLocalPatterns (self,irc,channel,create=True):
+        """returns TmpPatterns holding patterns added to channel alone, kept apart from its group's one"""
+        patterns = self.getPatterns(irc,channel,create)
+        chan = self.getChan(irc,channel)
+        if patterns is None or not channel in patterns.channels:
+            return patterns
+        life = self.getSettings(channel)['computedPatternLife']
+        if chan.local is None:
+            if not create:
+                return None
+            chan.local = TmpPatterns(life)
+        elif chan.local.timeout != life:
+            chan.local.setTimeout(life)
+        return chan.local
+
+    def getChannelPatterns (self,irc,channel):
+        """returns TmpPatterns searched for channel, the one of its group then its own"""
+        result = []
+        for patterns in (self.getPatterns(irc,channel,False),self.getLocalPatterns(irc,channel,False)):
+            if patterns is not None and not patterns in result:
+                result.append(patterns)
+        return result
+
+    def getAllPatterns (self,irc):
+        """returns distinct TmpPatterns of monitored channels, one per shareComputedPatternID group"""
+        i = self.getIrc(irc)
+        result = []
+        seen = set()
+        for channel in list(i.channels):
+            patterns = self.getPatterns(irc,channel)
+            if not id(patterns) in seen:
+                seen.add(id(patterns))
+                result.append(patterns)
+        return result
+
     def kill (self,irc,nick,reason=None):
         i = self.getIrc(irc)
         if i.defcon:
@@ -1399,6 +3140,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         if not reason:
             reason = self.registryValue('killMessage')
         irc.sendMsg(ircmsgs.IrcMsg('KILL %s :%s' % (nick,reason)))
+        self.metrics.inc('sigyn_kills_total')
 
     def do338 (self,irc,msg):
         i = self.getIrc(irc)
@@ -1427,6 +3169,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 irc.sendMsg(ircmsgs.IrcMsg('PRIVMSG OperServ :AKILL ADD %s !T %s %s | %s' % (mask,pending[2],pending[4],pending[3])))
             else:
                 irc.sendMsg(ircmsgs.IrcMsg('KLINE %s %s :%s|%s' % (pending[2],mask,pending[4],pending[3])))
+            self.metrics.inc('sigyn_klines_total')
             nickLowered = nick.lower()
             for channel in irc.state.channels:
                 chan = self.getChan(irc,channel)
@@ -1434,8 +3177,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     index = 0
                     for k in chan.klines:
                        if k.startswith(nickLowered):
-                           (at, m) = chan.klines.queue[index]
-                           chan.klines.queue[index] = (at,'%s %s' % (nickLowered,mask))
+                           m = chan.klines[index]
+                           chan.klines[index] = '%s %s' % (nickLowered,mask)
                            self.log.info('kline %s replaced at %s: %s / %s' % (m,index,nickLowered,mask))
                            break
                        index = index + 1
@@ -1473,6 +3216,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     irc.sendMsg(ircmsgs.IrcMsg('PRIVMSG OperServ :AKILL ADD %s !T %s %s | %s' % (mask,duration,klineMessage,reason)))
                 else:
                     irc.sendMsg(ircmsgs.IrcMsg('KLINE %s %s :%s|%s' % (duration,mask,klineMessage,reason)))
+                self.metrics.inc('sigyn_klines_total')
                 if i.defcon:
                     i.defcon = time.time()
         elif ircutils.isUserHostmask(prefix):
@@ -1481,6 +3225,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             if not nick in i.whowas:
                 i.whowas[nick] = [prefix,mask,duration,reason,klineMessage]
                 irc.sendMsg(ircmsgs.IrcMsg('WHOWAS %s' % nick))
+                self.metrics.inc('sigyn_whowas_fallbacks_total')
         def forgetKline ():
             i = self.getIrc(irc)
             if mask in i.klines:
@@ -1497,20 +3242,41 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         if not key in i.queues:
             i.queues[key] = {}
         if not kind in i.queues[key]:
-            i.queues[key][kind] = utils.structures.TimeoutQueue(life)
+            self.addWindow(i,i.queues[key],kind,life,i.queues,key)
         elif i.queues[key][kind].timeout != life:
             i.queues[key][kind].setTimeout(life)
         return i.queues[key][kind]
 
+    def addWindow (self,i,container,key,life,parent=None,parentKey=None,factory=Window):
+        """stores a new Window, or factory(life), at container[key], removed by cleanup once empty, with container from parent[parentKey]"""
+        window = factory(life)
+        container[key] = window
+        i.wheel.add(time.time() + life,(container,key,window,parent,parentKey))
+        return window
+
+    def getAmsgQueueFor (self,irc,mask,size,life):
+        """returns Window of mask's messages with a fingerprint of size characters"""
+        i = self.getIrc(irc)
+        if not mask in i.amsg:
+            i.amsg[mask] = {}
+        if not size in i.amsg[mask]:
+            self.addWindow(i,i.amsg[mask],size,life,i.amsg,mask)
+        elif i.amsg[mask][size].timeout != life:
+            i.amsg[mask][size].setTimeout(life)
+        return i.amsg[mask][size]
+
     def rmIrcQueueFor (self,irc,key):
         i = self.getIrc(irc)
         if key in i.queues:
             for k in i.queues[key]:
-                if type(i.queues[key][k]) == utils.structures.TimeoutQueue:
+                if isinstance(i.queues[key][k],Window):
                     i.queues[key][k].reset()
-                    i.queues[key][k].queue = None
             i.queues[key].clear()
             del i.queues[key]
+        if key in i.amsg:
+            for q in i.amsg[key].values():
+                q.reset()
+            del i.amsg[key]
 
     def do015 (self,irc,msg):
         try:
@@ -1560,21 +3326,16 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
            during 24h, via extended-join, account-notify, account's name change"""
         i = self.getIrc(irc)
         account = text.lower().strip()
-        i.klinednicks.enqueue(account)
+        i.klinednicks.add(account)
         self.logChannel(irc,'SERVICE: %s lethaled for 24h by %s' % (account, msg.nick))
-        for channel in irc.state.channels:
-            if irc.isChannel(channel):
-               c = self.getChan(irc,channel)
-               for u in list(irc.state.channels[channel].users):
-                  if u in c.nicks:
-                      if len(c.nicks[u]) > 4:
-                          if c.nicks[u][4] and c.nicks[u][4].lower() == account:
-                              self.ban(irc,u,c.nicks[u][1],c.nicks[u][2],self.registryValue('klineDuration'),'Lethaled account %s' % account,self.registryValue('klineMessage'),'BAD: %s (lethaled account %s)' % (account,c.nicks[u][1]),self.registryValue('killMessage'))
+        for user in i.sessions(account):
+            self.ban(irc,user.nick,user.prefix,user.mask,self.registryValue('klineDuration'),'Lethaled account %s' % account,self.registryValue('klineMessage'),'BAD: %s (lethaled account %s)' % (account,user.prefix),self.registryValue('killMessage'))
         irc.replySuccess()
     lethalaccount = wrap(lethalaccount,['owner','text'])
 
     def cleanup (self,irc):
         i = self.getIrc(irc)
+        self.cache.resize(self.registryValue('maskCacheSize'))
         partReason = 'Leaving the channel. /invite %s %s again if needed'
         for channel in irc.state.channels:
             if irc.isChannel(channel) and not channel in self.registryValue('mainChannel') and not channel == self.registryValue('snoopChannel') and not channel == self.registryValue('logChannel') and not channel == self.registryValue('reportChannel') and not channel == self.registryValue('secretChannel'):
@@ -1592,67 +3353,25 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                            network.channels().remove(channel)
                        except KeyError:
                            pass
-        kinds = []
-        for kind in i.queues:
-            count = 0
-            ks = []
-            try:
-                for k in i.queues[kind]:
-                    if isinstance(i.queues[kind][k],utils.structures.TimeoutQueue):
-                        if not len(i.queues[kind][k]):
-                            ks.append(k)
-                        else:
-                           count += 1
-                    else:
-                        count += 1
-            except:
-                self.log.error('Exception with %s' % kind)
-            if len(ks):
-                for k in ks:
-                    del i.queues[kind][k]
-            if count == 0:
-               kinds.append(kind)
-        for kind in kinds:
-            del i.queues[kind]
-        chs = []
-        for channel in i.channels:
-            chan = i.channels[channel]
-            ns = []
-            for n in chan.nicks:
-                if channel in irc.state.channels:
-                  if not n in irc.state.channels[channel].users:
-                        ns.append(n)
-                else:
-                    ns.append(n)
-            for n in ns:
-                del chan.nicks[n]
-            bs = []
-            for b in chan.buffers:
-                 qs = []
-                 count = 0
-                 for q in chan.buffers[b]:
-                     if isinstance(chan.buffers[b][q],utils.structures.TimeoutQueue):
-                         if not len(chan.buffers[b][q]):
-                            qs.append(q)
-                         else:
-                            count += 1
-                     else:
-                        count +=1
-                 for q in qs:
-                     del chan.buffers[b][q]
-                 if count == 0:
-                     bs.append(b)
-            for b in bs:
-                del chan.buffers[b]
-            logs = []
-            if chan.logs:
-                for log in chan.logs:
-                    if not len(chan.logs[log]):
-                        logs.append(log)
-            for log in logs:
-                del chan.logs[log]
-            if len(ns) or len(bs) or len(logs):
-                chs.append('[%s : %s nicks, %s buffers, %s logs]' % (channel,len(ns),len(bs),len(logs)))
+        for (container,key,window,parent,parentKey) in i.wheel.advance():
+            if container.get(key) is not window:
+                continue
+            if len(window):
+                i.wheel.add(window.expiry(),(container,key,window,parent,parentKey))
+                continue
+            del container[key]
+            if parent is not None and not len(container) and parent.get(parentKey) is container:
+                del parent[parentKey]
+        i.klinednicks.expire()
+        departed = i.departed
+        i.departed = []
+        for user in departed:
+            channels = ()
+            if i.users.get(user.nick) is user:
+                channels = i.nickchannels.get(user.nick,())
+            for channel in list(user.joins):
+                if not channel in channels and channel in i.channels and i.channels[channel].nicks.get(user.nick) is user:
+                    i.untrack(i.channels[channel],user.nick)
 
     def do391 (self,irc,msg):
         i = self.getIrc(irc)
@@ -1892,18 +3611,16 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         self.logChannel(irc,"SERVICE: %s suspicious evades/abuses with GROUP/ACCOUNTNAME/UNGROUP (was %s)" % (src,oldAccount))
                         i = self.getIrc(irc)
                         oldAccount = oldAccount.lower().strip()
-                        for u in i.klinednicks:
-                            if u == oldAccount:
-                                self.logChannel(irc,"SERVICE: %s lethaled (%s), enforcing" % (src,oldAccount))
-                                i.klinednicks.enqueue(src)
-                                if not src in i.tokline:
-                                    i.toklineresults[src] = {}
-                                    i.toklineresults[src]['kind'] = 'evade'
-                                    i.tokline[src] = src
-                                    def f ():
-                                        irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                                    schedule.addEvent(f,time.time()+random.randint(0,7))
-                                break
+                        if oldAccount in i.klinednicks:
+                            self.logChannel(irc,"SERVICE: %s lethaled (%s), enforcing" % (src,oldAccount))
+                            i.klinednicks.add(src)
+                            if not src in i.tokline:
+                                i.toklineresults[src] = {}
+                                i.toklineresults[src]['kind'] = 'evade'
+                                i.tokline[src] = src
+                                def f ():
+                                    irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
+                                schedule.addEvent(f,time.time()+random.randint(0,7))
     def do211 (self,irc,msg):
         i = self.getIrc(irc)
         if msg.args[1].startswith('[unknown@'):
@@ -1941,21 +3658,23 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         text = raw.lower()
         mask = self.prefixToMask(irc,msg.prefix)
         i = self.getIrc(irc)
-        if not i.ping or time.time() - i.ping > self.registryValue('lagInterval'):
+        settings = self.getSettings(None)
+        timer = i.timer(settings['profileSample'],settings['profileLife'])
+        if not i.ping or time.time() - i.ping > settings['lagInterval']:
             i.ping = time.time()
             self.cleanup(irc)
-            if self.registryValue('lagPermit') > -1:
+            if settings['lagPermit'] > -1:
                 i.stats = {}
-                if self.registryValue('ghostPermit') > -1:
+                if settings['ghostPermit'] > -1:
                     irc.queueMsg(ircmsgs.IrcMsg('STATS L'))
                 irc.queueMsg(ircmsgs.IrcMsg('MAP'))
         if i.defcon:
-            if time.time() > i.defcon + self.registryValue('defcon'):
+            if time.time() > i.defcon + settings['defcon']:
                 i.lastDefcon = time.time()
                 i.defcon = False
                 self.logChannel(irc,"INFO: triggers restored to normal behaviour")
                 for channel in irc.state.channels:
-                    if irc.isChannel(channel) and self.registryValue('defconMode',channel=channel):
+                    if irc.isChannel(channel) and self.getSettings(channel)['defconMode']:
                         if 'z' in irc.state.channels[channel].modes and irc.nick in list(irc.state.channels[channel].ops) and not 'm' in irc.state.channels[channel].modes:
                             irc.queueMsg(ircmsgs.IrcMsg('MODE %s q' % channel))
         if i.netsplit:
@@ -1966,31 +3685,36 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             self.log.debug('Ignoring %s (%s) - kline in progress', msg.prefix,mask)
             return
         isBanned = False
+        # built once a channel needs detectors
+        message = None
         for channel in targets.split(','):
             if channel.startswith('@'):
                 channel = channel.replace('@','',1)
             if channel.startswith('+'):
                 channel = channel.replace('+','',1)
             if irc.isChannel(channel) and channel in irc.state.channels:
-                if self.registryValue('reportChannel') == channel:
+                self.metrics.inc('sigyn_messages_total',(('channel',channel),))
+                settings = self.getSettings(channel)
+                if settings['reportChannel'] == channel:
                     self.handleReportMessage(irc,msg)
-                if self.registryValue('snoopChannel') == channel:
+                if settings['snoopChannel'] == channel:
                     self.handleSnoopMessage(irc,msg)
-                if self.registryValue('secretChannel') == channel:
+                if settings['secretChannel'] == channel:
                     self.handleSecretMessage(irc,msg)
-                if self.registryValue('ignoreChannel',channel):
+                if settings['ignoreChannel']:
                     continue
-                if ircdb.checkCapability(msg.prefix, 'protected'):
+                capabilities = self.getCapabilities(msg.prefix,channel)
+                if capabilities & capabilityBits['protected']:
                     if msg.nick in list(irc.state.channels[channel].ops) and irc.nick in text:
                         self.logChannel(irc,'OP: [%s] <%s> %s' % (channel,msg.nick,text))
                     continue
                 chan = self.getChan(irc,channel)
                 if chan.called:
-                    if time.time() - chan.called > self.registryValue('abuseDuration',channel=channel):
+                    if time.time() - chan.called > settings['abuseDuration']:
                         chan.called = False
                         if not i.defcon:
                             self.logChannel(irc,'INFO: [%s] returns to regular state' % channel)
-                        if irc.isChannel(channel) and self.registryValue('defconMode',channel=channel) and not i.defcon:
+                        if irc.isChannel(channel) and settings['defconMode'] and not i.defcon:
                             if 'z' in irc.state.channels[channel].modes and irc.nick in list(irc.state.channels[channel].ops) and not 'm' in irc.state.channels[channel].modes:
                                 irc.queueMsg(ircmsgs.IrcMsg('MODE %s q' % channel))
                 if isBanned:
@@ -1999,185 +3723,207 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if irc.nick in raw:
                         self.logChannel(irc,'OP: [%s] <%s> %s' % (channel,msg.nick,text))
                     continue
-                if self.registryValue('ignoreVoicedUser',channel=channel):
+                if settings['ignoreVoicedUser']:
                     if msg.nick in list(irc.state.channels[channel].voices):
                         continue
-                protected = ircdb.makeChannelCapability(channel, 'protected')
-                if ircdb.checkCapability(msg.prefix, protected):
+                if capabilities & capabilityBits['channelProtected']:
                     continue
-                if self.registryValue('ignoreRegisteredUser',channel=channel):
-                    if msg.nick in chan.nicks and len(chan.nicks[msg.nick]) > 4:
-                        if chan.nicks[msg.nick][4]:
-                            continue
-                killReason = self.registryValue('killMessage',channel=channel)
-                if msg.nick in chan.nicks and len(chan.nicks[msg.nick]) > 4:
-                    if chan.nicks[msg.nick][3] == "https://webchat.freenode.net":
+                if settings['ignoreRegisteredUser']:
+                    if msg.nick in chan.nicks and chan.nicks[msg.nick].account:
+                        continue
+                killReason = settings['killMessage']
+                if msg.nick in chan.nicks:
+                    if chan.nicks[msg.nick].gecos == "https://webchat.freenode.net":
                         hh = mask.split('@')[1]
                         mask = '*@%s' % hh
-                flag = ircdb.makeChannelCapability(channel, 'pattern')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    for k in i.patterns:
-                        pattern = i.patterns[k]
-                        if pattern.match(raw):
-                            if pattern.limit == 0:
+                if message is None:
+                    message = MessageContext(raw,text,self.spamchars)
+                if timer:
+                    timer.reset()
+                if capabilities & capabilityBits['pattern']:
+                    for pattern in i.match(raw):
+                        if pattern.limit == 0:
+                            isBanned = True
+                            uid = random.randint(0,1000000)
+                            reason = '%s - matches #%s in %s' % (uid,pattern.uid,channel)
+                            log = 'BAD: [%s] %s (matches #%s - %s)' % (channel,msg.prefix,pattern.uid,uid)
+                            self.ban(irc,msg.nick,msg.prefix,mask,settings['klineDuration'],reason,settings['klineMessage'],log,killReason)
+                            i.count(self.getDb(irc.network),pattern.uid,settings['patternCountPermit'])
+                            chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
+                            self.isAbuseOnChannel(irc,channel,'pattern',mask)
+                            self.metrics.inc('sigyn_detections_total',(('kind','pattern'),))
+                            self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
+                            break
+                        else:
+                            queue = self.getIrcQueueFor(irc,mask,pattern.uid,pattern.life)
+                            queue.enqueue(text)
+                            if len(queue) > pattern.limit:
                                 isBanned = True
                                 uid = random.randint(0,1000000)
-                                reason = '%s - matches #%s in %s' % (uid,pattern.uid,channel)
-                                log = 'BAD: [%s] %s (matches #%s - %s)' % (channel,msg.prefix,pattern.uid,uid)
-                                self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
-                                i.count(self.getDb(irc.network),pattern.uid)
+                                reason = '%s - matches #%s (%s/%ss) in %s' % (uid,pattern.uid,pattern.limit,pattern.life,channel)
+                                log = 'BAD: [%s] %s (matches #%s %s/%ss - %s)' % (channel,msg.prefix,pattern.uid,pattern.limit,pattern.life,uid)
+                                self.ban(irc,msg.nick,msg.prefix,mask,settings['klineDuration'],reason,settings['klineMessage'],log,killReason)
+                                self.rmIrcQueueFor(irc,mask)
+                                i.count(self.getDb(irc.network),pattern.uid,settings['patternCountPermit'])
                                 chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
                                 self.isAbuseOnChannel(irc,channel,'pattern',mask)
+                                self.metrics.inc('sigyn_detections_total',(('kind','pattern'),))
                                 self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                                 break
-                            else:
-                                queue = self.getIrcQueueFor(irc,mask,pattern.uid,pattern.life)
-                                queue.enqueue(text)
-                                if len(queue) > pattern.limit:
-                                    isBanned = True
-                                    uid = random.randint(0,1000000)
-                                    reason = '%s - matches #%s (%s/%ss) in %s' % (uid,pattern.uid,pattern.limit,pattern.life,channel)
-                                    log = 'BAD: [%s] %s (matches #%s %s/%ss - %s)' % (channel,msg.prefix,pattern.uid,pattern.limit,pattern.life,uid)
-                                    self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
-                                    self.rmIrcQueueFor(irc,mask)
-                                    i.count(self.getDb(irc.network),pattern.uid)
-                                    chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
-                                    self.isAbuseOnChannel(irc,channel,'pattern',mask)
-                                    self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
-                                    break
-                                i.count(self.getDb(irc.network),pattern.uid)
+                            i.count(self.getDb(irc.network),pattern.uid,settings['patternCountPermit'])
+                    if timer:
+                        timer.lap('pattern')
                 if isBanned:
                     continue
-                if i.defcon and self.isChannelUniSpam(irc,msg,channel,mask,text):
+                if i.defcon and self.isChannelUniSpam(irc,msg,channel,mask,message):
                     isBanned = True
                     uid = random.randint(0,1000000)
                     reason = '!dnsbl UniSpam'
                     log = 'BAD: [%s] %s (%s - %s)' % (channel,msg.prefix,reason,uid)
                     chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
                     reason = '%s - %s' % (uid,reason)
-                    self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
+                    self.ban(irc,msg.nick,msg.prefix,mask,settings['klineDuration'],reason,settings['klineMessage'],log,killReason)
                     self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                     i.defcon = time.time()
                 if isBanned:
                     continue
-                ignoreDuration = self.registryValue('ignoreDuration',channel=channel)
+                ignoreDuration = settings['ignoreDuration']
                 if not msg.nick in chan.nicks:
                     t = time.time()
                     if isCloaked(msg.prefix,self):
                         t = t - ignoreDuration - 1
-                    chan.nicks[msg.nick] = [t,msg.prefix,mask]
+                    i.track(chan,msg.nick,msg.prefix,mask,t)
                 isIgnored = False
                 if ignoreDuration > 0:
-                    ts = chan.nicks[msg.nick][0]
+                    ts = chan.nicks[msg.nick].joined(channel)
                     if time.time()-ts > ignoreDuration:
                         isIgnored = True
                 reason = ''
                 publicreason = ''
-                if self.registryValue('joinSpamPartPermit',channel=channel) > -1:
+                if settings['joinSpamPartPermit'] > -1:
                     kind = 'joinSpamPart'
-                    life = self.registryValue('joinSpamPartLife',channel=channel)
+                    life = settings['joinSpamPartLife']
                     key = mask
                     isNew = False
                     if not kind in chan.buffers:
                         chan.buffers[kind] = {}
                     if not key in chan.buffers[kind]:
                         isNew = True
-                        chan.buffers[kind][key] = utils.structures.TimeoutQueue(life)
+                        self.addWindow(i,chan.buffers[kind],key,life,chan.buffers,kind)
                     elif chan.buffers[kind][key].timeout != life:
                         chan.buffers[kind][key].setTimeout(life)
                     chan.buffers[kind][key].enqueue(key)
-                    if not isIgnored and isNew and len(chan.buffers[kind][key]) == 1 and text.startswith('http') and time.time()-chan.nicks[msg.nick][0] < 15 and 'z' in irc.state.channels[channel].modes and channel == '#freenode':
+                    if not isIgnored and isNew and len(chan.buffers[kind][key]) == 1 and text.startswith('http') and time.time()-chan.nicks[msg.nick].joined(channel) < 15 and 'z' in irc.state.channels[channel].modes and channel == '#freenode':
                         publicreason = 'link spam once joined'
                         reason = 'linkspam'
+                if timer:
+                    timer.reset()
                 badunicode = False
-                flag = ircdb.makeChannelCapability(channel,'badunicode')
-                if ircdb.checkCapability(msg.prefix,flag):
-                    badunicode = self.isChannelUnicode(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['badunicode']:
+                    badunicode = self.isChannelUnicode(irc,msg,channel,mask,message)
                     if badunicode and self.hasAbuseOnChannel(irc,channel,'badunicode'):
                         isIgnored = False
                     if badunicode:
                         publicreason = 'unreadable unicode glyphes'
                         reason = badunicode
+                    if timer:
+                        timer.lap('badunicode')
                 hilight = False
-                flag = ircdb.makeChannelCapability(channel, 'hilight')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    hilight = self.isChannelHilight(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['hilight']:
+                    hilight = self.isChannelHilight(irc,msg,channel,mask,message)
                     if hilight and self.hasAbuseOnChannel(irc,channel,'hilight'):
                         isIgnored = False
                     if hilight:
                          publicreason = 'nicks/hilight spam'
                          reason = hilight
-                if chan.patterns and not len(reason):
-                    for pattern in chan.patterns:
-                        if pattern in text:
+                    if timer:
+                        timer.lap('hilight')
+                stores = self.getChannelPatterns(irc,channel)
+                if len(stores) and not len(reason):
+                    for patterns in stores:
+                        pattern = patterns.search(text,settings['computedPatternLife'])
+                        if pattern is not None:
                             isIgnored = False
                             reason = 'matches tmp pattern in %s' % channel
                             publicreason = 'your sentence matches temporary blacklisted words'
-                            chan.patterns.enqueue(pattern)
+                            patterns.enqueue(pattern)
                             self.isAbuseOnChannel(irc,channel,'pattern',mask)
+                            self.metrics.inc('sigyn_detections_total',(('kind','tmpPattern'),))
                             break
+                    if timer:
+                        timer.lap('tmpPattern')
                 massrepeat = False
-                flag = ircdb.makeChannelCapability(channel, 'massRepeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    massrepeat = self.isChannelMassRepeat(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['massRepeat']:
+                    massrepeat = self.isChannelMassRepeat(irc,msg,channel,mask,message)
                     if massrepeat and self.hasAbuseOnChannel(irc,channel,'massRepeat'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('massRepeat')
                 lowmassrepeat = False
-                flag = ircdb.makeChannelCapability(channel, 'lowMassRepeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowmassrepeat = self.isChannelLowMassRepeat(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['lowMassRepeat']:
+                    lowmassrepeat = self.isChannelLowMassRepeat(irc,msg,channel,mask,message)
                     if lowmassrepeat and self.hasAbuseOnChannel(irc,channel,'lowMassRepeat'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('lowMassRepeat')
                 repeat = False
-                flag = ircdb.makeChannelCapability(channel, 'repeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    repeat = self.isChannelRepeat(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['repeat']:
+                    repeat = self.isChannelRepeat(irc,msg,channel,mask,message)
                     if repeat and self.hasAbuseOnChannel(irc,channel,'repeat'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('repeat')
                 lowrepeat = False
-                flag = ircdb.makeChannelCapability(channel, 'lowRepeat')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowrepeat = self.isChannelLowRepeat(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['lowRepeat']:
+                    lowrepeat = self.isChannelLowRepeat(irc,msg,channel,mask,message)
                     if lowrepeat and self.hasAbuseOnChannel(irc,channel,'lowRepeat'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('lowRepeat')
                 lowhilight = False
-                flag = ircdb.makeChannelCapability(channel, 'lowHilight')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowhilight = self.isChannelLowHilight(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['lowHilight']:
+                    lowhilight = self.isChannelLowHilight(irc,msg,channel,mask,message)
                     if lowhilight and self.hasAbuseOnChannel(irc,channel,'lowHilight'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('lowHilight')
                 flood = False
-                flag = ircdb.makeChannelCapability(channel, 'flood')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    flood = self.isChannelFlood(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['flood']:
+                    flood = self.isChannelFlood(irc,msg,channel,mask,message)
                     if flood and self.hasAbuseOnChannel(irc,channel,'flood'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('flood')
                 lowflood = False
-                flag = ircdb.makeChannelCapability(channel, 'lowFlood')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    lowflood = self.isChannelLowFlood(irc,msg,channel,mask,text)
+                if capabilities & capabilityBits['lowFlood']:
+                    lowflood = self.isChannelLowFlood(irc,msg,channel,mask,message)
                     if lowflood and self.hasAbuseOnChannel(irc,channel,'lowFlood'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('lowFlood')
                 ctcp = False
-                flag = ircdb.makeChannelCapability(channel, 'ctcp')
-                if ircdb.checkCapability(msg.prefix, flag):
+                if capabilities & capabilityBits['ctcp']:
                     if not ircmsgs.isAction(msg) and ircmsgs.isCtcp(msg):
-                        ctcp = self.isChannelCtcp(irc,msg,channel,mask,text)
+                        ctcp = self.isChannelCtcp(irc,msg,channel,mask,message)
                     if ctcp and self.hasAbuseOnChannel(irc,channel,'ctcp'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('ctcp')
                 notice = False
-                flag = ircdb.makeChannelCapability(channel, 'notice')
-                if ircdb.checkCapability(msg.prefix, flag):
+                if capabilities & capabilityBits['notice']:
                     if not ircmsgs.isAction(msg) and isNotice:
-                        notice = self.isChannelNotice(irc,msg,channel,mask,text)
+                        notice = self.isChannelNotice(irc,msg,channel,mask,message)
                     if notice and self.hasAbuseOnChannel(irc,channel,'notice'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('notice')
                 cap = False
-                flag = ircdb.makeChannelCapability(channel, 'cap')
-                if ircdb.checkCapability(msg.prefix, flag):
-                    cap = self.isChannelCap(irc,msg,channel,mask,raw)
+                if capabilities & capabilityBits['cap']:
+                    cap = self.isChannelCap(irc,msg,channel,mask,message)
                     if cap and self.hasAbuseOnChannel(irc,channel,'cap'):
                         isIgnored = False
+                    if timer:
+                        timer.lap('cap')
                 if not reason:
                     if massrepeat:
                         reason = massrepeat
@@ -2229,12 +3975,12 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             log = 'BAD: [%s] %s (%s - %s)' % (channel,msg.prefix,reason,uid)
                             chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
                             reason = '%s - %s' % (uid,reason)
-                            self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
+                            self.ban(irc,msg.nick,msg.prefix,mask,settings['klineDuration'],reason,settings['klineMessage'],log,killReason)
                             self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                             if i.defcon:
                                 i.defcon = time.time()
                         else:
-                            q = self.getIrcQueueFor(irc,mask,'warned-%s' % channel,self.registryValue('alertPeriod'))
+                            q = self.getIrcQueueFor(irc,mask,'warned-%s' % channel,settings['alertPeriod'])
                             if len(q) == 0:
                                 q.enqueue(text)
                                 self.logChannel(irc,'IGNORED: [%s] %s (%s)' % (channel,msg.prefix,reason))
@@ -2247,14 +3993,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         log = 'BAD: [%s] %s (%s - %s)' % (channel,msg.prefix,reason,uid)
                         chan.klines.enqueue('%s %s' % (msg.nick.lower(),mask))
                         reason = '%s - %s' % (uid,reason)
-                        self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
+                        self.ban(irc,msg.nick,msg.prefix,mask,settings['klineDuration'],reason,settings['klineMessage'],log,killReason)
                         if i.defcon:
                             i.defcon = time.time()
                         if chan.called:
                             chan.called = time.time()
-                        if i.lastDefcon and time.time()-i.lastDefcon < self.registryValue('alertPeriod') and not i.defcon:
-                            self.logChannel(irc,"INFO: ignores lifted and abuses end to klines for %ss due to abuses in %s after lastest defcon %s" % (self.registryValue('defcon')*2,channel,i.lastDefcon))
-                            i.defcon = time.time() + (self.registryValue('defcon')*2)
+                        if i.lastDefcon and time.time()-i.lastDefcon < settings['alertPeriod'] and not i.defcon:
+                            self.logChannel(irc,"INFO: ignores lifted and abuses end to klines for %ss due to abuses in %s after lastest defcon %s" % (settings['defcon']*2,channel,i.lastDefcon))
+                            i.defcon = time.time() + (settings['defcon']*2)
                             if not i.god:
                                 irc.sendMsg(ircmsgs.IrcMsg('MODE %s +p' % irc.nick))
                             else:
@@ -2262,32 +4008,39 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         ip = mask.split('@')[1]
                         if hilight and i.defcon:
                             if utils.net.bruteIsIPV6(ip) or utils.net.isIPV4(ip):
-                                if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                                    t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),reason))
-                                    t.setDaemon(True)
-                                    t.start()
+                                if len(settings['droneblKey']) and len(settings['droneblHost']) and settings['enable']:
+                                    self.fillDnsbl(irc,ip,settings['droneblHost'],settings['droneblKey'],reason)
                         self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
 
                 if not isBanned:
-                    mini = self.registryValue('amsgMinimum')
-                    if len(text) > mini or text.find('http') != -1:
-                        limit = self.registryValue('amsgPermit')
+                    if timer:
+                        timer.reset()
+                    mini = settings['amsgMinimum']
+                    if len(text) > mini or message.url:
+                        limit = settings['amsgPermit']
                         if limit > -1:
-                            life = self.registryValue('amsgLife')
-                            percent = self.registryValue('amsgPercent')
-                            queue = self.getIrcQueueFor(irc,mask,channel,life)
-                            queue.enqueue(text)
+                            life = settings['amsgLife']
+                            percent = settings['amsgPercent']
+                            fp = message.fingerprint
+                            size = len(fp)
+                            # messages of mask on the network, bucketed by fingerprint size
                             found = None
-                            for ch in i.channels:
-                                chc = self.getChan(irc,ch)
-                                if msg.nick in chc.nicks and ch != channel:
-                                    queue = self.getIrcQueueFor(irc,mask,ch,life)
-                                    for m in queue:
-                                        if compareString(m,text) > percent:
+                            channels = i.nickchannels.get(msg.nick,())
+                            if mask in i.amsg:
+                                buckets = i.amsg[mask]
+                                for n in similarSizes(size,percent,max(buckets,default=0)):
+                                    queue = buckets.get(n)
+                                    if queue is None:
+                                        continue
+                                    for (ch,m,fm) in queue:
+                                        if ch != channel and ch in channels and msg.nick in i.channels[ch].nicks and compareString(m,text,fm,fp) > percent:
                                             found = ch
                                             break
                                     if found:
                                         break
+                            self.getAmsgQueueFor(irc,mask,size,life).enqueue((channel,text,fp))
+                            if timer:
+                                timer.lap('amsg')
                             if found:
                                 queue = self.getIrcQueueFor(irc,mask,'amsg',life)
                                 flag = False
@@ -2301,19 +4054,14 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     chs = list(queue)
                                     queue.reset()
                                     key = 'amsg %s' % mask
-                                    q = self.getIrcQueueFor(irc,key,'amsg',self.registryValue('alertPeriod'))
+                                    q = self.getIrcQueueFor(irc,key,'amsg',settings['alertPeriod'])
                                     if len(q) == 0:
                                         q.enqueue(mask)
                                         chs.append(channel)
+                                        self.metrics.inc('sigyn_detections_total',(('kind','amsg'),))
                                         self.logChannel(irc,'AMSG: %s (%s) in %s' % (msg.nick,text,', '.join(chs)))
-                                        for channel in i.channels:
-                                            chan = self.getChan(irc,channel)
-                                            life = self.registryValue('computedPatternLife',channel=channel)
-                                            if not chan.patterns:
-                                                chan.patterns = utils.structures.TimeoutQueue(life)
-                                            elif chan.patterns.timeout != life:
-                                                chan.patterns.setTimeout(life)
-                                            chan.patterns.enqueue(text.lower())
+                                        for patterns in self.getAllPatterns(irc):
+                                            patterns.enqueue(text.lower())
 
     def handleSecretMessage (self,irc,msg):
         (targets, text) = msg.args
@@ -2334,9 +4082,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         ip = a.split('@')[1]
                         if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
                             if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                                t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),found))
-                                t.setDaemon(True)
-                                t.start()
+                                self.fillDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),found)
                             else:
                                 self.prefixToMask(irc,'*!*@%s' % ip,'',True)
             if text.startswith('sendemail():') and self.registryValue('registerPermit') > 0:
@@ -2452,9 +4198,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         ip = a.split('@')[1]
                         if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
                             if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                                t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),found))
-                                t.setDaemon(True)
-                                t.start()
+                                self.fillDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),found)
                         else:
                             self.prefixToMask(irc,'*!*@%s' % ip,'',True,found)
 
@@ -2474,28 +4218,26 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     channel = channel.replace('+','',1)
                 if not irc.isChannel(channel) and channel == irc.nick:
                     killReason = self.registryValue('killMessage',channel=channel)
-                    for k in i.patterns:
-                        pattern = i.patterns[k]
-                        if pattern.match(text):
-                            if pattern.limit == 0:
+                    for pattern in i.match(text):
+                        if pattern.limit == 0:
+                            uid = random.randint(0,1000000)
+                            reason = '%s - matches #%s in pm' % (pattern.uid,uid)
+                            log = 'BAD: [%s] %s (matches #%s - %s)' % (channel,msg.prefix,pattern.uid,uid)
+                            self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
+                            i.count(self.getDb(irc.network),pattern.uid,self.registryValue('patternCountPermit'))
+                            break
+                        else:
+                            queue = self.getIrcQueueFor(irc,mask,pattern.uid,pattern.life)
+                            queue.enqueue(text)
+                            if len(queue) > pattern.limit:
                                 uid = random.randint(0,1000000)
-                                reason = '%s - matches #%s in pm' % (pattern.uid,uid)
-                                log = 'BAD: [%s] %s (matches #%s - %s)' % (channel,msg.prefix,pattern.uid,uid)
+                                reason = '%s - matches #%s (%s/%ss) in pm' % (pattern.uid,pattern.limit,pattern.life,uid)
+                                log = 'BAD: [%s] %s (matches #%s %s/%ss - %s)' % (channel,msg.prefix,pattern.uid,pattern.limit,pattern.life,uid)
                                 self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
-                                i.count(self.getDb(irc.network),pattern.uid)
+                                self.rmIrcQueueFor(irc,mask)
+                                i.count(self.getDb(irc.network),pattern.uid,self.registryValue('patternCountPermit'))
                                 break
-                            else:
-                                queue = self.getIrcQueueFor(irc,mask,pattern.uid,pattern.life)
-                                queue.enqueue(text)
-                                if len(queue) > pattern.limit:
-                                    uid = random.randint(0,1000000)
-                                    reason = '%s - matches #%s (%s/%ss) in pm' % (pattern.uid,pattern.limit,pattern.life,uid)
-                                    log = 'BAD: [%s] %s (matches #%s %s/%ss - %s)' % (channel,msg.prefix,pattern.uid,pattern.limit,pattern.life,uid)
-                                    self.ban(irc,msg.nick,msg.prefix,mask,self.registryValue('klineDuration'),reason,self.registryValue('klineMessage'),log,killReason)
-                                    self.rmIrcQueueFor(irc,mask)
-                                    i.count(self.getDb(irc.network),pattern.uid)
-                                    break
-                                i.count(self.getDb(irc.network),pattern.uid)
+                            i.count(self.getDb(irc.network),pattern.uid,self.registryValue('patternCountPermit'))
         except:
             return
 
@@ -2695,6 +4437,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if user in i.queues:
                         if key in i.queues[user]:
                             del i.queues[user][key]
+                            if not len(i.queues[user]):
+                                del i.queues[user]
                 i.queues[user][key] = time.time()
                 schedule.addEvent(rcu,time.time()+self.registryValue('abuseLife'))
         if key in i.queues[user]:
@@ -2725,6 +4469,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if target in i.queues:
                     if key in i.queues[target]:
                         del i.queues[target][key]
+                        if not len(i.queues[target]):
+                            del i.queues[target]
             i.queues[target][key] = time.time()
             schedule.addEvent(rct,time.time()+self.registryValue('abuseLife'))
         if key in i.queues[target]:
@@ -2764,14 +4510,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         permit = self.registryValue('alertOnWideKline')
         found = ''
         if not i.lastKlineOper.find('freenode/staff/') == -1:
-            for channel in i.channels:
-                chan = i.channels[channel]
-                ns = []
-                if nick in chan.nicks:
-                    if len(chan.nicks[nick]) == 5:
-                        if chan.nicks[nick][4] and chan.nicks[nick][1] == user:
-                            found = chan.nicks[nick][4]
-                            break
+            if nick in i.users:
+                if i.users[nick].account and i.users[nick].prefix == user:
+                    found = i.users[nick].account
         if found:
             self.log.info ('Account klined %s --> %s' % (found,user))
         if permit > -1:
@@ -2925,14 +4666,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                         reason = hasPattern
                     if utils.net.isIPV4(ip) or utils.net.bruteIsIPV6(ip):
                         if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                            t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),reason))
-                            t.setDaemon(True)
-                            t.start()
+                            self.fillDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),reason)
                     else:
                         if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                            t = world.SupyThread(target=self.resolve,name=format('resolve %s', '*!*@%s' % ip),args=(irc,'*!*@%s' % ip,'',True, reason))
-                            t.setDaemon(True)
-                            t.start()
+                            self.resolve(irc,'*!*@%s' % ip,'',True,reason)
                         else:
                             self.prefixToMask(irc,'*!*@%s' % ip,'',True,reason)
             elif 'failed login attempts to' in text and 'SASL' in text:
@@ -2948,9 +4685,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             if len(q) > self.registryValue('serverFilteringPermit'):
                                 self.ipfiltered[ip] = True
                                 if len(self.registryValue('droneblKey')) and len(self.registryValue('droneblHost')) and self.registryValue('enable'):
-                                    t = world.SupyThread(target=self.fillDnsbl,name=format('fillDnsbl %s', ip),args=(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),reason))
-                                    t.setDaemon(True)
-                                    t.start()
+                                    self.fillDnsbl(irc,ip,self.registryValue('droneblHost'),self.registryValue('droneblKey'),reason)
         else:
             self.handleMsg(irc,msg,True)
 
@@ -3011,9 +4746,10 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         return False
 
     def hasAbuseOnChannel (self,irc,channel,key):
+        settings = self.getSettings(channel)
         chan = self.getChan(irc,channel)
         kind = 'abuse'
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = settings['%sPermit' % kind]
         if kind in chan.buffers:
             if key in chan.buffers[kind]:
                 if len(chan.buffers[kind][key]) > limit:
@@ -3021,16 +4757,17 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         return False
 
     def isAbuseOnChannel (self,irc,channel,key,mask):
+        settings = self.getSettings(channel)
         chan = self.getChan(irc,channel)
         kind = 'abuse'
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = settings['%sPermit' % kind]
         if limit < 0:
             return False
-        life = self.registryValue('%sLife' % kind,channel=channel)
+        life = settings['%sLife' % kind]
         if not kind in chan.buffers:
             chan.buffers[kind] = {}
         if not key in chan.buffers[kind]:
-            chan.buffers[kind][key] = utils.structures.TimeoutQueue(life)
+            self.addWindow(self.getIrc(irc),chan.buffers[kind],key,life,chan.buffers,kind)
         elif chan.buffers[kind][key].timeout != life:
             chan.buffers[kind][key].setTimeout(life)
         found = False
@@ -3051,7 +4788,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             # queue not reseted, that way during life, it returns True
             if not chan.called:
                 if not i.defcon:
-                    self.logChannel(irc,"INFO: [%s] ignores lifted, limits lowered due to %s abuses for %ss" % (channel,key,self.registryValue('abuseDuration',channel=channel)))
+                    self.logChannel(irc,"INFO: [%s] ignores lifted, limits lowered due to %s abuses for %ss" % (channel,key,settings['abuseDuration']))
                 if not i.defcon:
                     i.defcon = time.time()
                     if not i.god:
@@ -3063,8 +4800,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         return False
 
     def isBadOnChannel (self,irc,channel,kind,key):
+        settings = self.getSettings(channel)
         chan = self.getChan(irc,channel)
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = settings['%sPermit' % kind]
         if limit < 0:
             return False
         i = self.getIrc(irc)
@@ -3072,19 +4810,20 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             kinds = ['flood','lowFlood','nick','lowRepeat','lowMassRepeat','broken']
             if kind in kinds:
                 return False
-        life = self.registryValue('%sLife' % kind,channel=channel)
+        life = settings['%sLife' % kind]
         if limit == 0:
+            self.metrics.inc('sigyn_detections_total',(('kind',kind),))
             return '%s %s/%ss in %s' % (kind,limit,life,channel)
         if not kind in chan.buffers:
             chan.buffers[kind] = {}
         newUser = False
         if not key in chan.buffers[kind]:
             newUser = True
-            chan.buffers[kind][key] = utils.structures.TimeoutQueue(life)
+            self.addWindow(i,chan.buffers[kind],key,life,chan.buffers,kind)
             chan.buffers[kind]['%s-creation' % key] = time.time()
         elif chan.buffers[kind][key].timeout != life:
             chan.buffers[kind][key].setTimeout(life)
-        ignore = self.registryValue('ignoreDuration',channel=channel)
+        ignore = settings['ignoreDuration']
         if ignore > 0:
            if time.time() - chan.buffers[kind]['%s-creation' % key] < ignore:
                newUser = True
@@ -3097,6 +4836,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             chan.buffers[kind][key].reset()
             if not kind == 'broken':
                 self.isAbuseOnChannel(irc,channel,kind,key)
+            self.metrics.inc('sigyn_detections_total',(('kind',kind),))
             return '%s %s/%ss in %s' % (kind,limit,life,channel)
         return False
 
@@ -3108,113 +4848,102 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             return False;
         return len(chan.buffers[kind][key]) > 0
 
-    def isChannelUniSpam (self,irc,msg,channel,mask,text):
-        count = len([char for char in text if char in self.spamchars])
-        return len(text) < 32 and count >=3
+    def isChannelUniSpam (self,irc,msg,channel,mask,message):
+        return len(message.text) < 32 and message.spam >=3
 
-    def isChannelCtcp (self,irc,msg,channel,mask,text):
+    def isChannelCtcp (self,irc,msg,channel,mask,message):
         return self.isBadOnChannel(irc,channel,'ctcp',mask)
 
-    def isChannelNotice (self,irc,msg,channel,mask,text):
+    def isChannelNotice (self,irc,msg,channel,mask,message):
         return self.isBadOnChannel(irc,channel,'notice',mask)
 
-    def isChannelLowFlood (self,irc,msg,channel,mask,text):
+    def isChannelLowFlood (self,irc,msg,channel,mask,message):
         return self.isBadOnChannel(irc,channel,'lowFlood',mask)
 
-    def isChannelCap (self,irc,msg,channel,mask,text):
-        text = text.replace(' ','')
-        if len(text) == 0 or len(text) > self.registryValue('capMinimum',channel=channel):
-            limit = self.registryValue('capPermit',channel=channel)
+    def isChannelCap (self,irc,msg,channel,mask,message):
+        settings = self.getSettings(channel)
+        if message.letters == 0 or message.letters > settings['capMinimum']:
+            limit = settings['capPermit']
             if limit < 0:
                 return False
-            trigger = self.registryValue('capPercent',channel=channel)
-            matchs = self.recaps.findall(text)
-            #self.log.info ('%s : %s : %s :%s' % (mask,channel,text,len(matchs)))
-            if len(matchs) and len(text):
-                percent = (len(matchs)*100) / (len(text) * 1.0)
-                #self.log.info ('%s: %s/%s %s' % (mask,percent,trigger,text))
-                if percent >= trigger:
-                    return self.isBadOnChannel(irc,channel,'cap',mask)
+            trigger = settings['capPercent']
+            #self.log.info ('%s: %s/%s %s' % (mask,message.caps,trigger,message.raw))
+            if message.caps and message.caps >= trigger:
+                return self.isBadOnChannel(irc,channel,'cap',mask)
         return False
 
-    def isChannelFlood (self,irc,msg,channel,mask,text):
-        if len(text) == 0 or len(text) >= self.registryValue('floodMinimum',channel=channel) or text.isdigit():
+    def isChannelFlood (self,irc,msg,channel,mask,message):
+        settings = self.getSettings(channel)
+        text = message.text
+        if len(text) == 0 or len(text) >= settings['floodMinimum'] or text.isdigit():
             return self.isBadOnChannel(irc,channel,'flood',mask)
         return False
 
-    def isChannelHilight (self,irc,msg,channel,mask,text):
-        return self.isHilight(irc,msg,channel,mask,text,False)
+    def isChannelHilight (self,irc,msg,channel,mask,message):
+        return self.isHilight(irc,msg,channel,mask,message,False)
 
-    def isChannelLowHilight (self,irc,msg,channel,mask,text):
-        return self.isHilight(irc,msg,channel,mask,text,True)
+    def isChannelLowHilight (self,irc,msg,channel,mask,message):
+        return self.isHilight(irc,msg,channel,mask,message,True)
 
-    def isChannelUnicode (self,irc,msg,channel,mask,text):
-        limit = self.registryValue('badunicodeLimit',channel=channel)
+    def isChannelUnicode (self,irc,msg,channel,mask,message):
+        settings = self.getSettings(channel)
+        limit = settings['badunicodeLimit']
         if limit > 0:
-            score = sequence_weirdness(u'%s' % text)
-            count = self.registryValue('badunicodeScore',channel=channel)
+            score = weirdness(u'%s' % message.text)
+            count = settings['badunicodeScore']
             if count < score:
                 return self.isBadOnChannel(irc,channel,'badunicode',mask)
         return False
 
-    def isHilight (self,irc,msg,channel,mask,text,low):
+    def isHilight (self,irc,msg,channel,mask,message,low):
+        settings = self.getSettings(channel)
         kind = 'hilight'
         if low:
             kind = 'lowHilight'
-        limit = self.registryValue('%sNick' % kind,channel=channel)
+        limit = settings['%sNick' % kind]
         if limit < 0:
             return False
-        count = 0
-        users = []
-        if channel in irc.state.channels and irc.isChannel(channel):
-            for u in list(irc.state.channels[channel].users):
-                if u == 'ChanServ' or u == msg.nick:
-                    continue
-                users.append(u.lower())
         flag = False
-        us = {}
-        for user in users:
-            if len(user) > 3:
-                if not user in us and user in text:
-                    us[user] = True
-                    count = count + 1
-                    if count > limit:
-                        flag = True
-                        break
+        if channel in irc.state.channels and irc.isChannel(channel):
+            chan = self.getChan(irc,channel)
+            flag = chan.hilights.count(message.text,msg.nick,limit,message.words) > limit
         result = False
         if flag:
             result = self.isBadOnChannel(irc,channel,kind,mask)
         return result
 
-    def isChannelRepeat (self,irc,msg,channel,mask,text):
-        return self.isRepeat(irc,msg,channel,mask,text,False)
+    def isChannelRepeat (self,irc,msg,channel,mask,message):
+        return self.isRepeat(irc,msg,channel,mask,message,False)
 
-    def isChannelLowRepeat (self,irc,msg,channel,mask,text):
-        return self.isRepeat(irc,msg,channel,mask,text,True)
+    def isChannelLowRepeat (self,irc,msg,channel,mask,message):
+        return self.isRepeat(irc,msg,channel,mask,message,True)
 
-    def isRepeat(self,irc,msg,channel,mask,text,low):
+    def isRepeat(self,irc,msg,channel,mask,message,low):
+        settings = self.getSettings(channel)
+        text = message.text
         kind = 'repeat'
         key = mask
         if low:
             kind = 'lowRepeat'
             key = 'low_repeat %s' % mask
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = settings['%sPermit' % kind]
         if limit < 0:
             return False
-        if len(text) < self.registryValue('%sMinimum' % kind,channel=channel):
+        if len(text) < settings['%sMinimum' % kind]:
             return False
         chan = self.getChan(irc,channel)
-        life = self.registryValue('%sLife'  % kind,channel=channel)
-        trigger = self.registryValue('%sPercent' % kind,channel=channel)
+        life = settings['%sLife'  % kind]
+        trigger = settings['%sPercent' % kind]
         if not key in chan.logs:
-            chan.logs[key] = utils.structures.TimeoutQueue(life)
+            self.addWindow(self.getIrc(irc),chan.logs,key,life)
         elif chan.logs[key].timeout != life:
             chan.logs[key].setTimeout(life)
         logs = chan.logs[key]
         flag = False
         result = False
-        for m in logs:
-            if compareString(m,text) > trigger:
+        fp = message.fingerprint
+        for (m,fm) in logs:
+            if compareString(m,text,fm,fp) > trigger:
                 flag = True
                 break
         if flag:
@@ -3227,19 +4956,16 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if len(chan.buffers[kind][key])/(limit * 1.0) > 0.55:
                     enough = True
         if result or enough:
-            life = self.registryValue('computedPatternLife',channel=channel)
-            if not chan.patterns:
-                chan.patterns = utils.structures.TimeoutQueue(life)
-            elif chan.patterns.timeout != life:
-                chan.patterns.setTimeout(life)
-            if self.registryValue('computedPattern',channel=channel) > -1 and len(text) > self.registryValue('computedPattern',channel=channel):
+            life = settings['computedPatternLife']
+            tmp = self.getPatterns(irc,channel)
+            if settings['computedPattern'] > -1 and len(text) > settings['computedPattern']:
                 repeats = []
                 if low:
                     pat = ''
-                    for m in logs:
-                        if compareString(m,text) > trigger:
+                    for (m,fm) in logs:
+                        if compareString(m,text,fm,fp) > trigger:
                             p = largestString(m,text)
-                            if len(p) > self.registryValue('computedPattern',channel=channel):
+                            if len(p) > settings['computedPattern']:
                                 if len(p) > len(pat):
                                     pat = p
                     if len(pat):
@@ -3251,142 +4977,109 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 for repeat in repeats:
                     (p,c) = repeat
                     #self.log.debug('%s :: %s' % (p,c))
-                    if len(p) < self.registryValue('%sMinimum' % kind, channel=channel):
+                    if len(p) < settings['%sMinimum' % kind]:
                         continue
                     p = p.strip()
                     if p in patterns:
                         patterns[p] += c
                     else:
                         patterns[p] = c
-                    if len(p) > self.registryValue('computedPattern',channel=channel):
+                    if len(p) > settings['computedPattern']:
                         if len(p) > len(candidate):
                             candidate = p
-                    elif len(p) * c > self.registryValue('computedPattern',channel=channel):
+                    elif len(p) * c > settings['computedPattern']:
                         tentative = ''.join(list((p,) * int(c)))
                         if not tentative in text:
                             tentative = ''.join(list(((p + ' '),) * int(c)))
                             if not tentative in text:
                                 tentative = ''
                         if len(tentative):
-                            tentative = tentative[:self.registryValue('computedPattern',channel=channel)]
+                            tentative = tentative[:settings['computedPattern']]
                         if len(tentative) > len(candidate):
                             candidate = tentative
-                    elif patterns[p] > self.registryValue('%sCount' % kind,channel=channel):
+                    elif patterns[p] > settings['%sCount' % kind]:
                         if len(p) > len(candidate):
                             candidate = p
                 if candidate.strip() == channel:
                     self.log.debug('pattern candidate %s discared in %s' % (candidate,channel))
                     candidate = ''
-                if len(candidate) and len(candidate) > self.registryValue('%sMinimum' % kind, channel=channel):
-                    found = False
-                    for p in chan.patterns:
-                        if p in candidate:
-                            found = True
-                            break
+                if len(candidate) and len(candidate) > settings['%sMinimum' % kind]:
+                    found = tmp.search(candidate,life) is not None
                     if not found:
                         candidate = candidate.strip()
-                        shareID = self.registryValue('shareComputedPatternID',channel=channel)
+                        shareID = settings['shareComputedPatternID']
                         i = self.getIrc(irc)
-                        if shareID != -1 or i.defcon:
+                        if shareID != -1:
+                            tmp.enqueue(candidate)
+                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" in %s channels (%s)' % (channel,mask,candidate,len(tmp.channels),kind))
+                        elif i.defcon:
                             nb = 0
-                            for chan in i.channels:
-                                ch = i.channels[chan]
-                                life = self.registryValue('computedPatternLife',channel=chan)
-                                if shareID != self.registryValue('shareComputedPatternID',channel=chan):
+                            for ch in i.channels:
+                                if self.getSettings(ch)['shareComputedPatternID'] != -1:
                                     continue
-                                if not ch.patterns:
-                                    ch.patterns = utils.structures.TimeoutQueue(life)
-                                elif ch.patterns.timeout != life:
-                                    ch.patterns.setTimeout(life)
-                                ch.patterns.enqueue(candidate)
+                                self.getPatterns(irc,ch).enqueue(candidate)
                                 nb = nb + 1
                             self.logChannel(irc,'PATTERN: [%s] %s added "%s" in %s channels (%s)' % (channel,mask,candidate,nb,kind))
                         else:
-                            chan.patterns.enqueue(candidate)
-                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,candidate,self.registryValue('computedPatternLife',channel=channel),kind))
-        logs.enqueue(text)
+                            tmp.enqueue(candidate)
+                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,candidate,settings['computedPatternLife'],kind))
+        logs.enqueue((text,fp))
         return result
 
-    def isChannelMassRepeat (self,irc,msg,channel,mask,text):
-        return self.isMassRepeat(irc,msg,channel,mask,text,False)
+    def isChannelMassRepeat (self,irc,msg,channel,mask,message):
+        return self.isMassRepeat(irc,msg,channel,mask,message,False)
 
-    def isChannelLowMassRepeat (self,irc,msg,channel,mask,text):
-        return self.isMassRepeat(irc,msg,channel,mask,text,True)
+    def isChannelLowMassRepeat (self,irc,msg,channel,mask,message):
+        return self.isMassRepeat(irc,msg,channel,mask,message,True)
 
-    def isMassRepeat (self,irc,msg,channel,mask,text,low):
+    def isMassRepeat (self,irc,msg,channel,mask,message,low):
+        settings = self.getSettings(channel)
+        text = message.text
         kind = 'massRepeat'
         key = 'mass Repeat'
         if low:
             kind = 'lowMassRepeat'
             key = 'low mass Repeat'
-        limit = self.registryValue('%sPermit' % kind,channel=channel)
+        limit = settings['%sPermit' % kind]
         if limit < 0:
             return False
-        if len(text) < self.registryValue('%sMinimum' % kind,channel=channel):
+        if len(text) < settings['%sMinimum' % kind]:
             return False
         chan = self.getChan(irc,channel)
-        life = self.registryValue('%sLife' % kind,channel=channel)
-        trigger = self.registryValue('%sPercent' % kind,channel=channel)
-        length = self.registryValue('computedPattern',channel=channel)
+        life = settings['%sLife' % kind]
+        trigger = settings['%sPercent' % kind]
+        length = settings['computedPattern']
         if not key in chan.logs:
-            chan.logs[key] = utils.structures.TimeoutQueue(life)
+            self.addWindow(self.getIrc(irc),chan.logs,key,life,factory=SimilarIndex)
         elif chan.logs[key].timeout != life:
             chan.logs[key].setTimeout(life)
         flag = False
         result = False
         pattern = None
-        s = ''
         logs = chan.logs[key]
-        for m in logs:
-            found = compareString(m,text)
-            if found > trigger:
-                if length > 0:
-                    pattern = largestString(m,text)
-                    if len(pattern) < length:
-                        pattern = None
-                    else:
-                        s = s.strip()
-                        if len(s) > len(pattern):
-                            pattern = s
-                        s = pattern
-                flag = True
-                break
+        fp = message.fingerprint
+        m = logs.similar(text,trigger,fp)
+        if m is not None:
+            if length > 0:
+                pattern = largestString(m,text)
+                if len(pattern) < length:
+                    pattern = None
+            flag = True
         if flag:
             result = self.isBadOnChannel(irc,channel,kind,channel)
             if result and pattern and length > -1:
-                life = self.registryValue('computedPatternLife',channel=channel)
-                if not chan.patterns:
-                    chan.patterns = utils.structures.TimeoutQueue(life)
-                elif chan.patterns.timeout != life:
-                    chan.patterns.setTimeout(life)
+                life = settings['computedPatternLife']
+                tmp = self.getPatterns(irc,channel)
                 if len(pattern) > length:
                     pattern = pattern[:-1]
-                    found = False
-                    for p in chan.patterns:
-                        if p in pattern:
-                            found = True
-                            break
+                    found = tmp.search(pattern,life) is not None
                     if not found:
-                        shareID = self.registryValue('shareComputedPatternID',channel=channel)
-                        if shareID != -1:
-                            nb = 0
-                            i = self.getIrc(irc)
-                            for chan in i.channels:
-                                ch = i.channels[chan]
-                                if shareID != self.registryValue('shareComputedPatternID',channel=chan):
-                                    continue
-                                life = self.registryValue('computedPatternLife',channel=chan)
-                                if not ch.patterns:
-                                    ch.patterns = utils.structures.TimeoutQueue(life)
-                                elif ch.patterns.timeout != life:
-                                    ch.patterns.setTimeout(life)
-                                ch.patterns.enqueue(pattern)
-                                nb = nb + 1
-                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" in %s channels (%s)' % (channel,mask,pattern,nb,kind))
+                        tmp.enqueue(pattern)
+                        if channel in tmp.channels:
+                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" in %s channels (%s)' % (channel,mask,pattern,len(tmp.channels),kind))
                         else:
-                            chan.patterns.enqueue(pattern)
-                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,pattern,self.registryValue('computedPatternLife',channel=channel),kind))
-        logs.enqueue(text)
+                            self.logChannel(irc,'PATTERN: [%s] %s added "%s" for %ss (%s)' % (channel,mask,pattern,settings['computedPatternLife'],kind))
+        logs.add(text,fp)
         if result and pattern:
             return result
         return False
@@ -3441,9 +5134,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         channels = msg.args[0].split(',')
         if not ircutils.isUserHostmask(msg.prefix):
             return
+        i = self.getIrc(irc)
+        for channel in channels:
+            i.enter(channel,(msg.nick,))
         if ircdb.checkCapability(msg.prefix, 'protected'):
             return
-        i = self.getIrc(irc)
         prefix = msg.prefix
         gecos = None
         account = None
@@ -3451,23 +5146,22 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             gecos = msg.args[2]
             account = msg.args[1]
             if account == '*':
-                account = None
+                # logged out
+                account = ''
             else:
                 aa = account.lower()
-                for u in i.klinednicks:
-                    if aa == u:
-                        self.logChannel(irc,"SERVICE: %s (%s) lethaled account (extended-join %s)" % (msg.prefix,account,msg.args[0]))
-                        src = msg.nick
-                        i.klinednicks.enqueue(aa)
-                        if not src in i.tokline:
-                            i.toklineresults[src] = {}
-                            i.toklineresults[src]['kind'] = 'evade'
-                            i.tokline[src] = src
-                            def f ():
-                                irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                            schedule.addEvent(f,time.time()+random.randint(0,7))
-                            #irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
-                        break
+                if aa in i.klinednicks:
+                    self.logChannel(irc,"SERVICE: %s (%s) lethaled account (extended-join %s)" % (msg.prefix,account,msg.args[0]))
+                    src = msg.nick
+                    i.klinednicks.add(aa)
+                    if not src in i.tokline:
+                        i.toklineresults[src] = {}
+                        i.toklineresults[src]['kind'] = 'evade'
+                        i.tokline[src] = src
+                        def f ():
+                            irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
+                        schedule.addEvent(f,time.time()+random.randint(0,7))
+                        #irc.sendMsg(ircmsgs.IrcMsg('WHOIS %s %s' % (src,src)))
         for channel in channels:
             if ircutils.isChannel(channel) and channel in irc.state.channels:
                 if self.registryValue('ignoreChannel',channel):
@@ -3477,7 +5171,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 mask = self.prefixToMask(irc,msg.prefix,channel)
                 if isCloaked(msg.prefix,self) or account:
                     t = t - self.registryValue('ignoreDuration',channel=channel) - 1
-                chan.nicks[msg.nick] = [t,msg.prefix,mask,gecos,account]
+                i.track(chan,msg.nick,msg.prefix,mask,t,gecos,account)
                 if self.registryValue('ignoreRegisteredUser',channel=channel):
                     if account:
                         continue
@@ -3575,9 +5269,11 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if ircutils.isChannel(channel):
                     self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                     self.logChannel(irc,'PART: [%s] %s' % (channel,reason))
-                    if channel in i.channels:
-                        del i.channels[channel]
+                    i.part(channel)
             return
+        for channel in channels:
+            i.leave(channel,msg.nick)
+        i.depart(msg.nick)
         mask = self.prefixToMask(irc,msg.prefix)
         isBanned = False
         reason = ''
@@ -3590,9 +5286,8 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if self.registryValue('ignoreChannel',channel):
                         continue
                     if self.registryValue('ignoreRegisteredUser',channel=channel):
-                        if len(chan.nicks[msg.nick]) > 4:
-                            if chan.nicks[msg.nick][4]:
-                                continue
+                        if chan.nicks[msg.nick].account:
+                            continue
                     protected = ircdb.makeChannelCapability(channel, 'protected')
                     if ircdb.checkCapability(msg.prefix, protected):
                         continue
@@ -3615,7 +5310,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                     if len(reason):
                         if 'Kicked by @appservice-irc:matrix.org' in reason or 'requested by' in reason:
                             continue
-                        bad = self.isChannelMassRepeat(irc,msg,channel,mask,reason)
+                        bad = self.isChannelMassRepeat(irc,msg,channel,mask,MessageContext(reason,reason))
                         if bad:
                             # todo, needs to see more on that one to avoid false positive
                             #self.kill(irc,msg.nick,msg.prefix)
@@ -3623,7 +5318,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             self.logChannel(irc,"IGNORED: [%s] %s (Part's message %s) : %s" % (channel,msg.prefix,bad,reason))
                     if not isBanned:
                         life = self.registryValue('abuseDuration',channel=channel)
-                        if self.hasAbuseOnChannel(irc,channel,'cycle') and time.time() - chan.nicks[msg.nick][0] < life:
+                        if self.hasAbuseOnChannel(irc,channel,'cycle') and time.time() - chan.nicks[msg.nick].joined(channel) < life:
                             isBanned = True
                             uid = random.randint(0,1000000)
                             log = "BAD: [%s] %s (cycle abuse - %s)" % (channel,msg.prefix,uid)
@@ -3637,7 +5332,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                 kind = 'joinSpamPart'
                                 life = self.registryValue('joinSpamPartLife',channel=channel)
                                 key = mask
-                                if kind in chan.buffers and key in chan.buffers[kind] and len(chan.buffers[kind][key]) == limit and msg.nick in chan.nicks and time.time() - chan.nicks[msg.nick][0] < life:
+                                if kind in chan.buffers and key in chan.buffers[kind] and len(chan.buffers[kind][key]) == limit and msg.nick in chan.nicks and time.time() - chan.nicks[msg.nick].joined(channel) < life:
                                     self.isAbuseOnChannel(irc,channel,'joinSpamPart',mask)
                                     if self.hasAbuseOnChannel(irc,channel,'joinSpamPart'):
                                         uid = random.randint(0,1000000)
@@ -3662,12 +5357,15 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
             if channel in i.channels:
                 self.setRegistryValue('lastActionTaken',-1.0,channel=channel)
                 self.logChannel(irc,'PART: [%s] %s (kicked)' % (channel,reason))
-                del i.channels[channel]
+                i.part(channel)
                 try:
                     network = conf.supybot.networks.get(irc.network)
                     network.channels().remove(channel)
                 except KeyError:
                     pass
+        elif channel in i.channels:
+            i.leave(channel,target)
+            i.depart(target)
 
     def doQuit (self,irc,msg):
         if msg.prefix == irc.prefix:
@@ -3676,6 +5374,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         if len(msg.args) == 1:
             reason = msg.args[0].lstrip().rstrip()
         i = self.getIrc(irc)
+        channels = i.quit(msg.nick)
         if reason == '*.net *.split':
             if not i.netsplit:
                 self.logChannel(irc,'INFO: netsplit activated for %ss : some abuses are ignored' % self.registryValue('netsplitDuration'))
@@ -3685,16 +5384,15 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         mask = self.prefixToMask(irc,msg.prefix)
         isBanned = False
         (nick,ident,host) = ircutils.splitHostmask(msg.prefix)
-        for channel in irc.state.channels:
+        for channel in channels:
             if ircutils.isChannel(channel) and not i.netsplit:
                chan = self.getChan(irc,channel)
                if self.registryValue('ignoreChannel',channel):
                    continue
                if msg.nick in chan.nicks:
                     if self.registryValue('ignoreRegisteredUser',channel=channel):
-                        if len(chan.nicks[msg.nick]) > 4:
-                            if chan.nicks[msg.nick][4]:
-                                continue
+                        if chan.nicks[msg.nick].account:
+                            continue
                     protected = ircdb.makeChannelCapability(channel, 'protected')
                     if ircdb.checkCapability(msg.prefix, protected):
                         continue
@@ -3719,7 +5417,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             kind = 'joinSpamPart'
                             life = self.registryValue('joinSpamPartLife',channel=channel)
                             key = mask
-                            if kind in chan.buffers and key in chan.buffers[kind] and len(chan.buffers[kind][key]) == limit and msg.nick in chan.nicks and time.time() - chan.nicks[msg.nick][0] < life:
+                            if kind in chan.buffers and key in chan.buffers[kind] and len(chan.buffers[kind][key]) == limit and msg.nick in chan.nicks and time.time() - chan.nicks[msg.nick].joined(channel) < life:
                                 self.isAbuseOnChannel(irc,channel,'joinSpamPart',mask)
                                 if self.hasAbuseOnChannel(irc,channel,'joinSpamPart'):
                                     uid = random.randint(0,1000000)
@@ -3744,9 +5442,9 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                 if h in host:
                                     found = True
                                     break
-                        if found and len(chan.nicks[msg.nick]) == 5:
-                            gecos = chan.nicks[msg.nick][3]
-                            account = chan.nicks[msg.nick][4]
+                        if found:
+                            gecos = chan.nicks[msg.nick].gecos
+                            account = chan.nicks[msg.nick].account
                             if not account and gecos == msg.nick and gecos in ident and len(msg.nick) < 6:
                                 isBanned = True
                                 uid = random.randint(0,1000000)
@@ -3756,15 +5454,16 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
     def doNick (self,irc,msg):
         oldNick = msg.prefix.split('!')[0]
         newNick = msg.args[0]
+        i = self.getIrc(irc)
+        newPrefix = '%s!%s' % (newNick,msg.prefix.split('!')[1])
+        channels = i.rename(oldNick,newNick,newPrefix)
         if oldNick == irc.nick or newNick == irc.nick:
             return
-        newPrefix = '%s!%s' % (newNick,msg.prefix.split('!')[1])
         mask = self.prefixToMask(irc,newPrefix)
-        i = self.getIrc(irc)
         if i.netsplit:
             return
         isBanned = False
-        for channel in irc.state.channels:
+        for channel in channels:
             if ircutils.isChannel(channel):
                 if self.registryValue('ignoreChannel',channel):
                     continue
@@ -3772,14 +5471,13 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                 if ircdb.checkCapability(newPrefix, protected):
                     continue
                 chan = self.getChan(irc,channel)
-                if oldNick in chan.nicks:
-                    chan.nicks[newNick] = chan.nicks[oldNick]
+                if newNick in chan.nicks:
                     # todo check digit/hexa nicks too
                     if not newNick.startswith('Guest'):
                         if not isBanned:
                             reason = False
                             if self.registryValue('ignoreRegisteredUser',channel=channel):
-                                if newNick in chan.nicks and len(chan.nicks[newNick]) > 4 and chan.nicks[newNick][4]:
+                                if chan.nicks[newNick].account:
                                     continue
                             flag = ircdb.makeChannelCapability(channel, 'nick')
                             if ircdb.checkCapability(msg.prefix, flag):
@@ -3787,7 +5485,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                             hasBeenIgnored = False
                             ignore = self.registryValue('ignoreDuration',channel=channel)
                             if ignore > 0:
-                                ts = chan.nicks[newNick][0]
+                                ts = chan.nicks[newNick].joined(channel)
                                 if time.time()-ts > ignore:
                                     hasBeenIgnored = True
                             if not isCloaked(msg.prefix,self):
@@ -3813,14 +5511,34 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
                                     self.ban(irc,newNick,newPrefix,mask,self.registryValue('klineDuration'),'%s - %s' % (uid,reason),self.registryValue('klineMessage'),log)
                                     self.setRegistryValue('lastActionTaken',time.time(),channel=channel)
                                     isBanned = True
-                    del chan.nicks[oldNick]
+
+    def flushCounts (self):
+        for network in list(self._ircs.keys()):
+            try:
+                self._ircs[network].flush(self.getDb(network))
+            except sqlite3.Error as e:
+                self.log.error('failed to write patterns count for %s: %s' % (network,e))
 
     def reset(self):
+        self.flushCounts()
         self._ircs = ircutils.IrcDict()
 
     def die(self):
         self.log.info('die() called')
-        self.cache = {}
+        try:
+            schedule.removeEvent('SigynPatternCount')
+        except KeyError:
+            pass
+        self.flushCounts()
+        self.resolver.stop()
+        self.dronebl.stop()
+        if self.exporter:
+            self.exporter.stop()
+        for (value,callback) in self.watched:
+            value.removeCallback(callback)
+        self.watched = []
+        self.settingsValues = set()
+        self.cache.clear()
         try:
             conf.supybot.protocols.irc.throttleTime.setValue(1.6)
         except:
@@ -3829,6 +5547,7 @@ class Sigyn(callbacks.Plugin,plugins.ChannelDBHandler):
         super().die()
 
     def doError (self,irc,msg):
+        self.flushCounts()
         self._ircs = ircutils.IrcDict()
 
     def makeDb(self, filename):
@@ -30,8 +30,1190 @@
 
 from supybot.test import *
 
+import os
+import re
+import random
+import socket
+import threading
+import tracemalloc
+import http.client
+import http.server
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+from . import plugin
+
+def largestString(s1, s2):
+    # reference dynamic programming version
+    m = [[0] * (1 + len(s2)) for i in range(1 + len(s1))]
+    longest, x_longest = 0, 0
+    for x in range(1, 1 + len(s1)):
+        for y in range(1, 1 + len(s2)):
+            if s1[x - 1] == s2[y - 1]:
+                m[x][y] = m[x - 1][y - 1] + 1
+                if m[x][y] > longest:
+                    longest = m[x][y]
+                    x_longest = x
+            else:
+                m[x][y] = 0
+    return s1[x_longest - longest: x_longest]
+
+def repetitions(s):
+    # reference regexp version
+    return [(m.group(1), len(m.group(0)) / len(m.group(1)))
+        for m in re.finditer(r"(.+?)\1+", s)]
+
+def benchmark(f, *args):
+    """returns best duration of f(*args) in seconds"""
+    best = None
+    for n in range(5):
+        start = time.perf_counter()
+        f(*args)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+def threshold(name, default):
+    """returns limit of a benchmark, from environment variable name if set"""
+    return float(os.environ.get(name, default))
+
+class FakeIrc(object):
+    """wraps the test irc, outgoing messages are counted and dropped"""
+    def __init__(self, irc):
+        self.irc = irc
+        self.sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self.irc, name)
+
+    def sendMsg(self, msg):
+        self.sent += 1
+
+    def queueMsg(self, msg):
+        self.sent += 1
+
+def traffic(channel, size):
+    """returns a synthetic log: chatter, spam waves, join floods and server notices"""
+    random.seed(0)
+    server = 'irc.server.test'
+    users = ['user%s!~u@192.0.2.%s.__no_testcap__' % (n, n % 250) for n in range(200)]
+    words = ['hello', 'how', 'are', 'you', 'user1', 'user42', 'spam', 'http://example.com',
+        'WHAT', 'is', 'this', 'channel', 'about', 'thanks', 'ok', ':)']
+    msgs = [ircmsgs.join(channel, prefix=prefix) for prefix in users]
+    n = 0
+    while len(msgs) < size:
+        n += 1
+        roll = random.random()
+        if roll < 0.8:
+            text = ' '.join(random.choice(words) for i in range(random.randint(1, 12)))
+            msgs.append(ircmsgs.privmsg(channel, text, prefix=random.choice(users)))
+        elif roll < 0.88:
+            # spam wave from fresh clients
+            text = 'join #spam%s now, free stuff at http://spam.test/%s' % (n, n)
+            for i in range(5):
+                prefix = 'spam%s_%s!~s@198.51.100.%s.__no_testcap__' % (n, i, i)
+                msgs.append(ircmsgs.join(channel, prefix=prefix))
+                msgs.append(ircmsgs.privmsg(channel, text, prefix=prefix))
+                msgs.append(ircmsgs.quit('Killed', prefix=prefix))
+        elif roll < 0.94:
+            # join flood
+            prefixes = ['flood%s_%s!~f@203.0.113.%s.__no_testcap__' % (n, i, i) for i in range(10)]
+            for prefix in prefixes:
+                msgs.append(ircmsgs.join(channel, prefix=prefix))
+            for prefix in prefixes:
+                msgs.append(ircmsgs.quit('Quit', prefix=prefix))
+        elif roll < 0.97:
+            msgs.append(ircmsgs.IrcMsg(prefix=server, command='NOTICE',
+                args=('*', '*** Notice -- Possible Flooder flood%s[~f@203.0.113.%s] on %s target: %s'
+                % (n, n % 250, server, channel))))
+        else:
+            msgs.append(ircmsgs.IrcMsg(prefix=server, command='NOTICE',
+                args=('*', '*** Notice -- oper{%s} added global 1440 min. K-Line for [*@203.0.113.%s] [spam]'
+                % (server, n % 250))))
+    return msgs
+
+def replay(cb, irc, msgs, interval):
+    """feeds msgs to cb through irc, clock moves interval seconds between
+    messages, returns (duration, latencies by command, peak memory)"""
+    latencies = {}
+    tracemalloc.start()
+    start = time.perf_counter()
+    for msg in msgs:
+        timeFastForward(interval)
+        irc.state.addMsg(irc.irc, msg)
+        f = getattr(cb, 'do%s' % msg.command.capitalize(), None)
+        t = time.perf_counter()
+        if f:
+            f(irc, msg)
+        latencies.setdefault(msg.command, []).append(time.perf_counter() - t)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (duration, latencies, peak)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class DroneblHandler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        server.requests.append(data)
+        if server.failures:
+            server.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        answer = []
+        for ip in re.findall(r"<lookup ip='([^']+)'", data):
+            listed = '1' if ip in server.listed else '0'
+            answer.append('<result ip="%s" type="6" id="1" listed="%s" />'
+                % (ip, listed))
+        body = ('<?xml version="1.0"?><response type="success">%s</response>'
+            % ''.join(answer)).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DroneblServer(http.server.HTTPServer):
+    """fake dronebl rpc, lists ips from listed, fails the first failures requests"""
+    def __init__(self, listed, failures=0):
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', 0), DroneblHandler)
+        self.listed = listed
+        self.failures = failures
+        self.requests = []
+        self.url = 'http://127.0.0.1:%s/RPC2' % self.server_address[1]
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+class DnsServer(threading.Thread):
+    """answers AAAA and A queries from records, counts queries"""
+    def __init__(self, records, delay=0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.records = records
+        self.delay = delay
+        self.queries = []
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                (data, address) = self.socket.recvfrom(4096)
+            except OSError:
+                break
+            query = dns.message.from_wire(data)
+            question = query.question[0]
+            name = question.name.to_text(omit_final_dot=True)
+            rdtype = dns.rdatatype.to_text(question.rdtype)
+            self.queries.append((name, rdtype))
+            time.sleep(self.delay)
+            response = dns.message.make_response(query)
+            if name not in self.records:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            elif rdtype in self.records[name]:
+                response.answer.append(dns.rrset.from_text(question.name, 60,
+                    'IN', rdtype, *self.records[name][rdtype]))
+            self.socket.sendto(response.to_wire(), address)
+
+    def stop(self):
+        self.socket.close()
+
 class SigynTestCase(PluginTestCase):
     plugins = ('Sigyn',)
 
+    def testMatcher(self):
+        m = plugin.Matcher()
+        m.add(plugin.Pattern(1,'Spam',False,0,0))
+        m.add(plugin.Pattern(2,'am sp',False,0,0))
+        m.add(plugin.Pattern(3,'/^hello/',True,0,0))
+        m.add(plugin.Pattern(4,'/w(o)rld\\1/i',True,0,0))
+        m.add(plugin.Pattern(5,'pam',False,0,0))
+        self.assertEqual(m.match('hello SPAM spam'), [1,2,3,5])
+        self.assertEqual(m.match('WORLDo'.encode('utf-8')), [4])
+        self.assertEqual(m.match('nothing here'), [])
+        m.remove(1)
+        m.remove(3)
+        self.assertEqual(m.match('hello spam'), [5])
+        m.add(plugin.Pattern(5,'hello',False,0,0))
+        self.assertEqual(m.match('hello spam'), [5])
+        m.add(plugin.Pattern(6,'/[0-9]{3}/',True,0,0))
+        self.assertEqual(m.match('call 555'), [6])
+
+    def testCompareString(self):
+        def jaccard(a, b):
+            (sa, sb) = (set(a), set(b))
+            if not len(sa | sb):
+                return 0
+            return len(sa & sb) / float(len(sa | sb))
+        for (a, b) in (('hello world', 'world hello'), ('abc', 'xyz'),
+                ('spam spam', 'sp\u00e4m'), ('', 'a'), ('a', '')):
+            self.assertEqual(plugin.compareString(a, b), jaccard(a, b))
+            self.assertEqual(plugin.compareString(a, b,
+                plugin.fingerprint(a), plugin.fingerprint(b)), jaccard(a, b))
+        self.assertEqual(plugin.compareString('same', 'same'), 1)
+        for n in range(1000):
+            a = ''.join(random.choice('abcdefghij') for i in range(random.randint(1, 20)))
+            b = ''.join(random.choice('abcdefghij') for i in range(random.randint(1, 20)))
+            percent = random.choice((0, 0.3, 0.5, 0.8, 0.95, 1))
+            if plugin.compareString(a, b) > percent:
+                self.assertIn(len(set(b)), plugin.similarSizes(len(set(a)), percent, 10))
+        self.assertEqual(plugin.similarSizes(3, 0, 12), range(1, 13))
+        self.assertEqual(plugin.similarSizes(4, 0.5, 5), range(2, 6))
+
+    def testSimilarIndex(self):
+        index = plugin.SimilarIndex(60)
+        lines = []
+        # a still clock, lines at the edge of the window must expire on both sides
+        clock = [time.time()]
+        self.addCleanup(setattr, time, 'time', time.time)
+        time.time = lambda: clock[0]
+        for n in range(4000):
+            text = ''.join(random.choice('abcdeFG !') for i in range(random.randint(0, 12)))
+            percent = random.choice((0, 0.5, 0.7, 0.9, 1))
+            lines = [line for line in lines if line[0] >= time.time() - 60]
+            expected = None
+            for (t, m) in lines:
+                if plugin.compareString(m, text) > percent:
+                    expected = m
+                    break
+            self.assertEqual(index.similar(text, percent), expected)
+            index.add(text)
+            lines.append((time.time(), text))
+            if n % 20 == 0:
+                clock[0] += 1
+        # bits of expired lines were dropped
+        self.assertLess(index.seq - index.base, 4000)
+        clock[0] += 61
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.chars, {})
+
+    def testLargestString(self):
+        for n in range(2000):
+            alphabet = 'ab c'[:random.randint(1, 4)]
+            s1 = ''.join(random.choice(alphabet) for i in range(random.randint(0, 30)))
+            s2 = ''.join(random.choice(alphabet) for i in range(random.randint(0, 30)))
+            self.assertEqual(plugin.largestString(s1, s2), largestString(s1, s2))
+        self.assertEqual(plugin.largestString('join #spam now', 'please join #spam'), 'join #spam')
+
+    def testRepetitions(self):
+        for n in range(2000):
+            alphabet = random.choice(['ab', 'abc', 'a\nb', 'ab ', 'abcdefgh'])
+            s = ''.join(random.choice(alphabet) for i in range(random.randint(0, 300)))
+            if n % 3 == 0:
+                s = s[:40] * random.randint(1, 4) + s
+            self.assertEqual(list(plugin.repetitions(s)), repetitions(s))
+            shortest = plugin.squares(s)
+            for x in range(0, len(s), 11):
+                p = 0
+                for q in range(1, (len(s) - x) // 2 + 1):
+                    if s[x:x+q] == s[x+q:x+2*q]:
+                        p = q
+                        break
+                self.assertEqual(shortest[x], p)
+        self.assertEqual(list(plugin.repetitions('spam spam spam !!')),
+            [('spam ', 3.0), ('!', 2.0)])
+        # longer texts are cut
+        self.assertEqual(list(plugin.repetitions('x' * 5000)),
+            [('x', float(plugin.repetitionsLength))])
+
+    def testWeirdness(self):
+        pools = ['abc XYZ 123 +=<>|~$^`', 'абвгд АБВ', '日本語', 'é́ÃÂ©™×◊√±',
+            '\x02\x03\x1f', 'ʃɐ', '¨´', '½¼', '😀🙂', 'Ωμ', '…—“”«»']
+        for n in range(5000):
+            chars = ''.join(random.sample(pools, random.randint(1, 3)))
+            text = ''.join(random.choice(chars) for i in range(random.randint(0, 12)))
+            self.assertEqual(plugin.weirdness(text), plugin.sequence_weirdness(text))
+        for text in ('hello, how are you ? :) 1+1=2', 'привет как дела', '今日は'):
+            self.assertFalse(plugin.mayBeWeird(text))
+        for text in ('\x02bold\x02', 'café́', 'latin и кириллица', 'Ã©tÃ©'):
+            self.assertTrue(plugin.mayBeWeird(text))
+
+    def testMessageContext(self):
+        cb = self.irc.getCallback('Sigyn')
+        for raw in ('', '   ', 'Hello WORLD, see http://example.com',
+                'ÎÙṊ free $$$', 'alice: bob, carol[m]: hi', '12345'):
+            message = plugin.MessageContext(raw, None, cb.spamchars)
+            text = raw.lower()
+            self.assertEqual(message.text, text)
+            self.assertEqual(message.ascii, all(ord(c) < 128 for c in text))
+            letters = raw.replace(' ', '')
+            self.assertEqual(message.letters, len(letters))
+            if letters:
+                self.assertEqual(message.caps,
+                    len(re.findall('[A-Z]', letters)) * 100 / len(letters))
+            self.assertEqual(message.spam, len([c for c in text if c in cb.spamchars]))
+            self.assertEqual(message.fingerprint, plugin.fingerprint(text))
+            self.assertEqual(message.words, set(plugin.nickSplit.split(text)))
+            self.assertEqual(message.url, text.find('http') != -1)
+        # part messages are compared as they are
+        self.assertEqual(plugin.MessageContext('Bye', 'Bye').text, 'Bye')
+
+    def testTmpPatterns(self):
+        patterns = plugin.TmpPatterns(60)
+        self.assertIsNone(patterns.search('anything'))
+        patterns.enqueue('spam')
+        self.addCleanup(timeFastForward, -152)
+        timeFastForward(30)
+        patterns.enqueue('free stuff')
+        patterns.enqueue('spam')
+        self.assertEqual(list(patterns), ['free stuff', 'spam'])
+        self.assertEqual(patterns.search('free stuff and spam'), 'free stuff')
+        timeFastForward(61)
+        self.assertEqual(len(patterns), 0)
+        self.assertIsNone(patterns.search('free stuff and spam'))
+        for n in range(200):
+            patterns.enqueue('pattern%s' % n)
+            patterns.enqueue('other')
+        self.assertEqual(patterns.search('x pattern150 y'), 'pattern1')
+        timeFastForward(61)
+        self.assertEqual(len(patterns), 0)
+        # expired patterns are dropped from the automaton
+        self.assertEqual(len(patterns.automaton.goto), 1)
+        patterns.enqueue('other')
+        patterns.reset()
+        self.assertIsNone(patterns.search('other'))
+        for n in range(1000):
+            words = ['ab', 'ba', 'abc', 'c', 'cab', 'bca']
+            patterns.enqueue(random.choice(words))
+            text = ''.join(random.choice('abc') for i in range(random.randint(0, 6)))
+            found = [p for p in patterns if p in text]
+            self.assertEqual(patterns.search(text), found[0] if found else None)
+
+    def testSharedPatterns(self):
+        cb = self.irc.getCallback('Sigyn')
+        i = cb.getIrc(self.irc)
+        share = conf.supybot.plugins.Sigyn.shareComputedPatternID
+        life = conf.supybot.plugins.Sigyn.computedPatternLife
+        for (value, old, setting) in ((share.get('#a'), share.get('#a')(), 1),
+                (share.get('#b'), share.get('#b')(), 1),
+                (life.get('#a'), life.get('#a')(), 60),
+                (life.get('#b'), life.get('#b')(), 600),
+                (life.get('#c'), life.get('#c')(), 60)):
+            self.addCleanup(value.setValue, old)
+            value.setValue(setting)
+        for channel in ('#a', '#b', '#c'):
+            cb.getChan(self.irc, channel)
+        # drops throttled WHO requests
+        self.irc.queue.reset()
+        group = cb.getPatterns(self.irc, '#a')
+        self.assertIs(cb.getPatterns(self.irc, '#b'), group)
+        self.assertEqual(group.channels, set(['#a', '#b']))
+        self.assertEqual(group.timeout, 600)
+        self.assertIsNone(cb.getPatterns(self.irc, '#c', False))
+        # outside defcon addtmp stays on the channel
+        self.assertNotError('addtmp #a local stuff')
+        self.assertEqual(len(group), 0)
+        local = cb.getLocalPatterns(self.irc, '#a')
+        self.assertEqual(list(local), ['local stuff'])
+        self.assertEqual(cb.getChannelPatterns(self.irc, '#a'), [group, local])
+        self.assertEqual(cb.getChannelPatterns(self.irc, '#b'), [group])
+        while self.irc.takeMsg():
+            pass
+        self.addCleanup(setattr, i, 'defcon', i.defcon)
+        i.defcon = time.time()
+        self.assertNotError('addtmp #a free stuff')
+        i.defcon = False
+        self.assertEqual(len(group.queue), 1)
+        self.assertEqual(group.search('get free stuff', 60), 'free stuff')
+        while self.irc.takeMsg():
+            pass
+        self.assertNotError('addglobaltmp spam')
+        self.assertEqual(list(cb.getPatterns(self.irc, '#c')), ['spam'])
+        self.assertEqual(list(group), ['free stuff', 'spam'])
+        while self.irc.takeMsg():
+            pass
+        self.assertResponse('lstmp #a', '[#a] 3 patterns : free stuff, spam, local stuff')
+        # each channel keeps its own life on the shared store
+        self.addCleanup(timeFastForward, -120)
+        timeFastForward(120)
+        self.assertIsNone(group.search('get free stuff', 60))
+        self.assertEqual(group.search('get free stuff', 600), 'free stuff')
+        self.assertEqual(group.alive(60), [])
+        while self.irc.takeMsg():
+            pass
+        self.assertNotError('rmtmp #b')
+        self.assertEqual(len(group), 0)
+        self.assertEqual(len(local), 0)
+        self.assertEqual(list(cb.getPatterns(self.irc, '#c')), [])
+        i.part('#a')
+        self.assertEqual(group.channels, set(['#b']))
+        share.get('#b').setValue(-1)
+        self.assertIsNot(cb.getPatterns(self.irc, '#b'), group)
+        self.assertEqual(group.channels, set())
+
+    def testNickIndex(self):
+        def count(users, text, nick):
+            found = set(u.lower() for u in users if len(u) > 3 and u != 'ChanServ'
+                and u != nick and u.lower() in text)
+            return len(found)
+        users = ['ChanServ', 'alice', 'Bob', 'carol[m]', 'dave', 'eve_', 'Mallory']
+        index = plugin.NickIndex(users)
+        for text in ('alice, dave: hi', 'alicedave eve_', '<carol[m]> mallory!',
+                'nobody', 'bob chanserv', ''):
+            self.assertEqual(index.count(text, 'Mallory', 100),
+                count(users, text, 'Mallory'))
+        index.rename('alice', 'alice2')
+        self.assertEqual(index.count('alice2', 'x', 100), 1)
+        for n in range(100):
+            index.add('nick%s' % n)
+            index.remove('nick%s' % n)
+        self.assertEqual(index.count('nick1 nick2 dave', 'x', 100), 1)
+        cb = self.irc.getCallback('Sigyn')
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        for prefix in ('alice!a@a', 'bobby!b@b', 'carol!c@c'):
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=prefix))
+        chan = cb.getChan(self.irc, channel)
+        self.irc.feedMsg(ircmsgs.part(channel, prefix='bobby!b@b'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='carol!c@c', command='NICK',
+            args=('caroline',)))
+        self.irc.feedMsg(ircmsgs.quit(prefix='alice!a@a'))
+        self.assertEqual(chan.hilights.nicks, set(u.lower() for u in
+            self.irc.state.channels[channel].users if len(u) > 3))
+
+    def testNickChannels(self):
+        cb = self.irc.getCallback('Sigyn')
+        i = cb.getIrc(self.irc)
+        def check():
+            expected = {}
+            for channel in i.channels:
+                for nick in self.irc.state.channels[channel].users:
+                    expected.setdefault(str(nick), set()).add(channel)
+            self.assertEqual(dict((str(nick), channels) for (nick, channels)
+                in i.nickchannels.items()), expected)
+        for channel in ('#sigyn', '#other', '#third'):
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+            for prefix in ('alice!a@a', 'bobby!b@b', 'carol!c@c'):
+                self.irc.feedMsg(ircmsgs.join(channel, prefix=prefix))
+            cb.getChan(self.irc, channel)
+        check()
+        self.irc.feedMsg(ircmsgs.part('#sigyn', prefix='bobby!b@b'))
+        check()
+        self.irc.feedMsg(ircmsgs.kick('#other', 'carol', prefix='alice!a@a'))
+        check()
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='carol!c@c', command='NICK',
+            args=('Carol',)))
+        check()
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='Carol!c@c', command='NICK',
+            args=('caroline',)))
+        self.assertEqual(i.nickchannels['caroline'], set(['#sigyn', '#third']))
+        check()
+        self.irc.feedMsg(ircmsgs.quit(prefix='alice!a@a'))
+        check()
+        self.irc.feedMsg(ircmsgs.kick('#third', self.nick, prefix='bobby!b@b'))
+        self.assertNotIn('#third', i.channels)
+        check()
+        self.irc.feedMsg(ircmsgs.part('#other', prefix=self.prefix))
+        check()
+        self.assertEqual(i.nickchannels['caroline'], set(['#sigyn']))
+
+    def testAccounts(self):
+        cb = self.irc.getCallback('Sigyn')
+        i = cb.getIrc(self.irc)
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        chan = cb.getChan(self.irc, channel)
+        i.track(chan, 'foo', 'foo!bar@baz', '*@baz', time.time(), 'foo', 'Acc')
+        i.track(chan, 'foo2', 'foo2!bar@baz', '*@baz', time.time(), 'foo', 'acc')
+        self.assertEqual(sorted(u.nick for u in i.sessions('ACC')), ['foo', 'foo2'])
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='foo2!bar@baz', command='ACCOUNT',
+            args=('*',)))
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='foo!bar@baz', command='NICK',
+            args=('bar',)))
+        self.assertEqual([u.nick for u in i.sessions('acc')], ['bar'])
+        i.untrack(chan, 'bar')
+        self.assertEqual(i.sessions('acc'), [])
+        self.assertEqual(i.accounts, {})
+        while self.irc.takeMsg():
+            pass
+        self.assertNotError('lethalaccount Evil')
+        self.assertIn('evil', i.klinednicks)
+        default = conf.supybot.capabilities.default
+        self.addCleanup(default.setValue, default())
+        default.setValue(False)
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='evil!e@__no_testcap__', command='JOIN',
+            args=(channel, 'Evil', 'gecos')))
+        self.assertIn('evil', i.tokline)
+        self.addCleanup(timeFastForward, -86400*2-1)
+        timeFastForward(86400*2+1)
+        self.assertNotIn('evil', i.klinednicks)
+        self.assertEqual(len(i.klinednicks), 0)
+
+    def testQuitRejoin(self):
+        cb = self.irc.getCallback('Sigyn')
+        i = cb.getIrc(self.irc)
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        chan = cb.getChan(self.irc, channel)
+        self.irc.feedMsg(ircmsgs.join(channel, prefix='foo!a@a'))
+        i.track(chan, 'foo', 'foo!a@a', '*@a', time.time(), 'foo', 'alice')
+        self.irc.feedMsg(ircmsgs.quit(prefix='foo!a@a'))
+        self.assertNotIn('foo', i.users)
+        self.assertEqual(i.sessions('alice'), [])
+        default = conf.supybot.capabilities.default
+        self.addCleanup(default.setValue, default())
+        default.setValue(False)
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='foo!b@__no_testcap__', command='JOIN',
+            args=(channel, '*', 'gecos')))
+        user = i.users['foo']
+        self.assertIs(chan.nicks['foo'], user)
+        self.assertEqual(user.prefix, 'foo!b@__no_testcap__')
+        self.assertEqual(user.account, None)
+        self.assertEqual(i.sessions('alice'), [])
+        cb.cleanup(self.irc)
+        self.assertIs(chan.nicks['foo'], user)
+
+    def testAmsg(self):
+        for (name, value) in (('amsgPermit', 0), ('amsgLife', 60),
+                ('amsgPercent', 0.8), ('amsgMinimum', 5)):
+            v = conf.supybot.plugins.Sigyn.get(name)
+            self.addCleanup(v.setValue, v())
+            v.setValue(value)
+        default = conf.supybot.capabilities.default
+        self.addCleanup(default.setValue, default())
+        default.setValue(False)
+        cb = self.irc.getCallback('Sigyn')
+        prefix = 'foo!bar@__no_testcap__'
+        channels = ('#sigyn', '#other', '#third')
+        for channel in channels:
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=prefix))
+        def detections():
+            return cb.metrics.get('sigyn_detections_total', (('kind', 'amsg'),))
+        # hits of a pattern with a limit are counted in the mask's queues too
+        i = cb.getIrc(self.irc)
+        uid = i.add(cb.getDb(self.irc.network), 'foo!bar@baz', 'see here', 10, 60, False)
+        self.addCleanup(i.remove, cb.getDb(self.irc.network), uid)
+        self.irc.feedMsg(ircmsgs.privmsg('#sigyn', 'nothing to see here', prefix=prefix))
+        self.assertIn(uid, i.queues['bar@__no_testcap__'])
+        self.irc.feedMsg(ircmsgs.privmsg('#other', 'another unrelated line', prefix=prefix))
+        self.assertEqual(detections(), 0)
+        self.irc.feedMsg(ircmsgs.privmsg('#third', 'nothing to see here!', prefix=prefix))
+        self.assertEqual(detections(), 1)
+        self.assertIn('nothing to see here!', list(cb.getChan(self.irc, '#sigyn').patterns))
+
+    def testSettings(self):
+        cb = self.irc.getCallback('Sigyn')
+        value = conf.supybot.plugins.Sigyn.floodPermit
+        old = value()
+        try:
+            self.assertEqual(cb.getSettings('#sigyn')['floodPermit'], old)
+            cb.setRegistryValue('floodPermit', 12, channel='#sigyn')
+            self.assertEqual(cb.getSettings('#sigyn')['floodPermit'], 12)
+            value.setValue(7)
+            self.assertEqual(cb.getSettings('#other')['floodPermit'], 7)
+            self.assertEqual(cb.getSettings(None)['floodPermit'], 7)
+            self.assertEqual(cb.getSettings('#sigyn')['floodPermit'], 12)
+            # registry removes callbacks by identity, a new bound method never matches,
+            # die gives back the very callbacks which were added
+            self.assertIsNot(cb.resetSettings, cb.resetSettings)
+            self.assertIn(value, [v for (v, c) in cb.watched])
+            for (v, callback) in cb.watched:
+                self.assertTrue([c for (c, args, kwargs) in v._callbacks if c is callback])
+        finally:
+            value.get('#sigyn').setValue(old)
+            value.setValue(old)
+
+    def testCapabilities(self):
+        cb = self.irc.getCallback('Sigyn')
+        # checkCapability is always true in tests without it
+        prefix = 'foo!bar@__no_testcap__'
+        bits = plugin.capabilityBits
+        def check(channel):
+            capabilities = cb.getCapabilities(prefix, channel)
+            for detector in plugin.detectors:
+                flag = ircdb.makeChannelCapability(channel, detector)
+                self.assertEqual(bool(capabilities & bits[detector]),
+                    bool(ircdb.checkCapability(prefix, flag)))
+            return capabilities
+        self.assertTrue(check('#sigyn') & bits['hilight'])
+        user = ircdb.users.newUser()
+        user.name = 'foo'
+        user.addHostmask('*!*@__no_testcap__')
+        user.addCapability('#sigyn,-hilight')
+        ircdb.users.setUser(user)
+        # databases are checked at most once per second
+        cb.capabilitiesChecked = 0
+        self.assertFalse(check('#sigyn') & bits['hilight'])
+        self.assertTrue(check('#other') & bits['hilight'])
+
+    def testCache(self):
+        c = plugin.Cache(2)
+        c.set('a','1',60)
+        c.set('b','2',60)
+        self.assertEqual(c.get('a'), '1')
+        c.set('c','3',60)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('a'), '1')
+        c.set('d','4',-1)
+        self.assertEqual(c.get('d'), None)
+        self.assertEqual((c.hits,c.misses,c.evictions,c.expirations), (2,2,2,1))
+        c.resize(1)
+        self.assertEqual(len(c), 1)
+
+    def testResolver(self):
+        server = DnsServer({'example.test': {'A': ['192.0.2.1'],
+            'AAAA': ['2001:db8::1']}, 'v4.test': {'A': ['192.0.2.2']}},
+            delay=0.2)
+        server.start()
+        resolver = plugin.Resolver(4, 16, 2, 60, ['127.0.0.1'], server.port)
+        results = []
+        done = threading.Event()
+        def callback(host, ips):
+            results.append((host, ips))
+            if len(results) == 4:
+                done.set()
+        try:
+            self.assertTrue(resolver.resolve('example.test', callback))
+            self.assertTrue(resolver.resolve('example.test', callback))
+            self.assertTrue(resolver.resolve('v4.test', callback))
+            self.assertTrue(resolver.resolve('nx.test', callback))
+            self.assertTrue(done.wait(5))
+            self.assertEqual(sorted(results), [
+                ('example.test', ['2001:db8::1', '192.0.2.1']),
+                ('example.test', ['2001:db8::1', '192.0.2.1']),
+                ('nx.test', []), ('v4.test', ['192.0.2.2'])])
+            # identical requests were coalesced
+            self.assertEqual(server.queries.count(('example.test', 'A')), 1)
+            self.assertEqual(server.queries.count(('example.test', 'AAAA')), 1)
+            # negative answer is cached
+            results[:] = []
+            resolver.resolve('nx.test', callback)
+            self.assertEqual(results, [('nx.test', [])])
+            self.assertEqual(len([q for q in server.queries if q[0] == 'nx.test']), 2)
+        finally:
+            resolver.stop()
+            server.stop()
+
+    def testResolverQueueFull(self):
+        server = DnsServer({}, delay=0.5)
+        server.start()
+        resolver = plugin.Resolver(1, 2, 2, 60, ['127.0.0.1'], server.port)
+        try:
+            self.assertTrue(resolver.resolve('a.test', lambda host, ips: None))
+            self.assertFalse(resolver.resolve('b.test', lambda host, ips: None))
+        finally:
+            resolver.stop()
+            server.stop()
+
+    def testDronebl(self):
+        server = DroneblServer(['192.0.2.1'], failures=1)
+        dronebl = plugin.Dronebl(10, 60, 2, 0.01, 0.2)
+        results = []
+        done = threading.Event()
+        def callback(ip, status, detail):
+            results.append((ip, status, detail))
+            if len(results) == 3:
+                done.set()
+        try:
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.1', None, callback))
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.2', 'Bottler', callback))
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.3', None, callback))
+            # recently submitted
+            self.assertFalse(dronebl.add(server.url, 'k', '192.0.2.2', None, callback))
+            self.assertTrue(done.wait(5))
+            self.assertEqual(sorted(results), [('192.0.2.1', 'listed', None),
+                ('192.0.2.2', 'added', 5), ('192.0.2.3', 'added', 3)])
+            # first lookup failed and was retried, then one batched add
+            self.assertEqual(len(server.requests), 3)
+            self.assertEqual(server.requests[0], server.requests[1])
+            self.assertEqual(server.requests[1].count('<lookup'), 3)
+            self.assertEqual(server.requests[2].count('<add'), 2)
+            # a failed add may be submitted again
+            del results[:]
+            done.clear()
+            server.failures = 3
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.4', None, callback))
+            for n in range(50):
+                if len(results):
+                    break
+                time.sleep(0.1)
+            self.assertEqual([(ip, status) for (ip, status, detail) in results],
+                [('192.0.2.4', 'error')])
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.4', None, callback))
+        finally:
+            dronebl.stop()
+            server.shutdown()
+            server.server_close()
+
+    def testDroneblBatchError(self):
+        class Dronebl(plugin.Dronebl):
+            # adds fail once lookups are done
+            def post(self, host, key, elements):
+                if '<add' in elements[0]:
+                    raise plugin.requests.exceptions.ConnectionError('down')
+                return plugin.Dronebl.post(self, host, key, elements)
+        server = DroneblServer(['192.0.2.1'])
+        dronebl = Dronebl(10, 60, 0, 0.01, 0.2)
+        results = []
+        done = threading.Event()
+        def callback(ip, status, detail):
+            results.append((ip, status))
+            if len(results) == 2:
+                done.set()
+        try:
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.1', None, callback))
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.5', None, callback))
+            self.assertTrue(done.wait(5))
+            time.sleep(0.1)
+            # the listed job is not reported again as an error
+            self.assertEqual(sorted(results), [('192.0.2.1', 'listed'), ('192.0.2.5', 'error')])
+            self.assertFalse(dronebl.add(server.url, 'k', '192.0.2.1', None, callback))
+            self.assertTrue(dronebl.add(server.url, 'k', '192.0.2.5', None, callback))
+        finally:
+            dronebl.stop()
+            server.shutdown()
+            server.server_close()
+
+    def testPatternCount(self):
+        db = self.irc.getCallback('Sigyn').makeDb(':memory:')
+        i = plugin.Ircd(self.irc)
+        uid = i.add(db,'foo!bar@baz','spam',0,0,False)
+        def triggered():
+            c = db.cursor()
+            c.execute("""SELECT triggered FROM patterns WHERE id=?""",(uid,))
+            (triggered,) = c.fetchone()
+            c.close()
+            return triggered
+        i.count(db,uid,3)
+        i.count(db,uid,3)
+        self.assertEqual(triggered(), 0)
+        self.assertIn('(2 calls)', i.ls(db,str(uid))[0])
+        i.count(db,uid,3)
+        self.assertEqual(triggered(), 3)
+        self.assertEqual(i.triggered, 0)
+        i.count(db,uid,3)
+        self.assertEqual(i.triggered, 1)
+        i.flush(db)
+        self.assertEqual(triggered(), 4)
+        self.assertEqual(i.triggered, 0)
+        self.assertIn('(4 calls)', i.ls(db,str(uid))[0])
+
+    def testWindow(self):
+        random.seed(0)
+        w = plugin.Window(10)
+        q = utils.structures.TimeoutQueue(10)
+        elapsed = 0
+        for n in range(3000):
+            roll = random.random()
+            if roll < 0.5:
+                value = random.choice(['a', 'a', 'b', ('c', 1)])
+                w.enqueue(value)
+                q.enqueue(value)
+            elif roll < 0.6:
+                step = random.choice([0.5, 3, 11])
+                timeFastForward(step)
+                elapsed += step
+            elif roll < 0.62:
+                w.reset()
+                q.reset()
+            elif roll < 0.64 and len(q):
+                self.assertEqual(w.dequeue(), q.dequeue())
+            self.assertEqual(len(w), len(q))
+            self.assertEqual(list(w), list(q))
+        self.addCleanup(timeFastForward, -elapsed)
+        w.reset()
+        for value in ('a', 'a', 'b'):
+            w.enqueue(value)
+        w[1] = 'c'
+        self.assertEqual((w[0], w[1], w[2]), ('a', 'c', 'b'))
+
+    def testTimerWheel(self):
+        random.seed(0)
+        now = 1000000
+        wheel = plugin.TimerWheel(levels=3, now=now)
+        items = {}
+        for n in range(5000):
+            at = now + random.choice([0, 1, 5, 63, 64, 65, 200, 4095, 4096, 5000, 300000]) + random.random()
+            wheel.add(at, n)
+            items[n] = at
+        self.assertEqual(len(wheel), 5000)
+        while items:
+            now += random.choice([1, 7, 60, 1000, 10000])
+            due = wheel.advance(now)
+            self.assertEqual(sorted(due), sorted([n for n in items if int(items[n]) <= now]))
+            for n in due:
+                del items[n]
+        self.assertEqual(len(wheel), 0)
+
+    def testCleanup(self):
+        cb = self.irc.getCallback('Sigyn')
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        self.irc.feedMsg(ircmsgs.join(channel, prefix='foo!bar@baz'))
+        i = cb.getIrc(self.irc)
+        chan = cb.getChan(self.irc, channel)
+        # protected users are not tracked
+        i.track(chan, 'foo', 'foo!bar@baz', '*@baz', time.time())
+        cb.getIrcQueueFor(self.irc, 'short', 'kind', 10).enqueue('a')
+        cb.getIrcQueueFor(self.irc, 'long', 'kind', 100).enqueue('a')
+        self.irc.feedMsg(ircmsgs.part(channel, prefix='foo!bar@baz'))
+        self.addCleanup(timeFastForward, -20)
+        timeFastForward(20)
+        cb.cleanup(self.irc)
+        self.assertNotIn('short', i.queues)
+        self.assertIn('long', i.queues)
+        self.assertNotIn('foo', chan.nicks)
+        self.assertNotIn('foo', i.users)
+
+    def testUsers(self):
+        cb = self.irc.getCallback('Sigyn')
+        i = cb.getIrc(self.irc)
+        for channel in ('#sigyn', '#other'):
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        (sigyn, other) = (cb.getChan(self.irc, '#sigyn'), cb.getChan(self.irc, '#other'))
+        for chan in (sigyn, other):
+            self.irc.feedMsg(ircmsgs.join(chan.channel, prefix='foo!bar@baz'))
+            i.track(chan, 'foo', 'foo!bar@baz', '*@baz', time.time())
+        user = i.users['foo']
+        self.assertIs(sigyn.nicks['foo'], other.nicks['foo'])
+        self.assertEqual(sorted(user.joins), ['#other', '#sigyn'])
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='foo!bar@baz', command='ACCOUNT',
+            args=('foo',)))
+        self.assertEqual(other.nicks['foo'].account, 'foo')
+        self.irc.feedMsg(ircmsgs.IrcMsg(prefix='foo!bar@baz', command='NICK',
+            args=('bar',)))
+        self.assertNotIn('foo', i.users)
+        self.assertIs(i.users['bar'], user)
+        self.assertIs(sigyn.nicks['bar'], user)
+        self.assertEqual(user.prefix, 'bar!bar@baz')
+        self.irc.feedMsg(ircmsgs.part('#sigyn', prefix='bar!bar@baz'))
+        cb.cleanup(self.irc)
+        self.assertNotIn('bar', sigyn.nicks)
+        self.assertEqual(list(user.joins), ['#other'])
+        self.irc.feedMsg(ircmsgs.part('#other', prefix=self.prefix))
+        self.assertNotIn('bar', i.users)
+
+    def testHistogram(self):
+        h = plugin.Histogram(60)
+        self.addCleanup(timeFastForward, -243)
+        for n in range(99):
+            h.add(0.0001)
+        h.add(0.01)
+        self.assertEqual(len(h), 100)
+        self.assertEqual(h.percentile(0.5), 128 / 1000000.0)
+        self.assertEqual(h.percentile(1), 16384 / 1000000.0)
+        timeFastForward(61)
+        h.add(0.0001)
+        self.assertEqual(len(h), 101)
+        timeFastForward(61)
+        self.assertEqual(len(h), 1)
+        timeFastForward(121)
+        self.assertEqual(len(h), 0)
+
+    def testProfile(self):
+        path = os.path.join(conf.supybot.directories.data(), 'profile.txt')
+        for (name, value) in (('profileSample', 1), ('profileFile', path),
+                ('floodPermit', 10), ('floodLife', 10)):
+            v = conf.supybot.plugins.Sigyn.get(name)
+            self.addCleanup(v.setValue, v())
+            v.setValue(value)
+        default = conf.supybot.capabilities.default
+        self.addCleanup(default.setValue, default())
+        default.setValue(False)
+        cb = self.irc.getCallback('Sigyn')
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        prefix = 'foo!bar@baz.__no_testcap__'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=prefix))
+        self.irc.feedMsg(ircmsgs.privmsg(channel, 'hello', prefix=prefix))
+        self.assertEqual(len(cb.getIrc(self.irc).timings['flood']), 1)
+        while self.irc.takeMsg():
+            pass
+        self.assertNotError('profile')
+        with open(path) as f:
+            self.assertIn('flood: 1 samples', f.read())
+
+    def testMetrics(self):
+        m = plugin.Metrics()
+        m.inc('sigyn_messages_total', (('channel', '#a"b'),))
+        m.inc('sigyn_messages_total', (('channel', '#a"b'),), 2)
+        m.inc('sigyn_kills_total')
+        self.assertEqual(m.render([('sigyn_queues', (('network', 'test'),), 4)]),
+            '# TYPE sigyn_kills_total counter\n'
+            'sigyn_kills_total 1\n'
+            '# TYPE sigyn_messages_total counter\n'
+            'sigyn_messages_total{channel="#a\\"b"} 3\n'
+            '# TYPE sigyn_queues gauge\n'
+            'sigyn_queues{network="test"} 4\n')
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        path = os.path.join(conf.supybot.directories.data(), 'metrics.prom')
+        exporter = plugin.Exporter(m.render, '127.0.0.1', port, path, 0.05)
+        try:
+            c = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            c.request('GET', '/metrics')
+            self.assertIn('sigyn_kills_total 1', c.getresponse().read().decode())
+            c.close()
+            for n in range(100):
+                if os.path.exists(path):
+                    break
+                time.sleep(0.05)
+            with open(path) as f:
+                self.assertIn('sigyn_kills_total 1', f.read())
+        finally:
+            exporter.stop()
+        cb = self.irc.getCallback('Sigyn')
+        for (name, value) in (('enable', True), ('useWhoWas', True)):
+            v = conf.supybot.plugins.Sigyn.get(name)
+            self.addCleanup(v.setValue, v())
+            v.setValue(value)
+        cb.getIrc(self.irc).opered = True
+        cb.ban(self.irc, 'foo', 'foo!bar@baz', '*@baz', 60, 'spam', 'bye', 'BAD: foo')
+        self.assertEqual(cb.metrics.get('sigyn_kills_total'), 1)
+        self.assertEqual(cb.metrics.get('sigyn_whowas_fallbacks_total'), 1)
+        self.assertIn('sigyn_cache_entries{cache="masks"}', cb.renderMetrics())
+        i = cb.getIrc(self.irc)
+        i.queues.clear()
+        q = cb.getIrcQueueFor(self.irc, 'foo', 'kind', 60)
+        q.enqueue('a')
+        q.enqueue('b')
+        i.queues['foo']['marker'] = time.time()
+        self.assertIn(('sigyn_queues', (('network', self.irc.network),), 2), cb.gauges())
+        # gauges run on the exporter's threads and do not expire Windows
+        self.addCleanup(timeFastForward, -61)
+        timeFastForward(61)
+        self.assertIn(('sigyn_queues', (('network', self.irc.network),), 2), cb.gauges())
+        self.assertEqual(len(q.stamps), 2)
+        self.assertEqual(len(q), 0)
+
+
+@unittest.skipUnless(os.environ.get('SIGYN_BENCHMARK'),
+    'set SIGYN_BENCHMARK to run benchmarks')
+class SigynBenchmarkTestCase(PluginTestCase):
+    plugins = ('Sigyn',)
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        # detectors enabled, but never triggered
+        self.values = {}
+        for (name, value) in (('floodPermit', 1000), ('floodLife', 60),
+                ('lowFloodPermit', 1000), ('lowFloodLife', 60),
+                ('repeatPermit', 1000), ('repeatLife', 60),
+                ('lowRepeatPermit', 1000), ('lowRepeatLife', 60),
+                ('massRepeatPermit', 1000), ('massRepeatLife', 60),
+                ('lowMassRepeatPermit', 1000), ('lowMassRepeatLife', 60),
+                ('hilightNick', 1000), ('lowHilightNick', 1000),
+                ('capPermit', 1000), ('badunicodeLimit', 1),
+                ('badunicodeScore', 1000), ('amsgPermit', 1000)):
+            v = conf.supybot.plugins.Sigyn.get(name)
+            self.values[name] = v()
+            v.setValue(value)
+
+    def tearDown(self):
+        for name in self.values:
+            conf.supybot.plugins.Sigyn.get(name).setValue(self.values[name])
+        PluginTestCase.tearDown(self)
+
+    def testHandleMsg(self):
+        random.seed(0)
+        cb = self.irc.getCallback('Sigyn')
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        prefixes = ['user%s!~u@192.0.2.%s' % (n, n) for n in range(100)]
+        for prefix in prefixes:
+            self.irc.feedMsg(ircmsgs.join(channel, prefix=prefix))
+        words = ['hello', 'how', 'are', 'you', 'user1', 'spam', 'http://example.com',
+            'WHAT', 'is', 'this', 'channel', 'about']
+        msgs = []
+        for n in range(5000):
+            text = ' '.join(random.choice(words) for i in range(random.randint(1, 12)))
+            msgs.append(ircmsgs.privmsg(channel, text, prefix=random.choice(prefixes)))
+        start = time.perf_counter()
+        for msg in msgs:
+            cb.doPrivmsg(self.irc, msg)
+        duration = time.perf_counter() - start
+        print('\nhandleMsg: %d messages/s' % (len(msgs) / duration))
+        self.assertGreater(len(msgs) / duration, threshold('SIGYN_MIN_HANDLEMSG_RATE', 5000))
+
+    def testReplay(self):
+        # detectors enabled with usual thresholds, klines and kills are dropped by the fake irc
+        for (name, value) in (('floodPermit', 4), ('floodLife', 7),
+                ('lowFloodPermit', 6), ('lowFloodLife', 30),
+                ('repeatPermit', 3), ('repeatLife', 40),
+                ('lowRepeatPermit', 6), ('lowRepeatLife', 120),
+                ('massRepeatPermit', 3), ('massRepeatLife', 60),
+                ('lowMassRepeatPermit', 6), ('lowMassRepeatLife', 600),
+                ('hilightNick', 5), ('lowHilightNick', 3),
+                ('capPermit', 3), ('amsgPermit', 3), ('enable', True)):
+            v = conf.supybot.plugins.Sigyn.get(name)
+            self.addCleanup(v.setValue, v())
+            v.setValue(value)
+        # unknown users are not protected
+        default = conf.supybot.capabilities.default
+        self.addCleanup(default.setValue, default())
+        default.setValue(False)
+        cb = self.irc.getCallback('Sigyn')
+        channel = '#sigyn'
+        self.irc.feedMsg(ircmsgs.join(channel, prefix=self.prefix))
+        irc = FakeIrc(self.irc)
+        cb.getIrc(irc).opered = True
+        path = os.environ.get('SIGYN_REPLAY')
+        if path:
+            # recorded raw lines, as received from the server
+            with open(path) as f:
+                msgs = [ircmsgs.IrcMsg(line.strip()) for line in f if line.strip()]
+        else:
+            msgs = traffic(channel, 10000)
+        interval = float(os.environ.get('SIGYN_REPLAY_INTERVAL', 0.1))
+        self.addCleanup(timeFastForward, -interval * len(msgs))
+        (duration, latencies, peak) = replay(cb, irc, msgs, interval)
+        print('\nreplay: %d messages, %d messages/s, %d sent, peak memory %.1fMB' %
+            (len(msgs), len(msgs) / duration, irc.sent, peak / 1048576.0))
+        for command in sorted(latencies):
+            values = latencies[command]
+            print('%s: %d, p50 %.3fms, p99 %.3fms' % (command, len(values),
+                percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000))
+        self.assertGreater(len(msgs) / duration, threshold('SIGYN_MIN_REPLAY_RATE', 100))
+        for values in latencies.values():
+            self.assertLess(percentile(values, 0.99) * 1000, threshold('SIGYN_MAX_P99', 100))
+        if not path and interval == 0.1:
+            # klines, kills and reports of the seeded traffic, any change of detections shows here
+            self.assertEqual(irc.sent, 111)
+
+    def testWindow(self):
+        def fill(cls, size):
+            tracemalloc.start()
+            start = time.perf_counter()
+            queues = [cls(60) for n in range(size)]
+            for q in queues:
+                for n in range(3):
+                    q.enqueue('spam')
+                len(q)
+            duration = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            return (duration, peak)
+        for cls in (utils.structures.TimeoutQueue, plugin.Window):
+            (duration, peak) = fill(cls, 100000)
+            print('\n%s: 100000 queues of 3 items, %.3fs, %.1fMB' %
+                (cls.__name__, duration, peak / 1048576.0))
+
+    def testCleanup(self):
+        cb = self.irc.getCallback('Sigyn')
+        for n in range(100000):
+            cb.getIrcQueueFor(self.irc, 'key%s' % n, 'kind', 60 + n % 600).enqueue('spam')
+        timeFastForward(61)
+        self.addCleanup(timeFastForward, -61)
+        start = time.perf_counter()
+        cb.cleanup(self.irc)
+        expired = time.perf_counter() - start
+        start = time.perf_counter()
+        cb.cleanup(self.irc)
+        idle = time.perf_counter() - start
+        print('\ncleanup of 100000 queues: %.3fs with %d expired, %.6fs without' %
+            (expired, 100000 - len(cb.getIrc(self.irc).queues), idle))
+
+    def testSimilarIndex(self):
+        random.seed(0)
+        words = ['hello', 'how', 'are', 'you', 'doing', 'today', 'anyone', 'knows',
+            'why', 'my', 'kernel', 'panics', 'with', 'this', 'config', 'thanks',
+            'lol', 'ok', 'sure', 'python', 'version', '3.9', 'install', 'pip', 'error',
+            'quick', 'brown', 'fox', 'jumps', 'over', 'lazy', 'dog', '?', '!']
+        def line():
+            return ' '.join(random.choice(words) for i in range(random.randint(2, 10)))
+        def scan(logs, text, percent):
+            fp = plugin.fingerprint(text)
+            for (m, fm) in logs:
+                if plugin.compareString(m, text, fm, fp) > percent:
+                    return m
+            return None
+        texts = [line() for n in range(1000)]
+        for size in (100, 1000, 5000):
+            window = plugin.Window(3600)
+            index = plugin.SimilarIndex(3600)
+            for n in range(size):
+                text = line()
+                window.enqueue((text, plugin.fingerprint(text)))
+                index.add(text)
+            before = benchmark(lambda: [scan(window, text, 0.85) for text in texts])
+            after = benchmark(lambda: [index.similar(text, 0.85) for text in texts])
+            print('\nmassRepeat lookup in %s lines: scan %.3fms, index %.3fms' %
+                (size, before, after))
+
+    def testTmpPatterns(self):
+        random.seed(0)
+        words = ['hello', 'how', 'are', 'you', 'doing', 'today', 'join', 'free',
+            'stuff', 'click', 'here', 'now', 'spam', 'offer', 'best']
+        def line():
+            return ' '.join(random.choice(words) for i in range(random.randint(2, 10)))
+        def scan(patterns, text):
+            for pattern in patterns:
+                if pattern in text:
+                    return pattern
+            return None
+        texts = [line() for n in range(1000)]
+        for size in (10, 100, 1000):
+            window = plugin.Window(3600)
+            patterns = plugin.TmpPatterns(3600)
+            for n in range(size):
+                pattern = 'spam%s http://spam%s.test' % (n, n)
+                window.enqueue(pattern)
+                patterns.enqueue(pattern)
+            before = benchmark(lambda: [scan(window, text) for text in texts])
+            after = benchmark(lambda: [patterns.search(text) for text in texts])
+            print('\ntmp patterns lookup with %s patterns: scan %.3fms, automaton %.3fms' %
+                (size, before, after))
+
+    def testLargestString(self):
+        random.seed(0)
+        words = ['spam', 'join', '#channel', 'http://example.com', 'free',
+            'now', 'click', 'here', 'the', 'best', 'offer']
+        for size in (50, 200, 400):
+            s1 = ' '.join(random.choice(words) for i in range(size // 5))[:size]
+            s2 = ' '.join(random.choice(words) for i in range(size // 5))[:size]
+            before = benchmark(largestString, s1, s2)
+            after = benchmark(plugin.largestString, s1, s2)
+            print('\nlargestString %s chars: dp %.3fms, automaton %.3fms' %
+                (size, before * 1000, after * 1000))
+
+    def testWeirdness(self):
+        random.seed(0)
+        words = ['hello', 'how', 'are', 'you', 'spam', 'free', 'join', 'now', ':)']
+        lines = {'ascii': [' '.join(random.choice(words) for i in range(random.randint(3, 30)))
+                for n in range(1000)],
+            'cyrillic': [' '.join(random.choice(['привет', 'как', 'дела', 'спам'])
+                for i in range(random.randint(3, 30))) for n in range(1000)],
+            'mixed': [' '.join(random.choice(words + ['Ã©', 'ÐŸ', 'кот', '̸']) for i in
+                range(random.randint(3, 30))) for n in range(1000)]}
+        for (kind, texts) in lines.items():
+            before = benchmark(lambda: [plugin.sequence_weirdness(text) for text in texts])
+            plugin.weirdness.cache_clear()
+            after = benchmark(lambda: [plugin.weirdness.__wrapped__(text) for text in texts])
+            cached = benchmark(lambda: [plugin.weirdness(text) for text in texts])
+            print('\nweirdness of 1000 %s lines: ftfy %.3fms, screened %.3fms, cached %.3fms' %
+                (kind, before * 1000, after * 1000, cached * 1000))
+
+    def testRepetitions(self):
+        random.seed(0)
+        words = ['hello', 'how', 'are', 'you', 'spam', 'free', 'join', 'now']
+        for size in (256, 512, 2048):
+            # thue-morse differences, ternary and without any square
+            bits = [bin(n).count('1') % 2 for n in range(size + 1)]
+            lines = (('square free', ''.join('abc'[bits[n+1] - bits[n] + 1] for n in range(size))),
+                ('distinct', ''.join(chr(0x4e00 + n) for n in range(size))),
+                ('words', ' '.join(random.choice(words) for n in range(size))[:size]),
+                ('binary', ''.join(random.choice('ab') for n in range(size))),
+                ('spam', ('free stuff at http://spam.test ' * size)[:size]))
+            for (kind, line) in lines:
+                before = benchmark(repetitions, line)
+                after = benchmark(lambda s: list(plugin.repetitions(s)), line)
+                print('\nrepetitions of %s chars %s: regexp %.3fms, squares %.3fms' %
+                    (size, kind, before * 1000, after * 1000))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79: